@@ -0,0 +1,203 @@
+"""Resumable, parallel backfill engine for derived email columns.
+
+A backfill walks the emails table in primary-key order (keyset iteration, no
+OFFSET and no re-sorting), computes new values for each batch on a worker
+pool, and writes the batch back with a single execute_values UPDATE. The last
+processed id is stored in backfill_checkpoints in the same transaction as the
+UPDATE, so an interrupted run resumes exactly where it stopped. The checkpoint
+is cleared once a run completes.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from psycopg2.extras import DictCursor, execute_values
+
+import db
+import rollups
+
+
+class RateLimiter:
+    """Spread calls evenly so at most ``rate`` start per second (None = unlimited)."""
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def ensure_checkpoint_table():
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS backfill_checkpoints (
+                name TEXT PRIMARY KEY,
+                last_id INTEGER NOT NULL DEFAULT 0,
+                processed INTEGER NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        ''')
+        conn.commit()
+        cur.close()
+
+
+def load_checkpoint(name):
+    """Return (last_id, processed) for a backfill, or (0, 0) if it never ran."""
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT last_id, processed FROM backfill_checkpoints WHERE name = %s', (name,))
+        row = cur.fetchone()
+        cur.close()
+    return (row[0], row[1]) if row else (0, 0)
+
+
+def reset_checkpoint(name):
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute('DELETE FROM backfill_checkpoints WHERE name = %s', (name,))
+        conn.commit()
+        cur.close()
+
+
+def _save_checkpoint(cur, name, last_id, processed):
+    cur.execute('''
+        INSERT INTO backfill_checkpoints (name, last_id, processed, updated_at)
+        VALUES (%s, %s, %s, NOW())
+        ON CONFLICT (name) DO UPDATE
+        SET last_id = EXCLUDED.last_id,
+            processed = EXCLUDED.processed,
+            updated_at = NOW()
+    ''', (name, last_id, processed))
+
+
+def _format_eta(seconds):
+    if seconds is None:
+        return '?'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s"
+
+
+def _compute_rows(name, pool, limiter, compute, rows):
+    futures = []
+    for row in rows:
+        limiter.wait()
+        futures.append(pool.submit(compute, row))
+    values = []
+    for row, future in zip(rows, futures):
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f"[{name}] Error processing email {row['id']}: {str(e)}")
+            continue
+        if isinstance(result, list):
+            values.extend(result)
+        elif result is not None:
+            values.append(result)
+    return values
+
+
+def run_backfill(name, select_sql, compute, update_sql, template=None, params=None,
+                 count_sql=None, batch_size=200, workers=4, executor='thread',
+                 rate_limit=None, restart=False, compute_batch=None, skip_rollups=False):
+    """Run (or resume) a named backfill.
+
+    select_sql must select an ``id`` column and use the named placeholders
+    ``%(last_id)s`` (rows with a greater id) and ``%(limit)s``, ordered by id.
+    ``compute`` receives each row as a dict and returns the tuple of values
+    for ``update_sql`` (an execute_values statement), a list of such tuples
+    when one email produces several rows, or None to skip the row.
+    ``count_sql`` optionally counts remaining rows for progress reporting.
+    ``compute_batch``, if given, replaces ``compute``: it receives the whole
+    batch of rows and returns the list of value tuples, or writes the batch
+    itself and returns an empty list (``update_sql`` may then be None). It
+    can also return (values, done_id) when only the rows up to id
+    ``done_id`` (None: none of them) are finished: the values are written,
+    the checkpoint stops at ``done_id`` and the run ends there, so a rerun
+    picks the unfinished rows up again.
+    ``skip_rollups`` turns the dashboard rollup triggers off for the batch
+    UPDATEs; set it only when they never change a rollup column (see
+    rollups.skip).
+    """
+    ensure_checkpoint_table()
+    if restart:
+        reset_checkpoint(name)
+    last_id, processed = load_checkpoint(name)
+    if last_id:
+        print(f"[{name}] Resuming after email id {last_id} ({processed} rows already processed)")
+
+    params = dict(params or {})
+    remaining = None
+    if count_sql:
+        with db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(count_sql, {**params, 'last_id': last_id})
+            remaining = cur.fetchone()[0]
+            cur.close()
+        print(f"[{name}] {remaining} rows to process")
+
+    limiter = RateLimiter(rate_limit)
+    pool_class = ProcessPoolExecutor if executor == 'process' else ThreadPoolExecutor
+    start = time.monotonic()
+    done = 0
+
+    with pool_class(max_workers=workers) as pool:
+        while True:
+            with db.connection() as conn:
+                cur = conn.cursor(cursor_factory=DictCursor)
+                cur.execute(select_sql, {**params, 'last_id': last_id, 'limit': batch_size})
+                rows = [dict(row) for row in cur.fetchall()]
+                cur.close()
+            if not rows:
+                break
+
+            finished = True
+            if compute_batch:
+                values = compute_batch(rows)
+                if isinstance(values, tuple):
+                    values, done_id = values
+                    finished = done_id == rows[-1]['id']
+                    rows = [row for row in rows if done_id is not None and row['id'] <= done_id]
+            else:
+                values = _compute_rows(name, pool, limiter, compute, rows)
+
+            if rows:
+                last_id = rows[-1]['id']
+            processed += len(rows)
+            done += len(rows)
+
+            with db.connection() as conn:
+                cur = conn.cursor()
+                if skip_rollups:
+                    rollups.skip(cur)
+                if values:
+                    execute_values(cur, update_sql, values, template=template, page_size=1000)
+                _save_checkpoint(cur, name, last_id, processed)
+                conn.commit()
+                cur.close()
+
+            elapsed = time.monotonic() - start
+            rate = done / elapsed if elapsed else 0.0
+            eta = max(remaining - done, 0) / rate if remaining is not None and rate else None
+            progress = f"{done}/{remaining}" if remaining is not None else str(done)
+            print(f"[{name}] {progress} rows, last id {last_id}, {rate:.1f} rows/s, ETA {_format_eta(eta)}")
+            if not finished:
+                print(f"[{name}] Stopped before unfinished rows after id {last_id}; run again to resume")
+                return done
+
+    # A finished run starts from the beginning next time
+    reset_checkpoint(name)
+
+    elapsed = time.monotonic() - start
+    print(f"[{name}] Completed {done} rows in {elapsed:.1f}s")
+    return done
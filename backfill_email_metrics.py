@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""One-off backfill of the stored summary metrics for existing emails.
+
+Fills subject_length, word_count, link_count and plain_text for rows ingested
+before those columns existed. HTML-only emails are parsed with BeautifulSoup,
+which is CPU bound, so this runs on worker processes by default.
+
+    python3 backfill_email_metrics.py --workers 4
+    python3 backfill_email_metrics.py --threads    # use threads instead
+"""
+import argparse
+import os
+
+from backfill import run_backfill
+from enrichment import compute_email_metrics
+
+WHERE = "word_count IS NULL AND NOT enrichment_pending AND id > %(last_id)s"
+
+SELECT_SQL = f'''
+    SELECT id, subject, body_text, body_html, urls
+    FROM emails
+    WHERE {WHERE}
+    ORDER BY id
+    LIMIT %(limit)s
+'''
+
+COUNT_SQL = f"SELECT COUNT(*) FROM emails WHERE {WHERE}"
+
+UPDATE_SQL = '''
+    UPDATE emails AS e
+    SET subject_length = v.subject_length,
+        word_count = v.word_count,
+        link_count = v.link_count,
+        plain_text = v.plain_text
+    FROM (VALUES %s) AS v(id, subject_length, word_count, link_count, plain_text)
+    WHERE e.id = v.id
+'''
+
+
+def email_metrics_row(email):
+    """Return the UPDATE values for one email."""
+    metrics = compute_email_metrics(email['subject'], email['body_text'], email['body_html'], email['urls'])
+    return (email['id'], metrics['subject_length'], metrics['word_count'],
+            metrics['link_count'], metrics['plain_text'])
+
+
+def backfill_email_metrics(workers=None, batch_size=200, executor='process', restart=False):
+    return run_backfill(
+        'email_metrics',
+        SELECT_SQL,
+        email_metrics_row,
+        UPDATE_SQL,
+        template='(%s, %s::int, %s::int, %s::int, %s::text)',
+        count_sql=COUNT_SQL,
+        batch_size=batch_size,
+        workers=workers or os.cpu_count() or 2,
+        executor=executor,
+        restart=restart,
+        skip_rollups=True,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Store summary metrics for emails that do not have them yet.')
+    parser.add_argument('--workers', type=int, default=None, help='worker count (default: CPU count)')
+    parser.add_argument('--batch-size', type=int, default=200, help='emails per fetch/UPDATE batch (default 200)')
+    parser.add_argument('--threads', action='store_true', help='use threads instead of processes')
+    parser.add_argument('--restart', action='store_true', help='ignore the saved checkpoint and start over')
+    args = parser.parse_args()
+
+    backfill_email_metrics(
+        workers=args.workers,
+        batch_size=args.batch_size,
+        executor='thread' if args.threads else 'process',
+        restart=args.restart,
+    )
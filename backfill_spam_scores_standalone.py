@@ -1,136 +1,112 @@
 #!/usr/bin/env python3
-import sqlite3
-import psycopg2
-from psycopg2.extras import DictCursor
-import os
-import sys
-import re
-from datetime import datetime
+"""Backfill spam scores for every email that does not have one yet.
 
-def get_db_connection():
-    database_url = os.environ.get('DATABASE_URL')
-    if database_url:
-        # Production database (Render)
-        conn = psycopg2.connect(database_url)
-    else:
-        # Local development - use SQLite
-        print("DATABASE_URL not set. Using local SQLite database for development.")
-        conn = sqlite3.connect('mailfoxes.db')
-    return conn
+Walks all unscored emails in id order, scores each batch with the configured
+scorer (see spam_scoring.py) and writes the scores back. The local scorer
+scores a batch as one feature matrix; the remote one makes concurrent calls,
+optionally rate limited. Progress is checkpointed, so an interrupted run
+picks up where it left off when started again.
 
-def get_spam_score(email_content):
-    """Get spam score using the spamcheck library."""
-    try:
-        import spamcheck
-        
-        # We only need the score, not the full report
-        result = spamcheck.check(email_content, report=False)
-        return result['score']
-    except ImportError:
-        print("spamcheck library not installed. Install with: pip install spamcheck")
-        return 0
-    except Exception as e:
-        print(f"Error checking spam score: {str(e)}")
-        return 0  # Default score if API call fails
+    python3 backfill_spam_scores_standalone.py --batch-size 1000
+    python3 backfill_spam_scores_standalone.py --scorer remote --workers 8 --rate-limit 20
+    python3 backfill_spam_scores_standalone.py --source 14 --source 22
+    python3 backfill_spam_scores_standalone.py --restart   # ignore the checkpoint
+"""
+import argparse
 
-def backfill_spam_scores_for_inbox(source_id, limit=10):
-    """Calculate and update spam scores for emails in a specific inbox."""
-    conn = get_db_connection()
-    
-    # Check if we're using SQLite
-    is_sqlite = 'sqlite3.Connection' in str(type(conn))
-    
-    if is_sqlite:
-        # SQLite uses ? as placeholder
-        placeholder = "?"
-        conn.row_factory = lambda cursor, row: {
-            col[0]: row[idx] for idx, col in enumerate(cursor.description)
-        }
-        cur = conn.cursor()
-    else:
-        # PostgreSQL uses %s as placeholder
-        placeholder = "%s"
-        cur = conn.cursor(cursor_factory=DictCursor)
-    
-    # Get the source name for logging
-    query = f"SELECT display_name FROM email_sources WHERE id = {placeholder}"
-    cur.execute(query, (source_id,))
-    source = cur.fetchone()
-    source_name = source['display_name'] if source else f"Source ID {source_id}"
-    
-    print(f"Processing up to {limit} emails for {source_name}...")
-    
-    # Get emails without spam scores (or with score = 0)
-    query = f"""
-        SELECT id, from_address, to_address, subject, body_text
-        FROM emails
-        WHERE source_id = {placeholder} AND (spam_score IS NULL OR spam_score = 0)
-        ORDER BY received_at DESC
-        LIMIT {placeholder}
+import spam_scoring
+from backfill import run_backfill
+
+# Emails without spam scores (or with score = 0)
+UNSCORED_FILTER = "(spam_score IS NULL OR spam_score = 0)"
+
+UPDATE_SQL = '''
+    UPDATE emails AS e
+    SET spam_score = v.spam_score,
+        spam_scorer = v.spam_scorer,
+        spam_pending = FALSE
+    FROM (VALUES %s) AS v(id, spam_score, spam_scorer)
+    WHERE e.id = v.id
+'''
+
+
+def batch_scorer(scorer):
+    """Return a function scoring a batch of rows as (id, spam_score, spam_scorer) tuples.
+
+    Copies already scored come from the memo. The engine is called without
+    a deadline, since a rate-limited remote scorer is slow by design. If
+    some emails could not be scored, the batch reports only the rows before
+    the first of them as done, so the checkpoint never passes an unscored
+    email and the run stops there (see run_backfill).
     """
-    cur.execute(query, (source_id, limit))
-    
-    emails = cur.fetchall()
-    print(f"Found {len(emails)} emails to process")
-    
-    for email in emails:
-        # Reconstruct raw email format for spam checking
-        raw_email = f"From: {email['from_address']}\nTo: {email['to_address']}\nSubject: {email['subject']}\n\n{email['body_text']}"
-        
-        # Calculate spam score
-        spam_score = get_spam_score(raw_email)
-        
-        # Update the database
-        query = f"""
-            UPDATE emails
-            SET spam_score = {placeholder}
-            WHERE id = {placeholder}
-        """
-        cur.execute(query, (spam_score, email['id']))
-        
-        print(f"Email ID {email['id']} - Score: {spam_score}")
-    
-    conn.commit()
-    cur.close()
-    conn.close()
-    
-    print(f"Completed processing for {source_name}")
+    def score_rows(emails):
+        scores = spam_scoring.score_batch(emails, scorer, timeout=None, breaker=None)
+        version = scorer.version()
+        values = [(email['id'], score, version) for email, score in zip(emails, scores) if score is not None]
+        if len(values) == len(emails):
+            return values
+        failed = scores.index(None)
+        print(f"{len(emails) - len(values)} emails could not be scored")
+        return values, emails[failed - 1]['id'] if failed else None
+    return score_rows
+
+
+def backfill_spam_scores(source_ids=None, scorer=None, workers=4, batch_size=200, rate_limit=None,
+                         restart=False):
+    """Calculate and store spam scores for all unscored emails (optionally per source)."""
+    engine = spam_scoring.resolve(scorer)
+    if isinstance(engine, spam_scoring.RemoteScorer):
+        engine = spam_scoring.RemoteScorer(workers=workers, rate_limit=rate_limit)
+    where = f"{UNSCORED_FILTER} AND id > %(last_id)s"
+    params = {}
+    name = 'spam_scores'
+    if source_ids:
+        where += " AND source_id = ANY(%(source_ids)s)"
+        params['source_ids'] = list(source_ids)
+        name += '_sources_' + '_'.join(str(sid) for sid in sorted(source_ids))
+
+    select_sql = f'''
+        SELECT id, from_address, to_address, subject, body_text, body_html
+        FROM emails
+        WHERE {where}
+        ORDER BY id
+        LIMIT %(limit)s
+    '''
+    count_sql = f"SELECT COUNT(*) FROM emails WHERE {where}"
+
+    return run_backfill(
+        name,
+        select_sql,
+        None,
+        UPDATE_SQL,
+        template='(%s, %s::float, %s::text)',
+        params=params,
+        count_sql=count_sql,
+        batch_size=batch_size,
+        workers=1,
+        restart=restart,
+        compute_batch=batch_scorer(engine),
+    )
 
-def backfill_all_inboxes(limit_per_inbox=10):
-    """Calculate and update spam scores for all inboxes."""
-    conn = get_db_connection()
-    
-    # Check if we're using SQLite
-    is_sqlite = 'sqlite3.Connection' in str(type(conn))
-    
-    if is_sqlite:
-        # SQLite setup
-        conn.row_factory = lambda cursor, row: {
-            col[0]: row[idx] for idx, col in enumerate(cursor.description)
-        }
-        cur = conn.cursor()
-    else:
-        # PostgreSQL setup
-        cur = conn.cursor(cursor_factory=DictCursor)
-    
-    # Get all sources
-    cur.execute("SELECT id, display_name FROM email_sources ORDER BY id")
-    sources = cur.fetchall()
-    
-    cur.close()
-    conn.close()
-    
-    for source in sources:
-        try:
-            backfill_spam_scores_for_inbox(source['id'], limit_per_inbox)
-        except Exception as e:
-            print(f"Error processing source {source['display_name']} (ID {source['id']}): {str(e)}")
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1 and sys.argv[1] == "--all":
-        # Process all inboxes if --all flag is provided
-        backfill_all_inboxes(10)
-    else:
-        # Process just Agora - MoneyMorning - Free (ID 14) by default
-        backfill_spam_scores_for_inbox(14, 10)
-        print("\nTo process all inboxes, run: python3 backfill_spam_scores_standalone.py --all")
+    parser = argparse.ArgumentParser(description='Backfill spam scores for unscored emails.')
+    parser.add_argument('--source', type=int, action='append', dest='source_ids',
+                        help='only score emails from this source id (repeatable)')
+    parser.add_argument('--scorer', choices=('auto', 'local', 'remote'), default=None,
+                        help='scoring engine (default: SPAM_SCORER, see spam_scoring.py)')
+    parser.add_argument('--workers', type=int, default=4, help='concurrent remote scoring calls (default 4)')
+    parser.add_argument('--batch-size', type=int, default=200, help='emails per fetch/UPDATE batch (default 200)')
+    parser.add_argument('--rate-limit', type=float, default=None,
+                        help='maximum remote scoring calls started per second (default unlimited)')
+    parser.add_argument('--restart', action='store_true', help='ignore the saved checkpoint and start over')
+    args = parser.parse_args()
+
+    backfill_spam_scores(
+        source_ids=args.source_ids,
+        scorer=args.scorer,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        rate_limit=args.rate_limit,
+        restart=args.restart,
+    )
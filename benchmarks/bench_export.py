@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""Export throughput: fetchall() into dicts vs the streaming server-side cursor.
+
+Builds a synthetic emails table in a temporary table (dropped when the
+connection closes), then exports it newest first the way get_recent_emails
+reads emails (one fetchall, a dict per row, JSON lines written at the end)
+and through export.py in each format. Reports rows/s, time to the first
+chunk and, with --memory, the peak Python memory of each run (tracemalloc
+slows every run down, so rates are measured without it).
+
+    python benchmarks/bench_export.py --rows 1000000   # needs DATABASE_URL
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from psycopg2.extras import DictCursor  # noqa: E402
+
+import db  # noqa: E402
+import export  # noqa: E402
+
+
+def build_table(conn, rows):
+    cur = conn.cursor()
+    cur.execute('''
+        CREATE TEMP TABLE bench_emails (
+            id SERIAL PRIMARY KEY,
+            source_id INTEGER,
+            from_address TEXT,
+            subject TEXT,
+            body_text TEXT,
+            received_at TIMESTAMP,
+            spam_score FLOAT,
+            word_count INTEGER,
+            link_count INTEGER
+        )
+    ''')
+    cur.execute('''
+        INSERT INTO bench_emails (source_id, from_address, subject, body_text, received_at,
+                                  spam_score, word_count, link_count)
+        SELECT 1 + (g % 30), 'news' || (g % 30) || '@example.com', 'Subject ' || g,
+               repeat('body text ', 50), NOW() - (g * INTERVAL '37 seconds'),
+               (g % 100) / 10.0, 100 + g % 900, g % 40
+        FROM generate_series(1, %s) g
+    ''', (rows,))
+    cur.execute('CREATE INDEX ON bench_emails (received_at DESC, id DESC)')
+    cur.execute('ANALYZE bench_emails')
+    # Exports end their transaction; the temporary table lives for the session
+    conn.commit()
+    cur.close()
+
+
+def fetchall_jsonl(conn, sql, params, columns):
+    cur = conn.cursor(cursor_factory=DictCursor)
+    cur.execute(sql, params)
+    emails = [dict(row) for row in cur.fetchall()]
+    cur.close()
+    conn.rollback()
+    yield ''.join(json.dumps(email, default=str) + '\n' for email in emails).encode()
+
+
+def streamed(fmt):
+    def run(conn, sql, params, columns):
+        return export.WRITERS[fmt](export.iter_batches(conn, sql, params), columns)
+    return run
+
+
+def measure(run, conn, sql, params, columns, memory):
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    first = None
+    size = 0
+    for chunk in run(conn, sql, params, columns):
+        if first is None:
+            first = time.perf_counter() - start
+        size += len(chunk)
+    elapsed = time.perf_counter() - start
+    peak = None
+    if memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return elapsed, first or elapsed, size, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000000, help='synthetic emails (default 1000000)')
+    parser.add_argument('--columns', help='column projection, as for /api/export (default the list columns)')
+    parser.add_argument('--memory', action='store_true', help='also report peak Python memory per run')
+    args = parser.parse_args()
+
+    columns = export.parse_columns(args.columns)
+    runs = {'fetchall + dicts (before)': fetchall_jsonl}
+    for fmt in export.WRITERS:
+        runs[f'server-side {fmt}'] = streamed(fmt)
+    if 'parquet' not in export.WRITERS:
+        print("pyarrow not installed; skipping Parquet")
+
+    with db.connection() as conn:
+        build_table(conn, args.rows)
+        print(f"Built {args.rows} synthetic emails; exporting {', '.join(columns)}")
+        sql, params = export.export_query(columns, table='bench_emails')
+
+        for label, run in runs.items():
+            elapsed, first, size, _ = measure(run, conn, sql, params, columns, memory=False)
+            line = (f"{label:26} {args.rows / elapsed:10,.0f} rows/s  first chunk {first * 1000:8.1f} ms"
+                    f"  {size / 1024 / 1024:8.1f} MB")
+            if args.memory:
+                _, _, _, peak = measure(run, conn, sql, params, columns, memory=True)
+                line += f"  peak {peak / 1024 / 1024:8.1f} MB"
+            print(line)
+
+        cur = conn.cursor()
+        cur.execute('DROP TABLE bench_emails')
+        conn.commit()
+        cur.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Compare what an inbox page reads from Postgres: e.* vs the list projection.
+
+Runs the newest-first /inbox page query against the real emails table both
+ways and reports, per page, the bytes sent by the server (the text form of
+every row, which is what psycopg2 receives) and the median fetch time.
+Nothing is written.
+
+    python benchmarks/bench_list_projection.py --pages 20   # needs DATABASE_URL
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+import pagination  # noqa: E402
+
+PER_PAGE = 25
+SORT_COLUMNS = ['e.received_at', 'e.id']
+FROM_SQL = 'FROM emails e LEFT JOIN email_sources s ON e.source_id = s.id WHERE TRUE'
+
+PROJECTIONS = {
+    'e.* (before)': 'e.*, s.name AS source_name, s.display_name',
+    'list columns (after)': f'{pagination.EMAIL_LIST_COLUMNS}, s.name AS source_name, s.display_name',
+}
+
+
+def page_query(columns, after):
+    return pagination.keyset_query(f'SELECT {columns} {FROM_SQL}', SORT_COLUMNS, PER_PAGE, after=after)
+
+
+def page_bytes(cur, columns, after):
+    sql, params, _ = page_query(columns, after)
+    cur.execute(f'SELECT COALESCE(SUM(octet_length(page::text)), 0) FROM ({sql}) page', params)
+    return cur.fetchone()[0]
+
+
+def fetch_page(cur, columns, after):
+    sql, params, reverse = page_query(columns, after)
+    cur.execute(sql, params)
+    rows, _ = pagination.page_rows(cur.fetchall(), PER_PAGE, reverse)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages', type=int, default=20, help='consecutive pages from the newest (default 20)')
+    parser.add_argument('--repeat', type=int, default=5, help='fetches per page, median reported (default 5)')
+    args = parser.parse_args()
+
+    with db.connection() as conn:
+        cur = conn.cursor()
+        # Page cursors, walked once with the narrow projection
+        cursors = [None]
+        for _ in range(args.pages - 1):
+            rows = fetch_page(cur, 'e.received_at, e.id', cursors[-1])
+            if len(rows) < PER_PAGE:
+                break
+            cursors.append([rows[-1][0], rows[-1][1]])
+
+        results = {}
+        for label, columns in PROJECTIONS.items():
+            sizes, times = [], []
+            for after in cursors:
+                sizes.append(page_bytes(cur, columns, after))
+                samples = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    fetch_page(cur, columns, after)
+                    samples.append(time.perf_counter() - start)
+                times.append(statistics.median(samples))
+            results[label] = (sizes, times)
+        conn.rollback()
+        cur.close()
+
+    print(f"{len(cursors)} pages of {PER_PAGE} emails, newest first")
+    for label, (sizes, times) in results.items():
+        print(f"{label:22} {statistics.mean(sizes) / 1024:10.1f} KB/page  max {max(sizes) / 1024:10.1f} KB"
+              f"  fetch median {statistics.median(times) * 1000:8.1f} ms")
+    before, after = (statistics.mean(sizes) for sizes, _ in results.values())
+    if before:
+        print(f"bytes per page reduced by {(1 - after / before) * 100:.1f}%")
+
+
+if __name__ == '__main__':
+    main()
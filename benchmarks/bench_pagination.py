@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""Compare /inbox page latency: LIMIT/OFFSET vs keyset cursors.
+
+Builds a synthetic emails table in a temporary table (dropped when the
+connection closes) with the same (received_at, id) index the app creates,
+then times page 1 and a deep page both ways, plus the exact COUNT(*) the
+page used to run against the bounded count / planner estimate.
+
+    python benchmarks/bench_pagination.py --rows 500000 --page 1000   # needs DATABASE_URL
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+import pagination  # noqa: E402
+
+PER_PAGE = 25
+SORT_COLUMNS = ['e.received_at', 'e.id']
+
+
+def build_table(cur, rows):
+    cur.execute('''
+        CREATE TEMP TABLE bench_emails (
+            id SERIAL PRIMARY KEY,
+            source_id INTEGER,
+            subject TEXT,
+            body_text TEXT,
+            received_at TIMESTAMP
+        )
+    ''')
+    cur.execute('''
+        INSERT INTO bench_emails (source_id, subject, body_text, received_at)
+        SELECT 1 + (g % 30), 'Subject ' || g, repeat('body text ', 50),
+               NOW() - (g * INTERVAL '37 seconds')
+        FROM generate_series(1, %s) g
+    ''', (rows,))
+    cur.execute('CREATE INDEX ON bench_emails (received_at DESC, id DESC)')
+    cur.execute('ANALYZE bench_emails')
+
+
+def offset_page(cur, page):
+    cur.execute(f'''
+        SELECT e.* FROM bench_emails e
+        ORDER BY e.received_at DESC, e.id DESC
+        LIMIT {PER_PAGE} OFFSET {(page - 1) * PER_PAGE}
+    ''')
+    return cur.fetchall()
+
+
+def keyset_page(cur, after):
+    sql, params, reverse = pagination.keyset_query(
+        'SELECT e.* FROM bench_emails e WHERE TRUE', SORT_COLUMNS, PER_PAGE, after=after)
+    cur.execute(sql, params)
+    rows, _ = pagination.page_rows(cur.fetchall(), PER_PAGE, reverse)
+    return rows
+
+
+def timed(function, repeat, *args):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        times.append(time.perf_counter() - start)
+    return result, statistics.median(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=200000, help='synthetic emails (default 200000)')
+    parser.add_argument('--page', type=int, default=1000, help='deep page to compare with page 1 (default 1000)')
+    parser.add_argument('--repeat', type=int, default=7, help='runs per query, median reported (default 7)')
+    args = parser.parse_args()
+
+    with db.connection() as conn:
+        cur = conn.cursor()
+        build_table(cur, args.rows)
+        print(f"Built {args.rows} synthetic emails")
+
+        # The cursor a user would hold after clicking Next page-1 times
+        cur.execute(f'''
+            SELECT received_at, id FROM bench_emails
+            ORDER BY received_at DESC, id DESC
+            LIMIT 1 OFFSET {(args.page - 1) * PER_PAGE - 1}
+        ''')
+        deep_cursor = pagination.decode_cursor(pagination.encode_cursor(cur.fetchone()), len(SORT_COLUMNS))
+
+        first, offset_1 = timed(offset_page, args.repeat, cur, 1)
+        deep, offset_n = timed(offset_page, args.repeat, cur, args.page)
+        keyset_first, keyset_1 = timed(keyset_page, args.repeat, cur, None)
+        keyset_deep, keyset_n = timed(keyset_page, args.repeat, cur, deep_cursor)
+
+        if keyset_first != first or keyset_deep != deep:
+            print("Keyset pages differ from OFFSET pages")
+            sys.exit(1)
+
+        print(f"OFFSET  page 1: {offset_1:7.2f} ms   page {args.page}: {offset_n:7.2f} ms")
+        print(f"keyset  page 1: {keyset_1:7.2f} ms   page {args.page}: {keyset_n:7.2f} ms")
+
+        (total,), exact_ms = timed(lambda: cur.execute('SELECT COUNT(*) FROM bench_emails e') or cur.fetchone(),
+                                   args.repeat)
+        (bounded, is_exact), bounded_ms = timed(pagination.bounded_count, args.repeat,
+                                                cur, 'FROM bench_emails e WHERE TRUE', [])
+        print(f"COUNT(*): {total} in {exact_ms:.2f} ms; bounded count/estimate: "
+              f"{'' if is_exact else '~'}{bounded} in {bounded_ms:.2f} ms")
+
+        conn.rollback()
+        cur.close()
+
+
+if __name__ == '__main__':
+    main()
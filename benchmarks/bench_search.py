@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""Compare inbox keyword search latency: ILIKE scans vs the full-text index.
+
+Builds a synthetic corpus in a temporary table (dropped when the connection
+closes), indexes it the way search.py indexes emails, and times the count
+and first-page queries /inbox runs for each keyword_type mode.
+
+    python benchmarks/bench_search.py --rows 200000   # needs DATABASE_URL
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+import search  # noqa: E402
+
+WORDS = ("market stocks nvidia earnings growth investors rally shares federal rates "
+         "opportunity breakthrough energy gold crypto dividend chips semiconductor "
+         "portfolio inflation recession bitcoin ethereum options futures treasury "
+         "housing oil uranium lithium battery robotics biotech pharma insider buyback "
+         "acquisition merger guidance revenue forecast upgrade downgrade valuation").split()
+
+QUERIES = [
+    ('nvidia', 'subject'),
+    ('nvidia', 'body'),
+    ('nvidia', 'all'),
+    ('uranium lithium', 'all'),
+    ('semiconductor', 'body'),
+    ('vid', 'subject'),
+]
+
+PER_PAGE = 25
+
+
+def build_corpus(cur, rows, body_words):
+    cur.execute('''
+        CREATE TEMP TABLE bench_emails (
+            id SERIAL PRIMARY KEY,
+            subject TEXT,
+            body_text TEXT,
+            plain_text TEXT,
+            received_at TIMESTAMP,
+            search_vector tsvector
+        )
+    ''')
+    cur.execute('''
+        INSERT INTO bench_emails (subject, body_text, received_at)
+        SELECT
+            array_to_string(ARRAY(
+                SELECT (%(words)s::text[])[1 + floor(random() * %(n)s)::int]
+                FROM generate_series(1, 8) w WHERE g > 0), ' '),
+            array_to_string(ARRAY(
+                SELECT (%(words)s::text[])[1 + floor(random() * %(n)s)::int]
+                FROM generate_series(1, %(body_words)s) w WHERE g > 0), ' '),
+            NOW() - random() * INTERVAL '365 days'
+        FROM generate_series(1, %(rows)s) g
+    ''', {'words': WORDS, 'n': len(WORDS), 'rows': rows, 'body_words': body_words})
+    cur.execute('''
+        UPDATE bench_emails
+        SET search_vector = emails_search_vector(subject, COALESCE(body_text, plain_text))
+    ''')
+    cur.execute('CREATE INDEX ON bench_emails USING GIN (search_vector)')
+    try:
+        cur.execute('SAVEPOINT trgm')
+        cur.execute('CREATE INDEX ON bench_emails USING GIN (subject gin_trgm_ops)')
+    except Exception as e:
+        cur.execute('ROLLBACK TO SAVEPOINT trgm')
+        print(f"No trigram index: {str(e)}")
+    cur.execute('ANALYZE bench_emails')
+
+
+def legacy_filter(keyword, keyword_type):
+    pattern = f'%{keyword}%'
+    if keyword_type == 'subject':
+        return 'e.subject ILIKE %s', [pattern]
+    if keyword_type == 'body':
+        return 'e.body_text ILIKE %s', [pattern]
+    return '(e.subject ILIKE %s OR e.body_text ILIKE %s)', [pattern, pattern]
+
+
+def run_legacy(cur, keyword, keyword_type):
+    where, params = legacy_filter(keyword, keyword_type)
+    cur.execute(f'SELECT COUNT(*) FROM bench_emails e WHERE {where}', params)
+    total = cur.fetchone()[0]
+    cur.execute(f'SELECT e.* FROM bench_emails e WHERE {where} ORDER BY e.received_at DESC LIMIT {PER_PAGE}', params)
+    cur.fetchall()
+    return total
+
+
+def run_search(cur, keyword, keyword_type):
+    where, params = search.keyword_filter(keyword, keyword_type)
+    cur.execute(f'SELECT COUNT(*) FROM bench_emails e WHERE {where}', params)
+    total = cur.fetchone()[0]
+    cur.execute(f'''
+        SELECT e.id FROM bench_emails e WHERE {where}
+        ORDER BY {search.rank_expression()} DESC, e.received_at DESC
+        LIMIT {PER_PAGE}
+    ''', params + [keyword])
+    ids = [row[0] for row in cur.fetchall()]
+    cur.execute(f'''
+        SELECT ts_headline('{search.CONFIG}', body_text, websearch_to_tsquery('{search.CONFIG}', %s), %s)
+        FROM bench_emails WHERE id = ANY(%s)
+    ''', (keyword, search._HEADLINE_OPTIONS, ids))
+    cur.fetchall()
+    return total
+
+
+def timed(function, cur, keyword, keyword_type, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        total = function(cur, keyword, keyword_type)
+        times.append(time.perf_counter() - start)
+    return total, statistics.median(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100000, help='synthetic emails (default 100000)')
+    parser.add_argument('--body-words', type=int, default=400, help='words per body (default 400)')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per query, median reported (default 5)')
+    args = parser.parse_args()
+
+    with db.connection() as conn:
+        cur = conn.cursor()
+        # The corpus uses the production emails_search_vector() function
+        search.install(cur)
+        conn.commit()
+
+        start = time.perf_counter()
+        build_corpus(cur, args.rows, args.body_words)
+        print(f"Built {args.rows} synthetic emails in {time.perf_counter() - start:.1f}s")
+
+        print(f"{'keyword':<18}{'mode':<9}{'ILIKE ms':>10}{'FTS ms':>10}{'ILIKE hits':>12}{'FTS hits':>10}")
+        for keyword, keyword_type in QUERIES:
+            legacy_total, legacy_ms = timed(run_legacy, cur, keyword, keyword_type, args.repeat)
+            search_total, search_ms = timed(run_search, cur, keyword, keyword_type, args.repeat)
+            print(f"{keyword:<18}{keyword_type:<9}{legacy_ms:>10.1f}{search_ms:>10.1f}"
+                  f"{legacy_total:>12}{search_total:>10}")
+
+        conn.rollback()
+        cur.close()
+
+
+if __name__ == '__main__':
+    main()
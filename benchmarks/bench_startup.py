@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Time web worker startup: importing app.py and serving the first request.
+
+Each run is a fresh interpreter, like a gunicorn worker boot. The same
+measurement runs against this tree and, for comparison, against another git
+revision exported to a temporary directory (the revision before schema setup
+moved out of the import path, by default):
+
+    python benchmarks/bench_startup.py --runs 5                 # needs DATABASE_URL
+    python benchmarks/bench_startup.py --runs 5 --ref HEAD~1
+
+Reported per tree: interpreter + import time, first-request latency (a page
+that needs no database), total wall time, and which heavy analytics modules
+were imported by startup alone.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ('numpy', 'matplotlib', 'wordcloud', 'openai', 'tiktoken', 'bs4', 'spamcheck')
+
+MEASURE = '''
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+response = app.app.test_client().get('/email-insights')
+served = time.perf_counter()
+print(json.dumps({
+    'import_seconds': imported - start,
+    'first_request_seconds': served - imported,
+    'status': response.status_code,
+    'heavy_modules': [name for name in %r if name in sys.modules],
+}))
+''' % (HEAVY_MODULES,)
+
+
+def measure(tree, runs):
+    results = []
+    for _ in range(runs):
+        completed = subprocess.run(
+            [sys.executable, '-c', MEASURE], cwd=tree, capture_output=True, text=True,
+            env=dict(os.environ, PYTHONDONTWRITEBYTECODE='1'),
+        )
+        if completed.returncode != 0:
+            raise SystemExit(f"Startup failed in {tree}:\n{completed.stderr}")
+        results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+    return results
+
+
+def export(ref, directory):
+    archive = subprocess.run(['git', 'archive', ref], cwd=ROOT, capture_output=True, check=True).stdout
+    subprocess.run(['tar', '-x', '-C', directory], input=archive, check=True)
+
+
+def report(label, results):
+    imports = [r['import_seconds'] for r in results]
+    requests = [r['first_request_seconds'] for r in results]
+    print(f"{label}:")
+    print(f"  import app      median {statistics.median(imports) * 1000:8.1f} ms  max {max(imports) * 1000:8.1f} ms")
+    print(f"  first request   median {statistics.median(requests) * 1000:8.1f} ms  max {max(requests) * 1000:8.1f} ms")
+    print(f"  heavy modules loaded at startup: {', '.join(results[-1]['heavy_modules']) or 'none'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per tree (default 5)')
+    parser.add_argument('--ref', default='HEAD~1', help='git revision to compare against (default HEAD~1)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as before_tree:
+        export(args.ref, before_tree)
+        report(f"before ({args.ref})", measure(before_tree, args.runs))
+    report("after (working tree)", measure(ROOT, args.runs))
+
+
+if __name__ == '__main__':
+    main()
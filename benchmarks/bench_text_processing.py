@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Check and time text_processing against the original implementation.
+
+Every text in the corpus is run through both the compiled pipeline and the
+reference copy of the original functions; any difference in output is
+reported and makes the script exit non-zero.
+
+    python benchmarks/bench_text_processing.py                 # synthetic corpus
+    python benchmarks/bench_text_processing.py --from-db 5000  # latest emails (needs DATABASE_URL)
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import text_processing  # noqa: E402
+from legacy_text_processing import (  # noqa: E402
+    legacy_process_text_for_word_cloud,
+    legacy_remove_footer_content,
+)
+
+WORDS = ("market stocks nvidia earnings growth investors rally shares fed rates "
+         "opportunity breakthrough ai energy gold crypto dividend tech chips "
+         "the and of to in is for with you your this that it's don't").split()
+FRAGMENTS = list(text_processing.FOOTER_INDICATORS) + [
+    pattern for pattern in text_processing.SEPARATOR_PATTERNS
+] + ["Unsubscribe", "COPYRIGHT", "Best Regards", "(NASDAQ: NVDA)", "İstanbul", "“quoted”", "\n\n", "!!!", "s&p"]
+
+
+def synthetic_corpus(size, seed=42):
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        parts = []
+        for _ in range(rng.randint(20, 1500)):
+            parts.append(rng.choice(WORDS))
+            if rng.random() < 0.002:
+                parts.append(rng.choice(FRAGMENTS))
+            if rng.random() < 0.05:
+                parts.append(rng.choice('.,;:!?()[]{}"\''))
+        # Most newsletters end with a footer
+        if rng.random() < 0.8:
+            parts.extend(rng.sample(FRAGMENTS, 3))
+        corpus.append(' '.join(parts))
+    corpus.extend(['', 'short', 'Thanks!', '\n---\nfooter', 'a\n\n===========\nb'])
+    return corpus
+
+
+def db_corpus(limit):
+    import db
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT subject, body_text FROM emails ORDER BY id DESC LIMIT %s", (limit,))
+        corpus = []
+        for subject, body_text in cur.fetchall():
+            corpus.append(subject or '')
+            corpus.append(body_text or '')
+        cur.close()
+    return corpus
+
+
+def timed(function, corpus):
+    start = time.perf_counter()
+    results = [function(text) for text in corpus]
+    return results, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=2000, help='synthetic corpus size (default 2000)')
+    parser.add_argument('--from-db', type=int, default=None, metavar='N', help='use the latest N emails instead')
+    parser.add_argument('--workers', type=int, default=4, help='processes for the batch API timing (default 4)')
+    args = parser.parse_args()
+
+    corpus = db_corpus(args.from_db) if args.from_db else synthetic_corpus(args.size)
+    total_chars = sum(len(text) for text in corpus)
+    print(f"Corpus: {len(corpus)} texts, {total_chars / 1e6:.1f}M characters")
+
+    failures = 0
+    for name, legacy, current in [
+        ('remove_footer_content', legacy_remove_footer_content, text_processing.remove_footer_content),
+        ('process_text_for_word_cloud', legacy_process_text_for_word_cloud, text_processing.process_text_for_word_cloud),
+    ]:
+        expected, legacy_time = timed(legacy, corpus)
+        actual, current_time = timed(current, corpus)
+        mismatches = [i for i, (a, b) in enumerate(zip(expected, actual)) if a != b]
+        failures += len(mismatches)
+        print(f"{name}: legacy {legacy_time:.3f}s, compiled {current_time:.3f}s "
+              f"({legacy_time / current_time:.1f}x), {len(mismatches)} mismatches")
+        for i in mismatches[:5]:
+            print(f"  text {i}: {corpus[i][:80]!r}")
+
+    single = [text_processing.process_text_for_word_cloud(text) for text in corpus]
+    # The first call starts the worker pool; time the second, which reuses it
+    text_processing.process_texts_for_word_cloud(corpus, workers=args.workers)
+    start = time.perf_counter()
+    batch = text_processing.process_texts_for_word_cloud(corpus, workers=args.workers)
+    batch_time = time.perf_counter() - start
+    if batch != single:
+        print("process_texts_for_word_cloud: batch output differs from single-text output")
+        failures += 1
+    print(f"process_texts_for_word_cloud ({args.workers} workers, warm pool): {batch_time:.3f}s")
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
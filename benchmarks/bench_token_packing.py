@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Time prompt packing for a window of emails: per-request tokenizing vs stored counts.
+
+Compares, on a synthetic window (no database needed):
+
+- legacy: load the encoding, tokenize each email's JSON one by one, then
+  tokenize the assembled prompt again, as the analysis functions used to
+- cold: no stored counts yet; one batched encode, then pack
+- warm: counts already stored on the rows; pack without encoding
+
+    python benchmarks/bench_token_packing.py --emails 5000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import llm_analysis  # noqa: E402
+import tokenizer  # noqa: E402
+
+WORDS = ("market stocks nvidia earnings growth investors rally shares fed rates opportunity "
+         "breakthrough ai energy gold crypto dividend tech chips the and of to in is for with "
+         "you your this that buy now limited offer exclusive report").split()
+
+
+def synthetic_window(size, seed=7):
+    rng = random.Random(seed)
+    now = datetime.now()
+    return [{
+        'from_address': f"editor{rng.randint(1, 40)}@newsletter{rng.randint(1, 30)}.com",
+        'subject': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(4, 12))).title(),
+        'received_at': now - timedelta(minutes=i * 7),
+        'display_name': f"Source {rng.randint(1, 30)} - Free",
+        'body_text': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(150, 1500))),
+    } for i in range(size)]
+
+
+def legacy_pack(emails, budget):
+    import tiktoken
+    try:
+        encoding = tiktoken.encoding_for_model("gpt-4o")
+    except Exception:
+        encoding = tiktoken.get_encoding("cl100k_base")
+    chunks, current, current_tokens = [], [], 0
+    for email in sorted(emails, key=lambda x: x['received_at'], reverse=True):
+        entry = llm_analysis.email_entry(email)
+        entry_tokens = len(encoding.encode(json.dumps(entry)))
+        if current and current_tokens + entry_tokens > budget:
+            chunks.append(current)
+            current, current_tokens = [], 0
+        current.append(entry)
+        current_tokens += entry_tokens
+    if current:
+        chunks.append(current)
+    # ...and every assembled prompt was encoded again to check the limit
+    for chunk in chunks:
+        len(encoding.encode(json.dumps(chunk, indent=2)))
+    return chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--emails', type=int, default=5000, help='emails in the window (default 5000)')
+    parser.add_argument('--budget', type=int, default=20000, help='tokens per chunk (default 20000)')
+    args = parser.parse_args()
+
+    emails = synthetic_window(args.emails)
+
+    start = time.perf_counter()
+    legacy_chunks = legacy_pack(emails, args.budget)
+    legacy_seconds = time.perf_counter() - start
+
+    tokenizer.get_encoding()  # loaded once per worker, not per request
+    start = time.perf_counter()
+    cold_chunks = llm_analysis.chunk_emails(emails, args.budget)
+    cold_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    warm_chunks = llm_analysis.chunk_emails(emails, args.budget)
+    warm_seconds = time.perf_counter() - start
+
+    print(f"{args.emails} emails, {args.budget}-token chunks")
+    print(f"legacy (per-email encode + prompt re-encode): {legacy_seconds:.3f}s, {len(legacy_chunks)} chunks")
+    print(f"cold   (one batched encode, then pack):       {cold_seconds:.3f}s, {len(cold_chunks)} chunks")
+    print(f"warm   (stored counts, no encoding):          {warm_seconds:.3f}s, {len(warm_chunks)} chunks")
+
+    # Packing from stored counts must respect the budget when re-measured
+    worst = max(tokenizer.count(json.dumps(chunk)) for chunk in warm_chunks)
+    print(f"largest packed chunk re-measured: {worst} tokens")
+
+
+if __name__ == '__main__':
+    main()
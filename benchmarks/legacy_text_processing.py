@@ -0,0 +1,263 @@
+"""Reference copy of the original per-call text cleanup, kept for
+equivalence checks in bench_text_processing.py. Do not use in the app."""
+
+
+def legacy_remove_footer_content(text):
+    """Remove footer content from email text."""
+    if not text:
+        return ""
+    
+    # Common footer indicators
+    footer_indicators = [
+        "unsubscribe",
+        "privacy policy",
+        "terms of service",
+        "terms of use",
+        "copyright",
+        "all rights reserved",
+        "confidentiality notice",
+        "disclaimer",
+        "legal notice",
+        "to stop receiving",
+        "opt out",
+        "email preferences",
+        "manage subscriptions",
+        "view in browser",
+        "view as webpage",
+        "forward this email",
+        "sent to",
+        "you are receiving this email because",
+        "you received this email because",
+        "if you no longer wish",
+        "if you would like to unsubscribe",
+        "to unsubscribe",
+        "to opt-out",
+        "click here to unsubscribe",
+        "best regards",
+        "kind regards",
+        "sincerely",
+        "regards",
+        "thank you",
+        "thanks",
+        "this email was sent by",
+        "this message was sent to",
+        "this email contains",
+        "please do not reply",
+        "please consider",
+        "please note",
+        "please contact",
+        "for more information",
+        "for questions",
+        "for assistance",
+        "for help",
+        "for support",
+        "for customer service",
+        "for customer support",
+        "for technical support",
+        "for technical assistance",
+        "for further information",
+        "for further assistance",
+        "for further help",
+        "for further support",
+        "for further questions",
+        "for further inquiries",
+        "for further details",
+        "for further assistance",
+        "for further help",
+        "for further support",
+        "for further questions",
+        "for further inquiries",
+        "for further details"
+    ]
+    
+    # Check for common footer indicators and truncate text
+    text_lower = text.lower()
+    for indicator in footer_indicators:
+        index = text_lower.find(indicator)
+        if index != -1:
+            # Found a footer indicator, truncate the text
+            return text[:index]
+    
+    # Look for common footer separator patterns
+    separator_patterns = [
+        "\n---",
+        "\n___",
+        "\n***",
+        "\n===",
+        "\n--\n",
+        "\n__\n",
+        "\n**\n",
+        "\n==\n",
+        "\n\n---",
+        "\n\n___",
+        "\n\n***",
+        "\n\n===",
+        "\n\n--\n",
+        "\n\n__\n",
+        "\n\n**\n",
+        "\n\n==\n",
+        "\n\n-----------",
+        "\n\n___________",
+        "\n\n***********",
+        "\n\n===========",
+        "\n-----------",
+        "\n___________",
+        "\n***********",
+        "\n===========",
+    ]
+    
+    for pattern in separator_patterns:
+        index = text.find(pattern)
+        if index != -1:
+            # Found a separator pattern, truncate the text
+            return text[:index]
+    
+    # If no footer indicators or separators found, return the original text
+    return text
+
+
+def legacy_process_text_for_word_cloud(text):
+    """Process text to extract words for word cloud, removing common stop words and footer content."""
+    if not text:
+        return []
+    
+    # Remove footer content first
+    text = legacy_remove_footer_content(text)
+    
+    # Convert to lowercase
+    text = text.lower()
+    
+    # Remove common punctuation
+    for char in '.,;:!?()[]{}"\'':
+        text = text.replace(char, ' ')
+    
+    # Split into words
+    words = text.split()
+    
+    # Common English stop words to exclude
+    stop_words = {
+        # Basic English stop words
+        'a', 'an', 'the', 'and', 'or', 'but', 'if', 'because', 'as', 'what',
+        'which', 'this', 'that', 'these', 'those', 'then', 'just', 'so', 'than',
+        'such', 'both', 'through', 'about', 'for', 'is', 'of', 'while', 'during',
+        'to', 'from', 'in', 'on', 'at', 'by', 'with', 'about', 'against', 'between',
+        'into', 'through', 'during', 'before', 'after', 'above', 'below', 'up',
+        'down', 'out', 'off', 'over', 'under', 'again', 'further', 'then', 'once',
+        'here', 'there', 'when', 'where', 'why', 'how', 'all', 'any', 'both',
+        'each', 'few', 'more', 'most', 'other', 'some', 'such', 'no', 'nor',
+        'not', 'only', 'own', 'same', 'so', 'than', 'too', 'very', 's', 't',
+        'can', 'will', 'don', 'should', 'now', 'i', 'me', 'my', 'myself', 'we',
+        'our', 'ours', 'ourselves', 'you', 'your', 'yours', 'yourself',
+        'yourselves', 'he', 'him', 'his', 'himself', 'she', 'her', 'hers',
+        'herself', 'it', 'its', 'itself', 'they', 'them', 'their', 'theirs',
+        'themselves', 'am', 'is', 'are', 'was', 'were', 'be', 'been', 'being',
+        'have', 'has', 'had', 'having', 'do', 'does', 'did', 'doing', 'would',
+        'should', 'could', 'ought', 'i\'m', 'you\'re', 'he\'s', 'she\'s', 'it\'s',
+        'we\'re', 'they\'re', 'i\'ve', 'you\'ve', 'we\'ve', 'they\'ve', 'i\'d',
+        'you\'d', 'he\'d', 'she\'d', 'we\'d', 'they\'d', 'i\'ll', 'you\'ll',
+        'he\'ll', 'she\'ll', 'we\'ll', 'they\'ll', 'isn\'t', 'aren\'t', 'wasn\'t',
+        'weren\'t', 'hasn\'t', 'haven\'t', 'hadn\'t', 'doesn\'t', 'don\'t',
+        'didn\'t', 'won\'t', 'wouldn\'t', 'shan\'t', 'shouldn\'t', 'can\'t',
+        'cannot', 'couldn\'t', 'mustn\'t', 'let\'s', 'that\'s', 'who\'s', 'what\'s',
+        'here\'s', 'there\'s', 'when\'s', 'where\'s', 'why\'s', 'how\'s',
+        
+        # Email-specific terms
+        'email', 'emails', 'http', 'https', 'www', 'com', 'html', 'subject', 'body', 'text',
+        'get', 'one', 'also', 'new', 'may', 'like', 'use', 'click', 'view', 'read',
+        'publisher', 'publish', 'publishing', 'published', 'publication', 'publications',
+        'newsletter', 'newsletters', 'news', 'letter', 'letters', 'mail', 'mailing',
+        'inbox', 'outbox', 'folder', 'folders', 'attachment', 'attachments',
+        'send', 'sender', 'sending', 'sent', 'receive', 'receiver', 'receiving', 'received',
+        'forward', 'forwarding', 'forwarded', 'reply', 'replying', 'replied',
+        'message', 'messages', 'notification', 'notifications', 'alert', 'alerts',
+        'update', 'updates', 'updating', 'updated', 'version', 'versions',
+        
+        # Footer-related terms
+        'privacy', 'policy', 'policies', 'unsubscribe', 'copyright', 'rights', 'reserved',
+        'terms', 'conditions', 'service', 'services', 'contact', 'contacts', 'preferences', 
+        'update', 'updates', 'subscribe', 'subscription', 'subscriptions', 'manage', 
+        'management', 'settings', 'account', 'accounts', 'profile', 'profiles',
+        'address', 'addresses', 'please', 'thank', 'thanks', 'regards', 'sincerely', 'best',
+        'forward', 'sent', 'received', 'message', 'confidential', 'disclaimer',
+        'legal', 'notice', 'company', 'corporation', 'inc', 'llc', 'ltd', 'incorporated',
+        'limited', 'corp', 'group', 'holdings', 'international', 'enterprises',
+        'signature', 'signatures', 'footer', 'footers', 'header', 'headers',
+        
+        # Marketing terms
+        'offer', 'offers', 'offering', 'offered', 'special', 'specials', 'deal', 'deals',
+        'limited', 'time', 'exclusive', 'exclusively', 'free', 'discount', 'discounts',
+        'save', 'saving', 'savings', 'sale', 'sales', 'promotion', 'promotions', 
+        'promotional', 'marketing', 'advertisement', 'advertisements', 'advertise', 
+        'advertising', 'sponsor', 'sponsors', 'sponsored', 'sponsorship',
+        'newsletter', 'subscription', 'subscribe', 'unsubscribe', 'opt', 'opt-in', 'opt-out',
+        'register', 'registration', 'sign', 'signup', 'join', 'member', 'membership',
+        'trial', 'trials', 'demo', 'demos', 'sample', 'samples', 'preview', 'previews',
+        'bonus', 'bonuses', 'gift', 'gifts', 'reward', 'rewards', 'prize', 'prizes',
+        'win', 'winner', 'winners', 'winning', 'contest', 'contests', 'competition',
+        'promo', 'promos', 'promotion', 'promotions', 'coupon', 'coupons', 'code', 'codes',
+        'deal', 'deals', 'bargain', 'bargains', 'cheap', 'discount', 'discounts',
+        'sale', 'sales', 'clearance', 'liquidation', 'closeout', 'blowout',
+        
+        # Financial/Investment terms
+        'stock', 'stocks', 'market', 'markets', 'invest', 'investment', 'investments', 
+        'investor', 'investors', 'trading', 'trader', 'traders', 'trade', 'trades',
+        'buy', 'buying', 'bought', 'sell', 'selling', 'sold', 'price', 'prices', 'pricing',
+        'value', 'values', 'valuation', 'valuations', 'growth', 'return', 'returns', 
+        'profit', 'profits', 'profitable', 'loss', 'losses', 'portfolio', 'portfolios',
+        'fund', 'funds', 'funding', 'asset', 'assets', 'wealth', 'wealthy', 'financial', 
+        'finance', 'finances', 'financing', 'money', 'monetary', 'cash', 'dollar', 'dollars', 
+        'cent', 'cents', 'share', 'shares', 'shareholder', 'shareholders',
+        'dividend', 'dividends', 'yield', 'yields', 'bond', 'bonds', 'equity', 'equities',
+        'security', 'securities', 'exchange', 'exchanges', 'index', 'indices',
+        'nasdaq', 'nyse', 'dow', 'jones', 'sp500', 's&p', 'etf', 'etfs', 'mutual',
+        'hedge', 'commodity', 'commodities', 'forex', 'currency', 'currencies',
+        'crypto', 'cryptocurrency', 'cryptocurrencies', 'bitcoin', 'ethereum',
+        'bull', 'bullish', 'bear', 'bearish', 'rally', 'correction', 'crash',
+        'recession', 'inflation', 'deflation', 'economy', 'economic', 'economics',
+        
+        # Common web/tech terms
+        'browser', 'browsers', 'website', 'websites', 'site', 'sites', 'page', 'pages',
+        'link', 'links', 'click', 'clicks', 'clicking', 'clicked', 'download', 'downloads',
+        'upload', 'uploads', 'file', 'files', 'folder', 'folders', 'image', 'images',
+        'video', 'videos', 'audio', 'media', 'content', 'contents', 'data', 'database',
+        'information', 'info', 'user', 'users', 'username', 'usernames', 'password',
+        'passwords', 'login', 'logout', 'sign', 'signin', 'signup', 'access', 'security',
+        'secure', 'url', 'urls', 'domain', 'domains', 'host', 'hosting', 'server', 'servers',
+        'cloud', 'app', 'apps', 'application', 'applications', 'software', 'program',
+        'programs', 'code', 'coding', 'developer', 'developers', 'development',
+        'api', 'apis', 'interface', 'interfaces', 'platform', 'platforms',
+        'online', 'offline', 'internet', 'web', 'network', 'networks', 'connection',
+        'device', 'devices', 'mobile', 'desktop', 'laptop', 'tablet', 'phone',
+        'android', 'ios', 'windows', 'mac', 'linux', 'system', 'systems',
+        
+        # Time-related terms
+        'today', 'tomorrow', 'yesterday', 'week', 'weekly', 'month', 'monthly', 'year',
+        'yearly', 'day', 'daily', 'morning', 'afternoon', 'evening', 'night', 'date',
+        'time', 'hour', 'hourly', 'minute', 'second', 'monday', 'tuesday', 'wednesday',
+        'thursday', 'friday', 'saturday', 'sunday', 'weekend', 'weekday',
+        'january', 'february', 'march', 'april', 'may', 'june', 'july', 'august',
+        'september', 'october', 'november', 'december', 'quarter', 'quarterly',
+        'annual', 'annually', 'biannual', 'biannually', 'semiannual', 'semiannually',
+        'fiscal', 'calendar', 'schedule', 'scheduled', 'scheduling', 'appointment',
+        'deadline', 'due', 'soon', 'later', 'earlier', 'early', 'late',
+        
+        # Additional utility words
+        'able', 'almost', 'already', 'always', 'among', 'anyone', 'anything',
+        'anywhere', 'become', 'comes', 'either', 'else', 'every', 'everyone',
+        'everything', 'everywhere', 'first', 'going', 'gone', 'got', 'gotten',
+        'happens', 'hence', 'however', 'indeed', 'instead', 'keep', 'keeps',
+        'kept', 'know', 'known', 'knows', 'less', 'made', 'make', 'makes',
+        'making', 'many', 'might', 'much', 'must', 'need', 'needs', 'never',
+        'nothing', 'often', 'part', 'put', 'puts', 'quite', 'rather', 'really',
+        'said', 'saw', 'say', 'says', 'see', 'seeing', 'seen', 'sees', 'several',
+        'shall', 'since', 'take', 'taken', 'takes', 'taking', 'tell', 'tells',
+        'thing', 'things', 'think', 'thinks', 'though', 'thought', 'thoughts',
+        'thus', 'told', 'unless', 'until', 'using', 'various', 'want', 'wanted',
+        'wanting', 'wants', 'way', 'ways', 'well', 'went', 'whatever', 'whether',
+        'without', 'yes', 'yet', 'back', 'even', 'ever', 'still'
+    }
+    
+    # Filter out stop words and words less than 3 characters
+    filtered_words = [word for word in words if word not in stop_words and len(word) > 2]
+    
+    return filtered_words
@@ -0,0 +1,323 @@
+"""Near-duplicate detection for newsletters delivered to several inboxes.
+
+Consolidated inboxes (Marketbeat 2/22, Tradesmith 15/17/18, Paradigm
+10/11/20/21/32, ...) receive the same newsletter, which differs only in
+the recipient address, tracking links and footer. Each email gets a 64-bit
+SimHash of its subject and footer-stripped text (word 3-shingles), and
+copies within DEDUPE_MAX_DISTANCE bits of an earlier email from the same
+source family (a source and its consolidated children) within
+DEDUPE_WINDOW_HOURS are linked to it through emails.canonical_id.
+canonical_id is NULL for originals.
+
+Lookups use an LSH index: the fingerprint is split into BANDS 16-bit bands,
+each indexed, and two fingerprints within BANDS - 1 bits of each other
+share at least one band exactly. Only those candidates are compared.
+
+Two copies arriving at once must not both become originals, so the
+transaction that matches and stores a fingerprint first takes lock(): a
+transaction-level advisory lock per (family, band, band value). Only emails
+sharing a band in the same family, i.e. probable copies, wait for each
+other; a copy's webhook waits until the original's transaction commits.
+
+/inbox?duplicates=hide and the LLM analyses use canonical_id to skip
+copies. Emails stored before fingerprints existed, and the savings on the
+stored corpus:
+
+    python dedupe.py --backfill
+    python dedupe.py --report [--days 30]
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+
+from psycopg2.extras import DictCursor, execute_values
+
+import db
+import rollups
+import source_catalog
+from backfill import run_backfill
+from text_processing import remove_footer_content
+
+DEDUPE_MAX_DISTANCE = int(os.environ.get('DEDUPE_MAX_DISTANCE', 3))
+DEDUPE_WINDOW_HOURS = int(os.environ.get('DEDUPE_WINDOW_HOURS', 72))
+
+BANDS = 4
+BAND_BITS = 64 // BANDS
+SHINGLE_SIZE = 3
+# Texts with fewer shingles than this are too short to fingerprint reliably
+MIN_SHINGLES = 8
+
+SCHEMA_SQL = f'''
+    ALTER TABLE emails ADD COLUMN IF NOT EXISTS canonical_id INTEGER;
+
+    CREATE TABLE IF NOT EXISTS email_fingerprints (
+        email_id INTEGER PRIMARY KEY REFERENCES emails(id) ON DELETE CASCADE,
+        family_id INTEGER,
+        received_at TIMESTAMP,
+        simhash BIGINT NOT NULL,
+        canonical_id INTEGER,
+        {', '.join(f'band{band} INTEGER NOT NULL' for band in range(BANDS))}
+    );
+
+    {' '.join(f'CREATE INDEX IF NOT EXISTS idx_email_fingerprints_band{band} ON email_fingerprints(band{band});'
+              for band in range(BANDS))}
+'''
+
+_WORD = re.compile(r"[a-z0-9][a-z0-9'$%.]*")
+_TAG = re.compile(r'<[^>]+>')
+
+
+def install(cur):
+    """Add the canonical_id column and the email_fingerprints table."""
+    cur.execute(SCHEMA_SQL)
+
+
+def family_id(source_id, conn=None):
+    """The top of ``source_id``'s consolidation tree (see source_catalog for ``conn``)."""
+    return source_catalog.root_id(source_id, conn) if source_id is not None else None
+
+
+def fingerprint_text(email):
+    """The text an email is fingerprinted on: subject plus body without the footer."""
+    text = email.get('body_text') or email.get('plain_text') or _TAG.sub(' ', email.get('body_html') or '')
+    return f"{email.get('subject') or ''}\n{remove_footer_content(text)}"
+
+
+def simhash(text):
+    """64-bit SimHash of the text's word shingles (unsigned), or None if the text is too short."""
+    import numpy as np
+
+    words = _WORD.findall(text.lower())
+    shingles = {' '.join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+    if len(shingles) < MIN_SHINGLES:
+        return None
+    hashes = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), 'little') for shingle in shingles),
+        dtype=np.uint64, count=len(shingles))
+    bits = (hashes[:, None] >> np.arange(64, dtype=np.uint64)) & np.uint64(1)
+    # A bit is set where most shingles have it set
+    votes = bits.sum(axis=0) * 2 > len(shingles)
+    return sum(1 << int(bit) for bit in np.flatnonzero(votes))
+
+
+def bands(value):
+    return [(value >> (band * BAND_BITS)) & ((1 << BAND_BITS) - 1) for band in range(BANDS)]
+
+
+def to_signed(value):
+    """Store an unsigned 64-bit fingerprint in a BIGINT."""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def distance(a, b):
+    return bin((a ^ b) & ((1 << 64) - 1)).count('1')
+
+
+def _match(value, candidates):
+    """The canonical id for the closest candidate within DEDUPE_MAX_DISTANCE, or None.
+
+    ``candidates`` are (email_id, simhash, canonical_id); ties go to the earliest email.
+    """
+    best = None
+    for email_id, other, canonical_id in candidates:
+        bits = distance(value, other)
+        if bits <= DEDUPE_MAX_DISTANCE and (best is None or (bits, email_id) < best[:2]):
+            best = (bits, email_id, canonical_id or email_id)
+    return best[2] if best else None
+
+
+def _lock_key(family, band, value):
+    digest = hashlib.blake2b(f"dedupe:{family}:{band}:{value}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def lock(cur, fingerprints):
+    """Lock the bands of every (family, simhash) in ``fingerprints`` until the transaction ends.
+
+    Take all of a transaction's locks in one call: keys are acquired in
+    sorted order, so concurrent transactions cannot deadlock on them.
+    """
+    keys = sorted({_lock_key(family, band, band_value)
+                   for family, value in fingerprints if value is not None
+                   for band, band_value in enumerate(bands(value))})
+    for key in keys:
+        cur.execute('SELECT pg_advisory_xact_lock(%s)', (key,))
+
+
+def find_canonical(cur, value, family, received_at):
+    """The id of the earlier email ``value`` duplicates, or None.
+
+    Call lock() for the fingerprint first, in the transaction that then
+    stores it with store_fingerprint().
+    """
+    if value is None:
+        return None
+    band_sql = ' OR '.join(f'band{band} = %s' for band in range(BANDS))
+    cur.execute(f'''
+        SELECT email_id, simhash, canonical_id
+        FROM email_fingerprints
+        WHERE ({band_sql})
+          AND family_id IS NOT DISTINCT FROM %s
+          AND received_at BETWEEN %s - %s * INTERVAL '1 hour' AND %s
+    ''', bands(value) + [family, received_at, DEDUPE_WINDOW_HOURS, received_at])
+    return _match(value, [(row[0], row[1] % (1 << 64), row[2]) for row in cur.fetchall()])
+
+
+def store_fingerprint(cur, email_id, family, received_at, value, canonical_id):
+    if value is None:
+        return
+    cur.execute(f'''
+        INSERT INTO email_fingerprints
+            (email_id, family_id, received_at, simhash, canonical_id, {', '.join(f'band{band}' for band in range(BANDS))})
+        VALUES (%s, %s, %s, %s, %s, {', '.join(['%s'] * BANDS)})
+        ON CONFLICT (email_id) DO NOTHING
+    ''', [email_id, family, received_at, to_signed(value), canonical_id] + bands(value))
+
+
+def link_email(cur, email_id, source_id, received_at, value):
+    """Store a stored email's fingerprint and return its canonical id (None if it is an original).
+
+    The caller has taken lock() for the fingerprint in this transaction.
+    """
+    family = family_id(source_id, cur.connection)
+    canonical_id = find_canonical(cur, value, family, received_at)
+    store_fingerprint(cur, email_id, family, received_at, value, canonical_id)
+    return canonical_id
+
+
+def collapse(emails):
+    """Keep one email per canonical copy, the earliest. Returns (kept, dropped count).
+
+    Copies whose original is not in ``emails`` still collapse into one.
+    """
+    keep = {}
+    for email in sorted(emails, key=lambda email: (email['received_at'], email['id'])):
+        keep.setdefault(email.get('canonical_id') or email['id'], email['id'])
+    kept_ids = set(keep.values())
+    kept = [email for email in emails if email['id'] in kept_ids]
+    return kept, len(emails) - len(kept)
+
+
+BACKFILL_WHERE = '''
+    id > %(last_id)s
+    AND NOT enrichment_pending
+    AND NOT EXISTS (SELECT 1 FROM email_fingerprints f WHERE f.email_id = e.id)
+'''
+
+
+def _backfill_batch(rows):
+    """Fingerprint and link a batch in id order, in one transaction under the band locks.
+
+    Writes the batch itself and returns no rows for run_backfill to write.
+    """
+    fingerprints = [(row, family_id(row['source_id']), simhash(fingerprint_text(row))) for row in rows]
+    links = []
+    with db.connection() as conn:
+        cur = conn.cursor()
+        rollups.skip(cur)
+        lock(cur, [(family, value) for _, family, value in fingerprints])
+        for row, family, value in fingerprints:
+            if value is None:
+                continue
+            # Earlier rows of the batch are already stored in this transaction
+            canonical_id = find_canonical(cur, value, family, row['received_at'])
+            store_fingerprint(cur, row['id'], family, row['received_at'], value, canonical_id)
+            if canonical_id is not None:
+                links.append((row['id'], canonical_id))
+        if links:
+            execute_values(cur, '''
+                UPDATE emails AS e SET canonical_id = v.canonical_id
+                FROM (VALUES %s) AS v(id, canonical_id)
+                WHERE e.id = v.id
+            ''', links)
+        conn.commit()
+        cur.close()
+    return []
+
+
+def backfill_fingerprints(batch_size=500, restart=False):
+    """Fingerprint and link emails stored before fingerprints existed, oldest first."""
+    return run_backfill(
+        'email_fingerprints',
+        f'''
+            SELECT id, source_id, received_at, subject, body_text, plain_text, body_html
+            FROM emails e
+            WHERE {BACKFILL_WHERE}
+            ORDER BY id
+            LIMIT %(limit)s
+        ''',
+        None,
+        None,
+        count_sql=f"SELECT COUNT(*) FROM emails e WHERE {BACKFILL_WHERE}",
+        batch_size=batch_size,
+        workers=1,
+        restart=restart,
+        compute_batch=_backfill_batch,
+    )
+
+
+def savings_report(days=None):
+    """Emails, body bytes and prompt tokens held by duplicate copies.
+
+    Tokens use the stored token_count, or characters / 4 for emails never analysed.
+    """
+    where = "WHERE received_at >= NOW() - %s * INTERVAL '1 day'" if days else ''
+    params = [days] if days else []
+    with db.connection() as conn:
+        cur = conn.cursor(cursor_factory=DictCursor)
+        cur.execute(f'''
+            SELECT source_id,
+                   COUNT(*) AS emails,
+                   COUNT(*) FILTER (WHERE canonical_id IS NOT NULL) AS duplicates,
+                   SUM(bytes) AS body_bytes,
+                   SUM(bytes) FILTER (WHERE canonical_id IS NOT NULL) AS duplicate_body_bytes,
+                   SUM(tokens) AS tokens,
+                   SUM(tokens) FILTER (WHERE canonical_id IS NOT NULL) AS duplicate_tokens,
+                   COUNT(*) FILTER (WHERE token_count IS NULL) AS estimated_tokens
+            FROM (
+                SELECT source_id, canonical_id, token_count,
+                       COALESCE(pg_column_size(body_text), 0) + COALESCE(pg_column_size(body_html), 0)
+                           + COALESCE(pg_column_size(plain_text), 0) AS bytes,
+                       COALESCE(token_count, length(COALESCE(body_text, plain_text, '')) / 4) AS tokens
+                FROM emails
+                {where}
+            ) sized
+            GROUP BY source_id
+        ''', params)
+        rows = [dict(row) for row in cur.fetchall()]
+        cur.close()
+
+    def share(part, whole):
+        return round(part / whole, 4) if whole else None
+
+    totals = {key: sum(int(row[key] or 0) for row in rows)
+              for key in ('emails', 'duplicates', 'body_bytes', 'duplicate_body_bytes',
+                          'tokens', 'duplicate_tokens', 'estimated_tokens')}
+    totals.update({
+        'duplicate_share': share(totals['duplicates'], totals['emails']),
+        'body_bytes_share': share(totals['duplicate_body_bytes'], totals['body_bytes']),
+        'token_share': share(totals['duplicate_tokens'], totals['tokens']),
+    })
+    by_source = sorted(
+        ({'source_id': row['source_id'], 'emails': int(row['emails']), 'duplicates': int(row['duplicates']),
+          'duplicate_body_bytes': int(row['duplicate_body_bytes'] or 0),
+          'duplicate_tokens': int(row['duplicate_tokens'] or 0)}
+         for row in rows if row['duplicates']),
+        key=lambda row: row['duplicate_body_bytes'], reverse=True)
+    return {'days': days, 'totals': totals, 'by_source': by_source}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fingerprint emails and report near-duplicate savings.')
+    parser.add_argument('--backfill', action='store_true', help='fingerprint and link emails without a fingerprint')
+    parser.add_argument('--restart', action='store_true', help='ignore the saved checkpoint and start over')
+    parser.add_argument('--report', action='store_true', help='print storage and token held by duplicates')
+    parser.add_argument('--days', type=int, default=None, help='limit --report to the past N days')
+    args = parser.parse_args()
+
+    if args.backfill:
+        backfill_fingerprints(restart=args.restart)
+    if args.report or not args.backfill:
+        print(json.dumps(savings_report(days=args.days), indent=2))
@@ -0,0 +1,316 @@
+"""Background enrichment of ingested emails.
+
+When ENRICHMENT_MODE is "async", /parse-email stores the raw parsed fields
+with enrichment_pending = TRUE and returns straight away. The workers in this
+module claim pending rows in batches, compute the derived fields (spam score,
+URLs, summary metrics, word-cloud terms) off the request path and write each
+batch back with a single UPDATE.
+
+Claims are leases: rows claimed by a worker that dies are picked up again once
+ENRICHMENT_LEASE_SECONDS has passed, so restarting workers never loses emails.
+
+Run a dedicated worker with:
+
+    python enrichment.py            # poll forever
+    python enrichment.py --once     # drain the backlog and exit
+    python enrichment.py --status   # print pending count and lag
+"""
+import argparse
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime
+
+from psycopg2.extras import DictCursor, execute_values
+
+import db
+import dedupe
+import link_index
+import offload
+import rollups
+import spam_scoring
+import term_index
+
+# "sync" scores inside the webhook as before, "async" defers to the workers
+ENRICHMENT_MODE = os.environ.get('ENRICHMENT_MODE', 'sync')
+# "thread" or "process"
+ENRICHMENT_EXECUTOR = os.environ.get('ENRICHMENT_EXECUTOR', 'thread')
+ENRICHMENT_WORKERS = int(os.environ.get('ENRICHMENT_WORKERS', 4))
+ENRICHMENT_BATCH_SIZE = int(os.environ.get('ENRICHMENT_BATCH_SIZE', 20))
+ENRICHMENT_POLL_INTERVAL = float(os.environ.get('ENRICHMENT_POLL_INTERVAL', 5))
+ENRICHMENT_LEASE_SECONDS = int(os.environ.get('ENRICHMENT_LEASE_SECONDS', 300))
+ENRICHMENT_MAX_ATTEMPTS = int(os.environ.get('ENRICHMENT_MAX_ATTEMPTS', 5))
+# Run the worker pool inside each web process instead of a separate worker dyno
+ENRICHMENT_IN_PROCESS = os.environ.get('ENRICHMENT_IN_PROCESS', 'false').lower() == 'true'
+
+_wakeup = threading.Event()
+_worker_thread = None
+_worker_pid = None
+_stats_lock = threading.Lock()
+_stats = {
+    'batches': 0,
+    'enriched': 0,
+    'failed': 0,
+    'last_batch_seconds': 0.0,
+}
+
+
+def is_async():
+    return ENRICHMENT_MODE == 'async'
+
+
+def extract_urls(text):
+    """Extract URLs from text or HTML using a regex."""
+    if not text:
+        return []
+    url_pattern = r'http[s]?://(?:[a-zA-Z0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
+    return re.findall(url_pattern, text)
+
+
+def extract_plain_text(body_text, body_html):
+    """Return the text to count words in, extracting it from the HTML when there is no text part."""
+    if body_text or not body_html:
+        return body_text or ''
+    try:
+        # Extract text from HTML (removing HTML tags)
+        from bs4 import BeautifulSoup
+        return BeautifulSoup(body_html, 'html.parser').get_text(separator=' ', strip=True)
+    except ImportError:
+        print("BeautifulSoup not installed. Install with: pip install beautifulsoup4")
+        return ''
+    except Exception as e:
+        print(f"Error extracting text from HTML: {str(e)}")
+        return ''
+
+
+def compute_email_metrics(subject, body_text, body_html, urls):
+    """Compute the stored summary metrics shown in the inbox and metrics API.
+
+    plain_text is only stored for HTML-only emails; emails with a text part
+    already keep it in body_text.
+    """
+    text = extract_plain_text(body_text, body_html)
+    return {
+        'subject_length': len(subject) if subject else 0,
+        'word_count': len(text.split()),
+        'link_count': len(urls) if urls else 0,
+        'plain_text': None if body_text else (text or None),
+    }
+
+
+def enrich_email(email):
+    """Compute the derived fields for one email (a plain dict of its columns).
+
+    The spam score is left to process_batch, which scores the whole batch at once.
+    """
+    text_body = email.get('body_text') or ''
+    html_body = email.get('body_html') or ''
+
+    # Extract URLs from text content first, fall back to HTML if no text
+    urls = extract_urls(text_body) if text_body else extract_urls(html_body)
+
+    result = {
+        'id': email['id'],
+        'source_id': email.get('source_id'),
+        'received_at': email.get('received_at'),
+        'urls': urls,
+        'simhash': dedupe.simhash(dedupe.fingerprint_text(email)),
+        'display_html': link_index.rewrite_links(html_body),
+        'links': link_index.url_rows(email['id'], email.get('source_id'), email.get('received_at'), urls),
+    }
+    result.update(compute_email_metrics(email.get('subject'), text_body, html_body, urls))
+    result['terms'] = term_index.term_rows(email['id'], email.get('source_id'), email.get('received_at'),
+                                           term_index.compute_term_counts(email.get('subject'), text_body))
+    return result
+
+
+def claim_batch(limit=ENRICHMENT_BATCH_SIZE):
+    """Lease up to ``limit`` pending emails to this worker."""
+    with db.connection() as conn:
+        cur = conn.cursor(cursor_factory=DictCursor)
+        rollups.skip(cur)
+        cur.execute('''
+            UPDATE emails
+            SET enrichment_claimed_at = NOW(),
+                enrichment_attempts = enrichment_attempts + 1
+            WHERE id IN (
+                SELECT id FROM emails
+                WHERE enrichment_pending
+                  AND enrichment_attempts < %s
+                  AND (enrichment_claimed_at IS NULL
+                       OR enrichment_claimed_at < NOW() - %s * INTERVAL '1 second')
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, source_id, received_at, from_address, to_address, subject, body_text, body_html
+        ''', (ENRICHMENT_MAX_ATTEMPTS, ENRICHMENT_LEASE_SECONDS, limit))
+        rows = [dict(row) for row in cur.fetchall()]
+        conn.commit()
+        cur.close()
+    return rows
+
+
+def complete_batch(results):
+    """Write enrichment results back and clear the pending flag."""
+    if not results:
+        return
+    with db.connection() as conn:
+        cur = conn.cursor()
+        # All band locks at once, then in id order so copies within the batch link to the earliest one
+        dedupe.lock(cur, [(dedupe.family_id(r['source_id'], conn), r['simhash']) for r in results])
+        for r in sorted(results, key=lambda r: r['id']):
+            r['canonical_id'] = dedupe.link_email(cur, r['id'], r['source_id'], r['received_at'], r['simhash'])
+        execute_values(cur, '''
+            UPDATE emails AS e
+            SET spam_score = v.spam_score,
+                spam_scorer = v.spam_scorer,
+                urls = v.urls,
+                subject_length = v.subject_length,
+                word_count = v.word_count,
+                link_count = v.link_count,
+                plain_text = v.plain_text,
+                display_html = v.display_html,
+                canonical_id = v.canonical_id,
+                spam_pending = v.spam_score IS NULL,
+                enrichment_pending = FALSE,
+                enrichment_claimed_at = NULL
+            FROM (VALUES %s) AS v(id, spam_score, spam_scorer, urls, subject_length, word_count, link_count,
+                                  plain_text, display_html, canonical_id)
+            WHERE e.id = v.id
+        ''', [(r['id'], r['spam_score'], r['spam_scorer'], r['urls'], r['subject_length'], r['word_count'],
+               r['link_count'], r['plain_text'], r['display_html'], r['canonical_id']) for r in results],
+            template='(%s, %s::float, %s::text, %s::text[], %s::int, %s::int, %s::int, %s::text, %s::text, %s::int)')
+        term_index.store_term_rows(cur, [row for r in results for row in r['terms']])
+        link_index.store_url_rows(cur, [row for r in results for row in r['links']])
+        conn.commit()
+        cur.close()
+
+
+def _record(**changes):
+    with _stats_lock:
+        for key, value in changes.items():
+            if key == 'last_batch_seconds':
+                _stats[key] = value
+            else:
+                _stats[key] += value
+
+
+def process_batch(executor, batch_size=ENRICHMENT_BATCH_SIZE):
+    """Claim, enrich and store one batch. Returns the number of rows claimed."""
+    rows = claim_batch(batch_size)
+    if not rows:
+        return 0
+
+    start = time.monotonic()
+    # Under gevent the executor's threads are greenlets; the parsing itself
+    # runs on native threads so it does not hold up the web requests
+    futures = [(row['id'], executor.submit(offload.run, enrich_email, row)) for row in rows]
+    results = []
+    failed = 0
+    for email_id, future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            # Left claimed; another attempt is made once the lease expires
+            print(f"Error enriching email {email_id}: {str(e)}")
+            failed += 1
+
+    # One feature matrix (or one round of remote calls) for the whole batch
+    rows_by_id = {row['id']: row for row in rows}
+    engine = spam_scoring.resolve()
+    scores = spam_scoring.score_batch([rows_by_id[result['id']] for result in results], engine)
+    version = engine.version()
+    for result, score in zip(results, scores):
+        result['spam_score'] = score
+        result['spam_scorer'] = version if score is not None else None
+
+    complete_batch(results)
+    _record(batches=1, enriched=len(results), failed=failed,
+            last_batch_seconds=time.monotonic() - start)
+    return len(rows)
+
+
+def make_executor(kind=ENRICHMENT_EXECUTOR, workers=ENRICHMENT_WORKERS):
+    if kind == 'process':
+        return ProcessPoolExecutor(max_workers=workers)
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix='enrichment')
+
+
+def run_worker(stop_event=None, once=False):
+    """Enrich pending emails until stopped (or until the backlog is empty)."""
+    stop_event = stop_event or threading.Event()
+    with make_executor() as executor:
+        while not stop_event.is_set():
+            try:
+                claimed = process_batch(executor)
+            except Exception as e:
+                print(f"Error in enrichment worker: {str(e)}")
+                claimed = 0
+            if claimed:
+                continue
+            if once:
+                break
+            # Sleep until the next poll or until a new email is ingested
+            _wakeup.wait(ENRICHMENT_POLL_INTERVAL)
+            _wakeup.clear()
+
+
+def notify():
+    """Wake the in-process worker after a new pending email is stored."""
+    _wakeup.set()
+
+
+def start_background_worker():
+    """Start the worker pool on a daemon thread in this process (once per pid)."""
+    global _worker_thread, _worker_pid
+    if _worker_thread is not None and _worker_pid == os.getpid() and _worker_thread.is_alive():
+        return _worker_thread
+    _worker_pid = os.getpid()
+    _worker_thread = threading.Thread(target=run_worker, name='enrichment-dispatcher', daemon=True)
+    _worker_thread.start()
+    return _worker_thread
+
+
+def get_status():
+    """Return the pending backlog, enrichment lag and this process's counters."""
+    with db.connection() as conn:
+        cur = conn.cursor(cursor_factory=DictCursor)
+        cur.execute('''
+            SELECT COUNT(*) FILTER (WHERE enrichment_attempts < %s) AS pending,
+                   COUNT(*) FILTER (WHERE enrichment_attempts >= %s) AS failed,
+                   MIN(received_at) FILTER (WHERE enrichment_attempts < %s) AS oldest_pending
+            FROM emails
+            WHERE enrichment_pending
+        ''', (ENRICHMENT_MAX_ATTEMPTS, ENRICHMENT_MAX_ATTEMPTS, ENRICHMENT_MAX_ATTEMPTS))
+        row = cur.fetchone()
+        cur.close()
+
+    oldest_pending = row['oldest_pending']
+    lag_seconds = (datetime.now() - oldest_pending).total_seconds() if oldest_pending else 0.0
+    with _stats_lock:
+        worker_stats = dict(_stats)
+
+    return {
+        'mode': ENRICHMENT_MODE,
+        'pending': int(row['pending']),
+        'failed': int(row['failed']),
+        'oldest_pending': oldest_pending.isoformat() if oldest_pending else None,
+        'lag_seconds': round(lag_seconds, 1),
+        'worker': worker_stats,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Enrich emails stored by /parse-email in async mode.')
+    parser.add_argument('--once', action='store_true', help='drain the pending backlog and exit')
+    parser.add_argument('--status', action='store_true', help='print backlog and lag, then exit')
+    args = parser.parse_args()
+
+    if args.status:
+        print(get_status())
+    else:
+        print(f"Starting enrichment worker ({ENRICHMENT_WORKERS} {ENRICHMENT_EXECUTOR} workers, batch size {ENRICHMENT_BATCH_SIZE})")
+        run_worker(once=args.once)
@@ -0,0 +1,280 @@
+"""Bulk export of emails as CSV, JSON lines or Parquet.
+
+Analysts used to page through /inbox or fetchall() the whole window into
+dicts. An export runs one query through a named (server-side) cursor and
+writes each FETCH of EXPORT_FETCH_SIZE rows out before reading the next,
+so memory stays flat however many rows match:
+
+    GET /api/export?format=csv&source=2&start_date=2025-01-01&keyword=dividend&columns=id,subject
+    python export.py --format parquet --source 2 --output emails.parquet
+
+Filters match /inbox: a source includes its consolidated children, dates
+are inclusive, keywords use the search index. Rows come newest first.
+Parquet needs pyarrow, which is not a default dependency; without it
+the format is not offered (FORMATS and WRITERS leave it out).
+"""
+import argparse
+import csv
+import importlib.util
+import io
+import itertools
+import json
+import os
+import sys
+import threading
+from datetime import date, datetime
+
+import db
+import search
+import source_catalog
+
+EXPORT_FETCH_SIZE = int(os.environ.get('EXPORT_FETCH_SIZE', 2000))
+# Each running export holds a pooled connection until it finishes
+EXPORT_CONCURRENCY = int(os.environ.get('EXPORT_CONCURRENCY', 2))
+
+# name: (SQL expression, type)
+COLUMNS = {
+    'id': ('e.id', 'int'),
+    'source_id': ('e.source_id', 'int'),
+    'source_name': ('COALESCE(s.display_name, s.name)', 'text'),
+    'to_address': ('e.to_address', 'text'),
+    'from_address': ('e.from_address', 'text'),
+    'subject': ('e.subject', 'text'),
+    'received_at': ('e.received_at', 'timestamp'),
+    'spam_score': ('e.spam_score', 'float'),
+    'subject_length': ('e.subject_length', 'int'),
+    'word_count': ('e.word_count', 'int'),
+    'link_count': ('e.link_count', 'int'),
+    'token_count': ('e.token_count', 'int'),
+    'canonical_id': ('e.canonical_id', 'int'),
+    'urls': ('e.urls', 'text[]'),
+    'body_text': ('e.body_text', 'text'),
+    'plain_text': ('e.plain_text', 'text'),
+    'body_html': ('e.body_html', 'text'),
+}
+# Everything but the bodies
+DEFAULT_COLUMNS = ('id', 'source_id', 'source_name', 'from_address', 'subject', 'received_at',
+                   'spam_score', 'word_count', 'link_count')
+
+# format: (mimetype, file extension); Parquet only when pyarrow is installed
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'jsonl': ('application/x-ndjson', 'jsonl'),
+}
+if importlib.util.find_spec('pyarrow') is not None:
+    FORMATS['parquet'] = ('application/vnd.apache.parquet', 'parquet')
+
+_slots = threading.BoundedSemaphore(EXPORT_CONCURRENCY)
+
+
+class ExportBusy(Exception):
+    """EXPORT_CONCURRENCY exports are already running in this process."""
+
+
+def parse_columns(value):
+    """Validate a comma-separated column list; raises ValueError on unknown names."""
+    if not value:
+        return DEFAULT_COLUMNS
+    columns = tuple(dict.fromkeys(column.strip() for column in value.split(',') if column.strip()))
+    unknown = [column for column in columns if column not in COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown columns: {', '.join(unknown)}")
+    return columns
+
+
+def export_query(columns=DEFAULT_COLUMNS, source_id=None, start_date=None, end_date=None,
+                 keyword=None, keyword_type='subject', hide_duplicates=False, limit=None, table='emails'):
+    """Return (sql, params) selecting ``columns`` for the filters, newest first."""
+    where_clauses = []
+    params = []
+    if source_id is not None:
+        where_clauses.append('e.source_id = ANY(%s)')
+        params.append(source_catalog.descendant_ids(source_id))
+    if keyword:
+        keyword_sql, keyword_params = search.keyword_filter(keyword, keyword_type)
+        where_clauses.append(keyword_sql)
+        params.extend(keyword_params)
+    if start_date:
+        where_clauses.append('e.received_at >= %s')
+        params.append(start_date)
+    if end_date:
+        where_clauses.append("e.received_at < (%s::date + INTERVAL '1 day')")
+        params.append(end_date)
+    if hide_duplicates:
+        where_clauses.append('e.canonical_id IS NULL')
+
+    sql = f'''
+        SELECT {', '.join(f'{COLUMNS[column][0]} AS {column}' for column in columns)}
+        FROM {table} e
+        LEFT JOIN email_sources s ON e.source_id = s.id
+        WHERE {' AND '.join(where_clauses) or 'TRUE'}
+        ORDER BY e.received_at DESC, e.id DESC
+    '''
+    if limit:
+        sql += ' LIMIT %s'
+        params.append(int(limit))
+    return sql, params
+
+
+def iter_batches(conn, sql, params, fetch_size=EXPORT_FETCH_SIZE):
+    """Yield lists of row tuples from a server-side cursor, ``fetch_size`` at a time."""
+    cur = conn.cursor(name='email_export')
+    try:
+        cur.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(fetch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cur.close()
+        # Read-only; ends the transaction the cursor lived in
+        conn.rollback()
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def csv_chunks(batches, columns):
+    """Header, then one CSV chunk per batch. Arrays are space-separated."""
+    arrays = [i for i, column in enumerate(columns) if COLUMNS[column][1] == 'text[]']
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in batches:
+        if arrays:
+            rows = [list(row) for row in rows]
+            for row in rows:
+                for i in arrays:
+                    row[i] = ' '.join(row[i] or [])
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def jsonl_chunks(batches, columns):
+    """One JSON object per row, a chunk per batch."""
+    for rows in batches:
+        yield ''.join(json.dumps(dict(zip(columns, row)), default=_json_default) + '\n'
+                      for row in rows).encode()
+
+
+class _Sink(io.RawIOBase):
+    """Write-only stream that hands its bytes over on drain() but keeps counting positions."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def parquet_chunks(batches, columns):
+    """A Parquet file with one row group per batch, streamed as each group is written."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    types = {'int': pa.int64(), 'float': pa.float64(), 'text': pa.string(),
+             'timestamp': pa.timestamp('us'), 'text[]': pa.list_(pa.string())}
+    schema = pa.schema([(column, types[COLUMNS[column][1]]) for column in columns])
+    sink = _Sink()
+    writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    try:
+        for rows in batches:
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)],
+                schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+WRITERS = {'csv': csv_chunks, 'jsonl': jsonl_chunks}
+if 'parquet' in FORMATS:
+    WRITERS['parquet'] = parquet_chunks
+
+
+def _generate(fmt, sql, params, columns, fetch_size):
+    if not _slots.acquire(blocking=False):
+        raise ExportBusy(f"{EXPORT_CONCURRENCY} exports already running")
+    try:
+        with db.connection() as conn:
+            yield from WRITERS[fmt](iter_batches(conn, sql, params, fetch_size), columns)
+    finally:
+        _slots.release()
+
+
+def stream(fmt, columns=DEFAULT_COLUMNS, fetch_size=EXPORT_FETCH_SIZE, **filters):
+    """Return an iterator of the export's byte chunks.
+
+    The first chunk is produced before returning, so ExportBusy (too many
+    exports running), a bad keyword or a failed query raise here rather than
+    halfway through a response. The pooled connection is held until the
+    iterator is exhausted or discarded.
+    """
+    if fmt not in WRITERS:
+        raise ValueError(f"Unknown format: {fmt}")
+    sql, params = export_query(columns, **filters)
+    chunks = _generate(fmt, sql, params, columns, fetch_size)
+    try:
+        first = next(chunks)
+    except StopIteration:
+        return iter(())
+    return itertools.chain((first,), chunks)
+
+
+def filename(fmt):
+    return f"emails-{datetime.now():%Y%m%d-%H%M%S}.{FORMATS[fmt][1]}"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export emails as CSV, JSON lines or Parquet.')
+    parser.add_argument('--format', choices=sorted(WRITERS), default='csv')
+    parser.add_argument('--columns', help=f"comma-separated, from: {', '.join(COLUMNS)}")
+    parser.add_argument('--source', type=int, help='source id (includes consolidated children)')
+    parser.add_argument('--start-date', help='YYYY-MM-DD, inclusive')
+    parser.add_argument('--end-date', help='YYYY-MM-DD, inclusive')
+    parser.add_argument('--keyword')
+    parser.add_argument('--keyword-type', default='subject', choices=sorted(search.KEYWORD_TYPES))
+    parser.add_argument('--hide-duplicates', action='store_true', help='leave out copies (see dedupe.py)')
+    parser.add_argument('--limit', type=int)
+    parser.add_argument('--output', default='-', help='file to write (default stdout)')
+    args = parser.parse_args()
+
+    try:
+        columns = parse_columns(args.columns)
+    except ValueError as e:
+        parser.error(str(e))
+    chunks = stream(args.format, columns, source_id=args.source, start_date=args.start_date,
+                    end_date=args.end_date, keyword=args.keyword, keyword_type=args.keyword_type,
+                    hide_duplicates=args.hide_duplicates, limit=args.limit)
+    out = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+    try:
+        for chunk in chunks:
+            out.write(chunk)
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
@@ -0,0 +1,29 @@
+"""Gunicorn settings for the web process (``gunicorn -c gunicorn.conf.py app:app``).
+
+The default gevent worker serves many concurrent requests per process, so
+a long LLM call or an open event stream (see streaming.py) only parks a
+greenlet instead of blocking a whole sync worker. psycopg2 is made
+cooperative with psycogreen so database waits yield to other requests too.
+Background threads are greenlets under gevent, so CPU-heavy work (word
+cloud rendering, the local spam scorer, HTML parsing) is handed to gevent's
+native thread pool (see offload.py) instead of stalling the event loop.
+Set GUNICORN_WORKER_CLASS=gthread to use OS threads instead.
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+# Concurrent requests per gevent worker, threads per gthread worker
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 200))
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+# Only fires if a worker stops responding; a streamed analysis keeps it alive
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+
+
+def post_fork(server, worker):
+    if server.cfg.worker_class_str == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
@@ -0,0 +1,297 @@
+"""Background jobs for long analyses (deep research).
+
+A deep-research search can run for minutes: retrieval, a map stage over
+every email and a reasoning call. Instead of holding the HTTP request open,
+the page submits a job and polls it:
+
+    POST /api/research-jobs          -> 202 {"job_id": 12, "status": "queued"}
+    GET  /api/research-jobs/12       -> status, progress, partial answer, result
+
+Jobs live in the analysis_jobs table, so any worker can answer a poll and
+finished results survive page refreshes and restarts. Each web process runs
+a dispatcher thread that claims queued jobs onto a pool of JOB_WORKERS
+threads. Claims are leases kept alive by a heartbeat: a job whose process
+dies is picked up again after JOB_LEASE_SECONDS, up to JOB_MAX_ATTEMPTS
+times.
+
+Submitting a job identical (same kind and parameters) to one that is still
+queued or running returns the existing job instead of starting another.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from psycopg2.extras import DictCursor, Json
+
+import db
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 5))
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', 120))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 2))
+JOB_RETENTION_DAYS = int(os.environ.get('JOB_RETENTION_DAYS', 7))
+
+# Progress and partial answers are written at most this often per job
+REPORT_INTERVAL = 1.0
+PURGE_INTERVAL = 3600
+
+SCHEMA_SQL = '''
+    CREATE TABLE IF NOT EXISTS analysis_jobs (
+        id BIGSERIAL PRIMARY KEY,
+        kind TEXT NOT NULL,
+        params JSONB NOT NULL,
+        dedupe_key TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        progress JSONB,
+        partial_result TEXT,
+        result JSONB,
+        error TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        started_at TIMESTAMP,
+        heartbeat_at TIMESTAMP,
+        finished_at TIMESTAMP
+    );
+
+    -- At most one queued or running job per request; identical submissions coalesce
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_analysis_jobs_inflight
+    ON analysis_jobs(dedupe_key) WHERE status IN ('queued', 'running');
+
+    CREATE INDEX IF NOT EXISTS idx_analysis_jobs_finished
+    ON analysis_jobs(finished_at) WHERE finished_at IS NOT NULL;
+'''
+
+_handlers = {}
+_wakeup = threading.Event()
+_running = set()
+_running_lock = threading.Lock()
+_dispatcher_thread = None
+_dispatcher_pid = None
+
+
+def install(cur):
+    """Create the analysis_jobs table."""
+    cur.execute(SCHEMA_SQL)
+
+
+def register(kind, handler):
+    """Run jobs of ``kind`` with ``handler(params, report)``.
+
+    The handler returns the JSON-serializable result. It may call
+    ``report(progress=..., partial_result=...)`` as it goes; reports are
+    stored at most once per REPORT_INTERVAL unless ``force`` is set.
+    """
+    _handlers[kind] = handler
+
+
+def dedupe_key(kind, params):
+    payload = json.dumps({'kind': kind, 'params': params}, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def submit(kind, params):
+    """Queue a job, or join the identical one in flight. Returns (job_id, coalesced)."""
+    if kind not in _handlers:
+        raise ValueError(f"Unknown job kind: {kind}")
+    key = dedupe_key(kind, params)
+    with db.connection() as conn:
+        cur = conn.cursor()
+        # The in-flight job can finish between the two statements; try again then
+        for _ in range(3):
+            cur.execute('''
+                INSERT INTO analysis_jobs (kind, params, dedupe_key)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (dedupe_key) WHERE status IN ('queued', 'running') DO NOTHING
+                RETURNING id
+            ''', (kind, Json(params), key))
+            row = cur.fetchone()
+            if row:
+                job_id, coalesced = row[0], False
+                break
+            cur.execute('''
+                SELECT id FROM analysis_jobs
+                WHERE dedupe_key = %s AND status IN ('queued', 'running')
+            ''', (key,))
+            row = cur.fetchone()
+            if row:
+                job_id, coalesced = row[0], True
+                break
+        else:
+            raise RuntimeError("Could not queue the job")
+        conn.commit()
+        cur.close()
+    if not coalesced:
+        _wakeup.set()
+    return job_id, coalesced
+
+
+def get(job_id):
+    """The job as a JSON-ready dict, or None."""
+    with db.connection() as conn:
+        cur = conn.cursor(cursor_factory=DictCursor)
+        cur.execute('''
+            SELECT id, kind, params, status, progress, partial_result, result, error, attempts,
+                   created_at, started_at, finished_at
+            FROM analysis_jobs WHERE id = %s
+        ''', (job_id,))
+        row = cur.fetchone()
+        cur.close()
+    if row is None:
+        return None
+    job = dict(row)
+    for column in ('created_at', 'started_at', 'finished_at'):
+        job[column] = job[column].isoformat() if job[column] else None
+    return job
+
+
+def _claim(limit):
+    """Lease up to ``limit`` queued jobs, or running jobs whose worker stopped heartbeating."""
+    with db.connection() as conn:
+        cur = conn.cursor(cursor_factory=DictCursor)
+        cur.execute('''
+            UPDATE analysis_jobs
+            SET status = 'failed',
+                error = 'The job was interrupted too many times',
+                finished_at = NOW()
+            WHERE status = 'running'
+              AND heartbeat_at < NOW() - %s * INTERVAL '1 second'
+              AND attempts >= %s
+        ''', (JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS))
+        cur.execute('''
+            UPDATE analysis_jobs
+            SET status = 'running',
+                attempts = attempts + 1,
+                started_at = NOW(),
+                heartbeat_at = NOW()
+            WHERE id IN (
+                SELECT id FROM analysis_jobs
+                WHERE status = 'queued'
+                   OR (status = 'running' AND heartbeat_at < NOW() - %s * INTERVAL '1 second')
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, kind, params
+        ''', (JOB_LEASE_SECONDS, limit))
+        rows = [dict(row) for row in cur.fetchall()]
+        conn.commit()
+        cur.close()
+    return rows
+
+
+def _heartbeat():
+    with _running_lock:
+        ids = list(_running)
+    if not ids:
+        return
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            UPDATE analysis_jobs SET heartbeat_at = NOW()
+            WHERE id = ANY(%s) AND status = 'running'
+        ''', (ids,))
+        conn.commit()
+        cur.close()
+
+
+def _update(job_id, finished=False, **fields):
+    """Set columns of a running job; also refreshes its heartbeat (and finished_at)."""
+    columns = [f"{name} = %s" for name in fields] + ['heartbeat_at = NOW()']
+    if finished:
+        columns.append('finished_at = NOW()')
+    values = [Json(value) if isinstance(value, (dict, list)) else value for value in fields.values()]
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"UPDATE analysis_jobs SET {', '.join(columns)} WHERE id = %s AND status = 'running'",
+                    values + [job_id])
+        conn.commit()
+        cur.close()
+
+
+def _reporter(job_id):
+    last = [0.0]
+
+    def report(force=False, **fields):
+        now = time.monotonic()
+        if not force and now - last[0] < REPORT_INTERVAL:
+            return
+        last[0] = now
+        try:
+            _update(job_id, **fields)
+        except Exception as e:
+            print(f"Error reporting progress for job {job_id}: {str(e)}")
+    return report
+
+
+def _run(job):
+    job_id = job['id']
+    start = time.monotonic()
+    try:
+        result = _handlers[job['kind']](job['params'], _reporter(job_id))
+        _update(job_id, finished=True, status='succeeded', result=result)
+        print(f"Job {job_id} ({job['kind']}) finished in {time.monotonic() - start:.1f}s")
+    except Exception as e:
+        print(f"Job {job_id} ({job['kind']}) failed: {str(e)}")
+        try:
+            _update(job_id, finished=True, status='failed', error=str(e))
+        except Exception as update_error:
+            print(f"Error recording failure of job {job_id}: {str(update_error)}")
+    finally:
+        with _running_lock:
+            _running.discard(job_id)
+        _wakeup.set()
+
+
+def purge(days=JOB_RETENTION_DAYS):
+    """Delete finished jobs older than ``days``. Returns rows deleted."""
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM analysis_jobs WHERE finished_at < NOW() - %s * INTERVAL '1 day'", (days,))
+        deleted = cur.rowcount
+        conn.commit()
+        cur.close()
+    return deleted
+
+
+def run_dispatcher(stop_event=None):
+    """Claim and run jobs on a pool of JOB_WORKERS threads until stopped."""
+    stop_event = stop_event or threading.Event()
+    last_purge = 0.0
+    with ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job') as executor:
+        while not stop_event.is_set():
+            try:
+                _heartbeat()
+                with _running_lock:
+                    free = JOB_WORKERS - len(_running)
+                if free > 0:
+                    for job in _claim(free):
+                        if job['kind'] not in _handlers:
+                            _update(job['id'], finished=True, status='failed',
+                                    error=f"Unknown job kind: {job['kind']}")
+                            continue
+                        with _running_lock:
+                            _running.add(job['id'])
+                        executor.submit(_run, job)
+                if time.monotonic() - last_purge > PURGE_INTERVAL:
+                    last_purge = time.monotonic()
+                    purge()
+            except Exception as e:
+                print(f"Error in job dispatcher: {str(e)}")
+            # Sleep until the next poll, a new submission or a finished job;
+            # the heartbeat has to run well within the lease
+            _wakeup.wait(min(JOB_POLL_INTERVAL, JOB_LEASE_SECONDS / 3))
+            _wakeup.clear()
+
+
+def start_dispatcher():
+    """Start the dispatcher on a daemon thread in this process (once per pid)."""
+    global _dispatcher_thread, _dispatcher_pid
+    if _dispatcher_thread is not None and _dispatcher_pid == os.getpid() and _dispatcher_thread.is_alive():
+        return _dispatcher_thread
+    _dispatcher_pid = os.getpid()
+    _dispatcher_thread = threading.Thread(target=run_dispatcher, name='job-dispatcher', daemon=True)
+    _dispatcher_thread.start()
+    return _dispatcher_thread
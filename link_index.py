@@ -0,0 +1,221 @@
+"""Links in emails: display-ready HTML and a URL/domain index.
+
+At ingest (or enrichment) each email gets:
+
+- display_html: body_html with every link opened in a new tab, so views
+  send the stored column instead of running the rewrite on each render;
+- one email_urls row per distinct normalized URL, with the source, date and
+  registrable domain, so "which sources link to this domain" and "top
+  domains per source" are index scans instead of unnesting every urls array.
+
+Emails stored before either existed are handled by:
+
+    python link_index.py --backfill
+    python link_index.py --top-domains --days 30
+"""
+import argparse
+import json
+import re
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from psycopg2.extras import execute_values
+
+import db
+from backfill import run_backfill
+
+SCHEMA_SQL = '''
+    ALTER TABLE emails ADD COLUMN IF NOT EXISTS display_html TEXT;
+
+    CREATE TABLE IF NOT EXISTS email_urls (
+        email_id INTEGER NOT NULL REFERENCES emails(id) ON DELETE CASCADE,
+        source_id INTEGER,
+        received_at TIMESTAMP,
+        url TEXT NOT NULL,
+        domain TEXT NOT NULL,
+        PRIMARY KEY (email_id, url)
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_email_urls_domain_received ON email_urls(domain, received_at);
+    CREATE INDEX IF NOT EXISTS idx_email_urls_source_received ON email_urls(source_id, received_at);
+'''
+
+INSERT_SQL = '''
+    INSERT INTO email_urls (email_id, source_id, received_at, url, domain)
+    VALUES %s
+    ON CONFLICT (email_id, url) DO NOTHING
+'''
+
+_LINK_PATTERN = re.compile(r'<a\s+(?:[^>]*?\s+)?href="([^"]*)"([^>]*)>')
+_LINK_REPLACEMENT = r'<a href="\1" target="_blank" rel="noopener noreferrer"\2>'
+
+# Query parameters that only identify the campaign, not the destination
+TRACKING_PARAMS = ('utm_', 'mc_cid', 'mc_eid', 'fbclid', 'gclid')
+# Second-level labels under which the registrable domain has three labels
+# (example.co.uk). A heuristic; the public suffix list is not a dependency.
+SECOND_LEVEL_LABELS = {'co', 'com', 'net', 'org', 'gov', 'edu', 'ac', 'or', 'ne', 'go'}
+# Characters the ingest regex picks up around URLs in text and HTML
+_URL_TRAILING = '.,;:!?)]}\'"'
+
+
+def install(cur):
+    """Add the display_html column and the email_urls table."""
+    cur.execute(SCHEMA_SQL)
+
+
+def rewrite_links(html):
+    """Add target="_blank" to all links in the email HTML."""
+    if not html:
+        return html
+    return _LINK_PATTERN.sub(_LINK_REPLACEMENT, html)
+
+
+def normalize_url(url):
+    """Lower-case scheme and host, no default port, fragment or tracking parameters.
+
+    Returns None for anything that is not an http(s) URL with a host.
+    """
+    url = re.split(r'[<>\s]', url.strip(), maxsplit=1)[0].rstrip(_URL_TRAILING)
+    try:
+        parts = urlsplit(url)
+        host = (parts.hostname or '').rstrip('.')
+        port = parts.port
+    except ValueError:
+        return None
+    scheme = parts.scheme.lower()
+    if scheme not in ('http', 'https') or not host:
+        return None
+    netloc = host if port is None or (scheme, port) in (('http', 80), ('https', 443)) else f"{host}:{port}"
+    query = urlencode([(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+                       if not key.lower().startswith(TRACKING_PARAMS)])
+    return urlunsplit((scheme, netloc, parts.path or '/', query, ''))
+
+
+def registrable_domain(url):
+    """The domain a normalized URL belongs to: news.example.co.uk -> example.co.uk."""
+    host = urlsplit(url).hostname or ''
+    if re.fullmatch(r'[\d.]+', host):
+        return host
+    labels = host.split('.')
+    keep = 3 if len(labels) > 2 and labels[-2] in SECOND_LEVEL_LABELS and len(labels[-1]) == 2 else 2
+    return '.'.join(labels[-keep:])
+
+
+def url_rows(email_id, source_id, received_at, urls):
+    """email_urls rows for one email: each distinct normalized URL once."""
+    seen = {}
+    for url in urls or []:
+        normalized = normalize_url(url)
+        if normalized and normalized not in seen:
+            seen[normalized] = registrable_domain(normalized)
+    return [(email_id, source_id, received_at, url, domain) for url, domain in seen.items()]
+
+
+def store_url_rows(cur, rows):
+    """Insert (email_id, source_id, received_at, url, domain) rows."""
+    if rows:
+        execute_values(cur, INSERT_SQL, rows, page_size=1000)
+
+
+def top_domains(cur, days=30, source_ids=None, domain=None, limit=10):
+    """The most linked domains per source over the past ``days`` days.
+
+    Returns [{source_id, source_name, domains: [{domain, links, emails}]}],
+    busiest sources first. ``domain`` restricts the answer to the sources
+    linking to that registrable domain.
+    """
+    query = '''
+        SELECT source_id, domain, COUNT(*) AS links, COUNT(DISTINCT email_id) AS emails
+        FROM email_urls
+        WHERE received_at >= NOW() - %s * INTERVAL '1 day'
+    '''
+    params = [days]
+    if source_ids:
+        query += ' AND source_id = ANY(%s)'
+        params.append(list(source_ids))
+    if domain:
+        query += ' AND domain = %s'
+        params.append(domain.lower())
+    cur.execute(f'''
+        SELECT ranked.source_id, COALESCE(s.display_name, s.name) AS source_name,
+               ranked.domain, ranked.links, ranked.emails
+        FROM (
+            SELECT counts.*,
+                   ROW_NUMBER() OVER (PARTITION BY source_id ORDER BY links DESC, domain) AS rank,
+                   SUM(links) OVER (PARTITION BY source_id) AS source_links
+            FROM ({query} GROUP BY source_id, domain) counts
+        ) ranked
+        LEFT JOIN email_sources s ON s.id = ranked.source_id
+        WHERE ranked.rank <= %s
+        ORDER BY ranked.source_links DESC, ranked.source_id, ranked.rank
+    ''', params + [limit])
+
+    sources = {}
+    for source_id, source_name, row_domain, links, emails in cur.fetchall():
+        entry = sources.setdefault(source_id, {'source_id': source_id, 'source_name': source_name, 'domains': []})
+        entry['domains'].append({'domain': row_domain, 'links': int(links), 'emails': int(emails)})
+    return list(sources.values())
+
+
+# One statement per batch: store display_html and insert the URL rows
+BACKFILL_SQL = '''
+    WITH v(id, display_html, urls, domains) AS (VALUES %s),
+    updated AS (
+        UPDATE emails AS e SET display_html = v.display_html
+        FROM v WHERE e.id = v.id
+    )
+    INSERT INTO email_urls (email_id, source_id, received_at, url, domain)
+    SELECT e.id, e.source_id, e.received_at, u.url, u.domain
+    FROM v
+    JOIN emails e ON e.id = v.id
+    CROSS JOIN LATERAL unnest(v.urls, v.domains) AS u(url, domain)
+    ON CONFLICT (email_id, url) DO NOTHING
+'''
+
+BACKFILL_WHERE = "id > %(last_id)s AND display_html IS NULL AND NOT enrichment_pending"
+
+
+def _backfill_row(email):
+    rows = url_rows(email['id'], None, None, email['urls'])
+    return (email['id'], rewrite_links(email['body_html'] or ''),
+            [row[3] for row in rows], [row[4] for row in rows])
+
+
+def backfill_links(workers=4, batch_size=200, restart=False):
+    """Store display_html and email_urls rows for emails that have neither yet."""
+    return run_backfill(
+        'email_links',
+        f'''
+            SELECT id, body_html, urls
+            FROM emails
+            WHERE {BACKFILL_WHERE}
+            ORDER BY id
+            LIMIT %(limit)s
+        ''',
+        _backfill_row,
+        BACKFILL_SQL,
+        template='(%s, %s::text, %s::text[], %s::text[])',
+        count_sql=f"SELECT COUNT(*) FROM emails WHERE {BACKFILL_WHERE}",
+        batch_size=batch_size,
+        workers=workers,
+        executor='process',
+        skip_rollups=True,
+        restart=restart,
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index email links and pre-render display HTML.')
+    parser.add_argument('--backfill', action='store_true', help='process emails stored before the link index')
+    parser.add_argument('--workers', type=int, default=4, help='worker processes for --backfill (default 4)')
+    parser.add_argument('--restart', action='store_true', help='ignore the saved checkpoint and start over')
+    parser.add_argument('--top-domains', action='store_true', help='print the most linked domains per source')
+    parser.add_argument('--days', type=int, default=30, help='window for --top-domains (default 30)')
+    args = parser.parse_args()
+
+    if args.backfill:
+        backfill_links(workers=args.workers, restart=args.restart)
+    if args.top_domains:
+        with db.connection() as conn:
+            cur = conn.cursor()
+            print(json.dumps(top_domains(cur, days=args.days), indent=2))
+            cur.close()
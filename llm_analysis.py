@@ -0,0 +1,365 @@
+"""Map-reduce email analysis with the DeepSeek chat API.
+
+The analysis endpoints used to pack the newest emails into a single
+40,000-token request and drop everything older, so long windows were only
+partly analysed. Now:
+
+1. chunk: emails are split, newest first, into batches that each fit
+   LLM_CHUNK_TOKENS (an email too large for a chunk on its own is cut).
+2. map: every chunk is summarised against the user's question on a
+   bounded thread pool (LLM_MAP_WORKERS concurrent requests).
+3. reduce: the partial summaries are merged into the final answer; if
+   they do not fit one request they are merged in groups first.
+
+When every email fits in one chunk the map stage is skipped and the answer
+comes from a single request, as before. Results report how many emails were
+covered and how long each stage took.
+
+Callers that stream the answer (see streaming.py) can follow the map stage
+through a ``progress`` callback and abandon the run by setting a
+``cancelled`` event: chunks not yet sent are dropped and Cancelled is
+raised before the final request is made.
+"""
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from psycopg2.extras import execute_values
+
+import db
+import dedupe
+import llm_cache
+import rollups
+import tokenizer
+
+DEEPSEEK_BASE_URL = 'https://api.deepseek.com'
+DEEPSEEK_API_KEY = os.environ.get('DEEPSEEK_API_KEY', 'sk-c68a67e660b74167886f051b790ca6fd')
+# Chunk summaries are extraction work; the final answer keeps the reasoning model
+LLM_MAP_MODEL = os.environ.get('LLM_MAP_MODEL', 'deepseek-chat')
+LLM_REDUCE_MODEL = os.environ.get('LLM_REDUCE_MODEL', 'deepseek-reasoner')
+LLM_MAP_WORKERS = int(os.environ.get('LLM_MAP_WORKERS', 4))
+# Email tokens per request, well below the 65,536 context window
+LLM_CHUNK_TOKENS = int(os.environ.get('LLM_CHUNK_TOKENS', 30000))
+# Send each newsletter once when copies from sibling inboxes are in the window (see dedupe.py)
+LLM_COLLAPSE_DUPLICATES = os.environ.get('LLM_COLLAPSE_DUPLICATES', 'true').lower() == 'true'
+# Tokens kept free in every request for the model's answer
+RESPONSE_TOKENS = 8000
+MAP_RETRIES = 1
+MAX_REDUCE_ROUNDS = 3
+
+MAP_SYSTEM_PROMPT = (
+    "You are an expert email analyst. You are given one batch of a larger set of emails. "
+    "Extract everything in this batch that is relevant to the analyst's request: themes, "
+    "sentiment, promotions and offers, notable patterns and strategies, with concrete examples "
+    "(sender, subject, date). Be factual and dense; another step will merge your notes with "
+    "notes from the other batches."
+)
+REDUCE_SYSTEM_PROMPT = (
+    "You are an expert email analyst. You are given notes extracted from consecutive batches "
+    "of emails. Merge them into one answer to the analyst's request, weighing patterns that "
+    "recur across batches above one-off observations."
+)
+
+
+
+class Cancelled(Exception):
+    """Raised when the caller set the ``cancelled`` event mid-analysis."""
+
+
+_client = None
+_client_lock = threading.Lock()
+_source_tokens = {}
+_source_tokens_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            from openai import OpenAI
+            _client = OpenAI(api_key=DEEPSEEK_API_KEY, base_url=DEEPSEEK_BASE_URL)
+        return _client
+
+
+def email_entry(email, source=True):
+    """The fields of an email that are sent to the model."""
+    text = email.get('body_text') or email.get('plain_text')
+    return {
+        'from': email['from_address'],
+        'subject': email['subject'],
+        'date': email['received_at'].strftime('%Y-%m-%d %H:%M:%S'),
+        'source': (email.get('display_name') or email.get('source_name')) if source else None,
+        'text': text if text else "No text content",
+    }
+
+
+def ensure_token_counts(emails):
+    """Set email['token_count'] where it is missing and store it for next time.
+
+    The stored count covers the entry without its source name (sources can
+    be renamed); entry_tokens() adds that back. Uncounted emails are encoded
+    in one batch. Emails still waiting for enrichment are counted but not
+    stored, since their extracted text may not exist yet. A trigger clears
+    the stored count whenever the fields it covers change (see migrate.py),
+    and a count is only written back while the row still has no count.
+    """
+    missing = [email for email in emails if email.get('token_count') is None]
+    if not missing:
+        return 0
+    counts = tokenizer.count_batch([json.dumps(email_entry(email, source=False)) for email in missing])
+    rows = []
+    for email, token_count in zip(missing, counts):
+        email['token_count'] = token_count
+        if 'id' in email and not email.get('enrichment_pending'):
+            rows.append((email['id'], token_count))
+    if rows:
+        with db.connection() as conn:
+            cur = conn.cursor()
+            rollups.skip(cur)
+            execute_values(cur, '''
+                UPDATE emails AS e SET token_count = v.token_count
+                FROM (VALUES %s) AS v(id, token_count)
+                WHERE e.id = v.id AND e.token_count IS NULL
+            ''', rows, page_size=1000)
+            conn.commit()
+            cur.close()
+    return len(missing)
+
+
+def entry_tokens(email):
+    """Tokens of email_entry(email), from the stored count plus the source name."""
+    source = email.get('display_name') or email.get('source_name')
+    with _source_tokens_lock:
+        tokens = _source_tokens.get(source)
+    if tokens is None:
+        # json.dumps(None) is the single token "null"
+        tokens = tokenizer.count(json.dumps(source)) - 1
+        with _source_tokens_lock:
+            _source_tokens[source] = tokens
+    return email['token_count'] + tokens
+
+
+def _fit_entry(entry, budget):
+    """Cut an entry's text so its JSON fits in ``budget`` tokens."""
+    overhead = tokenizer.count(json.dumps(dict(entry, text='')))
+    keep = max(0, budget - overhead - 16)
+    entry = dict(entry, text=tokenizer.truncate(entry['text'], keep) + ' [truncated]')
+    return entry, tokenizer.count(json.dumps(entry))
+
+
+def chunk_emails(emails, budget):
+    """Split emails (newest first) into lists of entries of at most ``budget`` tokens.
+
+    Packing uses the stored per-email counts; only emails too large for a
+    chunk on their own are encoded again, to cut them.
+    """
+    ensure_token_counts(emails)
+    chunks = []
+    current = []
+    current_tokens = 0
+    for email in sorted(emails, key=lambda x: x['received_at'], reverse=True):
+        entry = email_entry(email)
+        tokens = entry_tokens(email)
+        if tokens > budget:
+            entry, tokens = _fit_entry(entry, budget)
+        if current and current_tokens + tokens > budget:
+            chunks.append(current)
+            current, current_tokens = [], 0
+        current.append(entry)
+        current_tokens += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _complete(model, system_prompt, user_prompt, temperature, stream=False):
+    return get_client().chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt},
+        ],
+        temperature=temperature,
+        stream=stream,
+    )
+
+
+def _map_chunk(prompt, chunk, index, total):
+    user_prompt = (
+        f"Analyst's request:\n{prompt}\n\n"
+        f"Batch {index + 1} of {total} ({len(chunk)} emails):\n{json.dumps(chunk)}"
+    )
+    start = time.monotonic()
+    for attempt in range(MAP_RETRIES + 1):
+        try:
+            response = _complete(LLM_MAP_MODEL, MAP_SYSTEM_PROMPT, user_prompt, temperature=0.3)
+            return response.choices[0].message.content, time.monotonic() - start
+        except Exception as e:
+            print(f"Map chunk {index + 1}/{total} failed (attempt {attempt + 1}): {str(e)}")
+    return None, time.monotonic() - start
+
+
+def _group_notes(notes, budget):
+    groups = []
+    current = []
+    current_tokens = 0
+    for note in notes:
+        note_tokens = tokenizer.count(note)
+        if current and current_tokens + note_tokens > budget:
+            groups.append(current)
+            current, current_tokens = [], 0
+        current.append(note)
+        current_tokens += note_tokens
+    if current:
+        groups.append(current)
+    return groups
+
+
+def _format_notes(notes):
+    return '\n\n'.join(f"--- Notes from batch {i + 1} ---\n{note}" for i, note in enumerate(notes))
+
+
+def _reduce(prompt, notes, budget, temperature, stream=False):
+    """Merge notes into the final answer, in rounds if they do not fit one request."""
+    rounds = 0
+    while rounds < MAX_REDUCE_ROUNDS and len(notes) > 1 and tokenizer.count(_format_notes(notes)) > budget:
+        rounds += 1
+        groups = _group_notes(notes, budget)
+        with ThreadPoolExecutor(max_workers=LLM_MAP_WORKERS, thread_name_prefix='llm-reduce') as executor:
+            notes = list(executor.map(
+                lambda group: _complete(
+                    LLM_MAP_MODEL, REDUCE_SYSTEM_PROMPT,
+                    f"Analyst's request:\n{prompt}\n\nMerge these notes into one set of notes:\n{_format_notes(group)}",
+                    temperature=0.3,
+                ).choices[0].message.content,
+                groups,
+            ))
+
+    user_prompt = f"{prompt}\n\nNotes extracted from the emails, newest batch first:\n{_format_notes(notes)}"
+    response = _complete(LLM_REDUCE_MODEL, REDUCE_SYSTEM_PROMPT, user_prompt, temperature, stream=stream)
+    return (response if stream else response.choices[0].message.content), rounds
+
+
+def _check(cancelled):
+    if cancelled is not None and cancelled.is_set():
+        raise Cancelled()
+
+
+def analyze(emails, prompt, system_prompt, temperature=0.7, stream=False, progress=None, cancelled=None,
+            collapse_duplicates=None):
+    """Answer ``prompt`` over all of ``emails``.
+
+    Returns a dict with the answer under 'analysis' (the streaming response
+    object when ``stream`` is true), plus 'coverage' and 'timings'.
+    ``progress(stage, done, total)`` is called as map chunks finish and
+    before the final request; ``cancelled`` is a threading.Event.
+    Copies of the same newsletter (see dedupe.py) are sent once unless
+    ``collapse_duplicates`` is false (default LLM_COLLAPSE_DUPLICATES).
+    """
+    started = time.monotonic()
+    duplicates = 0
+    if LLM_COLLAPSE_DUPLICATES if collapse_duplicates is None else collapse_duplicates:
+        emails, duplicates = dedupe.collapse(emails)
+    budget = LLM_CHUNK_TOKENS - RESPONSE_TOKENS - tokenizer.count(system_prompt) - tokenizer.count(prompt)
+    budget = max(budget, 1000)
+
+    chunks = chunk_emails(emails, budget)
+    chunked = time.monotonic()
+    coverage = {
+        'emails_available': len(emails),
+        'emails_analyzed': sum(len(chunk) for chunk in chunks),
+        'chunks': len(chunks),
+        'chunks_failed': 0,
+        'duplicates_collapsed': duplicates,
+    }
+    timings = {'chunk_seconds': round(chunked - started, 3)}
+    print(f"Analyzing {len(emails)} emails in {len(chunks)} chunks of up to {budget} tokens")
+    _check(cancelled)
+
+    if len(chunks) <= 1:
+        # Everything fits in one request: answer directly, no map stage
+        if progress:
+            progress('answer', 0, 1)
+        full_prompt = f"{prompt}\n\nEmail data: {json.dumps(chunks[0] if chunks else [])}"
+        response = _complete(LLM_REDUCE_MODEL, system_prompt, full_prompt, temperature, stream=stream)
+        analysis = response if stream else response.choices[0].message.content
+        timings.update(map_seconds=0.0, reduce_seconds=round(time.monotonic() - chunked, 3))
+    else:
+        with ThreadPoolExecutor(max_workers=LLM_MAP_WORKERS, thread_name_prefix='llm-map') as executor:
+            futures = [executor.submit(_map_chunk, prompt, chunk, index, len(chunks))
+                       for index, chunk in enumerate(chunks)]
+            try:
+                for done, _ in enumerate(as_completed(futures), 1):
+                    if progress:
+                        progress('map', done, len(chunks))
+                    _check(cancelled)
+            except Cancelled:
+                # Requests already in flight finish; queued chunks are never sent
+                for future in futures:
+                    future.cancel()
+                raise
+            results = [future.result() for future in futures]
+        mapped = time.monotonic()
+
+        notes = []
+        for chunk, (note, _) in zip(chunks, results):
+            if note is None:
+                coverage['chunks_failed'] += 1
+                coverage['emails_analyzed'] -= len(chunk)
+            else:
+                notes.append(note)
+        if not notes:
+            raise RuntimeError("Every chunk of the map stage failed")
+
+        chunk_seconds = [seconds for _, seconds in results]
+        timings.update(
+            map_seconds=round(mapped - chunked, 3),
+            map_chunk_seconds_max=round(max(chunk_seconds), 3),
+            map_chunk_seconds_avg=round(sum(chunk_seconds) / len(chunk_seconds), 3),
+        )
+
+        if progress:
+            progress('reduce', 0, 1)
+        analysis, rounds = _reduce(prompt, notes, budget, temperature, stream=stream)
+        timings['reduce_seconds'] = round(time.monotonic() - mapped, 3)
+        timings['reduce_rounds'] = rounds + 1
+
+    timings['total_seconds'] = round(time.monotonic() - started, 3)
+    coverage['ratio'] = round(coverage['emails_analyzed'] / coverage['emails_available'], 4) if emails else 1.0
+    return {'analysis': analysis, 'coverage': coverage, 'timings': timings}
+
+
+def iter_stream(response):
+    """Yield ('reasoning' | 'content', text) pieces of a streamed answer.
+
+    Closing the generator early closes the HTTP connection, which stops
+    the model generating the rest.
+    """
+    try:
+        for chunk in response:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            reasoning = getattr(delta, 'reasoning_content', None)
+            if reasoning:
+                yield 'reasoning', reasoning
+            if delta.content:
+                yield 'content', delta.content
+    finally:
+        response.response.close()
+
+
+def cache_key(emails, prompt, system_prompt, temperature, collapse_duplicates=None):
+    """llm_cache key for analysing exactly these emails with these settings."""
+    return llm_cache.make_key(
+        [email['id'] for email in emails],
+        prompt=prompt,
+        system_prompt=system_prompt,
+        temperature=temperature,
+        map_model=LLM_MAP_MODEL,
+        reduce_model=LLM_REDUCE_MODEL,
+        chunk_tokens=LLM_CHUNK_TOKENS,
+        collapse_duplicates=LLM_COLLAPSE_DUPLICATES if collapse_duplicates is None else collapse_duplicates,
+    )
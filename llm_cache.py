@@ -0,0 +1,273 @@
+"""Two-tier cache for LLM analysis results.
+
+Keys are content-addressed: a SHA-256 of the exact set of email ids plus
+everything else that changes the answer (prompts, models, temperature,
+chunk size). A new email arriving in the window, or any change to the
+request, gives a new key, so a stale answer is never returned.
+
+Lookups try a small in-process LRU first (LLM_CACHE_MEMORY_ENTRIES per
+worker) and then the llm_cache table, which every worker shares. Entries
+expire after LLM_CACHE_TTL seconds. A purge removes expired rows and then
+the least recently used ones beyond LLM_CACHE_MAX_ROWS. It runs on a
+background thread every LLM_CACHE_PURGE_INTERVAL seconds, in one worker at
+a time, and can also be run by hand:
+
+    python llm_cache.py --purge
+    python llm_cache.py --stats
+"""
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import db
+
+LLM_CACHE_TTL = int(os.environ.get('LLM_CACHE_TTL', 86400))
+LLM_CACHE_MEMORY_ENTRIES = int(os.environ.get('LLM_CACHE_MEMORY_ENTRIES', 128))
+LLM_CACHE_MAX_ROWS = int(os.environ.get('LLM_CACHE_MAX_ROWS', 5000))
+LLM_CACHE_PURGE_INTERVAL = int(os.environ.get('LLM_CACHE_PURGE_INTERVAL', 3600))
+
+# Bump to invalidate every entry after a change to what is cached
+KEY_VERSION = 1
+# Held while purging so workers do not purge concurrently
+PURGE_LOCK_ID = 0x6c6c6d63
+
+SCHEMA_SQL = '''
+    CREATE TABLE IF NOT EXISTS llm_cache (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        expires_at TIMESTAMP NOT NULL,
+        last_hit_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        hits INTEGER NOT NULL DEFAULT 0
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_llm_cache_expires ON llm_cache(expires_at);
+    CREATE INDEX IF NOT EXISTS idx_llm_cache_last_hit ON llm_cache(last_hit_at);
+
+    -- Replaced by llm_cache; its keys cannot be mapped to the new ones
+    DROP TABLE IF EXISTS cache;
+'''
+
+_memory = OrderedDict()
+_memory_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {
+    'memory_hits': 0,
+    'db_hits': 0,
+    'misses': 0,
+    'puts': 0,
+    'memory_evictions': 0,
+    'purged_expired': 0,
+    'purged_overflow': 0,
+    'errors': 0,
+    'get_seconds_total': 0.0,
+    'get_seconds_max': 0.0,
+}
+_purger_thread = None
+_purger_pid = None
+
+
+def install(cur):
+    """Create the llm_cache table and drop the old unbounded cache table."""
+    cur.execute(SCHEMA_SQL)
+
+
+def _record(**changes):
+    with _stats_lock:
+        for key, value in changes.items():
+            if key == 'get_seconds_max':
+                _stats[key] = max(_stats[key], value)
+            else:
+                _stats[key] += value
+
+
+def make_key(email_ids, **params):
+    """Key for an answer over exactly ``email_ids`` with the given request parameters."""
+    payload = json.dumps({
+        'version': KEY_VERSION,
+        'emails': sorted(set(email_ids)),
+        'params': params,
+    }, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _memory_get(key):
+    with _memory_lock:
+        entry = _memory.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires <= time.time():
+            del _memory[key]
+            return None
+        _memory.move_to_end(key)
+        return value
+
+
+def _memory_put(key, value, expires):
+    evicted = 0
+    with _memory_lock:
+        _memory[key] = (value, expires)
+        _memory.move_to_end(key)
+        while len(_memory) > LLM_CACHE_MEMORY_ENTRIES:
+            _memory.popitem(last=False)
+            evicted += 1
+    if evicted:
+        _record(memory_evictions=evicted)
+
+
+def get(key):
+    """The cached value for ``key``, or None."""
+    start = time.monotonic()
+    value = _memory_get(key)
+    if value is not None:
+        elapsed = time.monotonic() - start
+        _record(memory_hits=1, get_seconds_total=elapsed, get_seconds_max=elapsed)
+        return value
+
+    row = None
+    try:
+        with db.connection() as conn:
+            cur = conn.cursor()
+            # One round trip: the hit is recorded for LRU eviction as it is read
+            cur.execute('''
+                UPDATE llm_cache
+                SET last_hit_at = NOW(), hits = hits + 1
+                WHERE key = %s AND expires_at > NOW()
+                RETURNING value, EXTRACT(EPOCH FROM expires_at - NOW())
+            ''', (key,))
+            row = cur.fetchone()
+            conn.commit()
+            cur.close()
+    except Exception as e:
+        # A cache failure should cost a recomputation, not the request
+        print(f"Error reading LLM cache: {str(e)}")
+        _record(errors=1)
+
+    elapsed = time.monotonic() - start
+    if row is None:
+        _record(misses=1, get_seconds_total=elapsed, get_seconds_max=elapsed)
+        return None
+    value = json.loads(row[0])
+    _memory_put(key, value, time.time() + float(row[1]))
+    _record(db_hits=1, get_seconds_total=elapsed, get_seconds_max=elapsed)
+    return value
+
+
+def put(key, value, ttl=LLM_CACHE_TTL):
+    """Store ``value`` (JSON-serializable) under ``key`` in both tiers."""
+    _memory_put(key, value, time.time() + ttl)
+    try:
+        with db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute('''
+                INSERT INTO llm_cache (key, value, created_at, expires_at, last_hit_at)
+                VALUES (%s, %s, NOW(), NOW() + %s * INTERVAL '1 second', NOW())
+                ON CONFLICT (key) DO UPDATE
+                SET value = EXCLUDED.value,
+                    created_at = EXCLUDED.created_at,
+                    expires_at = EXCLUDED.expires_at,
+                    last_hit_at = EXCLUDED.last_hit_at
+            ''', (key, json.dumps(value), ttl))
+            conn.commit()
+            cur.close()
+    except Exception as e:
+        print(f"Error writing LLM cache: {str(e)}")
+        _record(errors=1)
+        return
+    _record(puts=1)
+
+
+def purge(max_rows=LLM_CACHE_MAX_ROWS):
+    """Delete expired rows, then the least recently used beyond ``max_rows``.
+
+    Returns (expired, overflow) row counts, or None if another process is
+    already purging.
+    """
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT pg_try_advisory_xact_lock(%s)', (PURGE_LOCK_ID,))
+        if not cur.fetchone()[0]:
+            conn.rollback()
+            cur.close()
+            return None
+        cur.execute('DELETE FROM llm_cache WHERE expires_at <= NOW()')
+        expired = cur.rowcount
+        cur.execute('''
+            DELETE FROM llm_cache
+            WHERE key IN (
+                SELECT key FROM llm_cache
+                ORDER BY last_hit_at DESC
+                OFFSET %s
+            )
+        ''', (max_rows,))
+        overflow = cur.rowcount
+        conn.commit()
+        cur.close()
+    _record(purged_expired=expired, purged_overflow=overflow)
+    return expired, overflow
+
+
+def _run_purger():
+    while True:
+        time.sleep(LLM_CACHE_PURGE_INTERVAL)
+        try:
+            result = purge()
+            if result and any(result):
+                print(f"LLM cache purge: {result[0]} expired, {result[1]} over the {LLM_CACHE_MAX_ROWS}-row limit")
+        except Exception as e:
+            print(f"Error purging LLM cache: {str(e)}")
+
+
+def start_purger():
+    """Start the periodic purge on a daemon thread (once per process)."""
+    global _purger_thread, _purger_pid
+    if _purger_thread is not None and _purger_pid == os.getpid() and _purger_thread.is_alive():
+        return _purger_thread
+    _purger_pid = os.getpid()
+    _purger_thread = threading.Thread(target=_run_purger, name='llm-cache-purger', daemon=True)
+    _purger_thread.start()
+    return _purger_thread
+
+
+def stats():
+    """Hit/miss/latency counters for this process, plus the shared table size."""
+    with _stats_lock:
+        counters = dict(_stats)
+    with _memory_lock:
+        memory_entries = len(_memory)
+    lookups = counters['memory_hits'] + counters['db_hits'] + counters['misses']
+    counters.update({
+        'pid': os.getpid(),
+        'memory_entries': memory_entries,
+        'memory_capacity': LLM_CACHE_MEMORY_ENTRIES,
+        'hit_ratio': round((counters['memory_hits'] + counters['db_hits']) / lookups, 4) if lookups else None,
+        'get_seconds_avg': round(counters['get_seconds_total'] / lookups, 6) if lookups else None,
+    })
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT COUNT(*), COUNT(*) FILTER (WHERE expires_at <= NOW()) FROM llm_cache')
+        rows, expired = cur.fetchone()
+        cur.close()
+    counters.update({'db_rows': rows, 'db_expired_rows': expired, 'db_max_rows': LLM_CACHE_MAX_ROWS})
+    return counters
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Purge or inspect the LLM result cache.')
+    parser.add_argument('--purge', action='store_true', help='delete expired and least recently used rows now')
+    parser.add_argument('--stats', action='store_true', help='print the table size')
+    args = parser.parse_args()
+
+    if args.purge:
+        result = purge()
+        if result is None:
+            print("Another process is purging the cache")
+        else:
+            print(f"Purged {result[0]} expired and {result[1]} least recently used rows")
+    else:
+        print(json.dumps(stats(), indent=2))
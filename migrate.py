@@ -0,0 +1,412 @@
+"""Versioned database migrations, run once per deploy.
+
+The schema is built by the ordered steps in MIGRATIONS. Each applied step
+is recorded in schema_version, so a step runs once per database: the
+source seed data and inbox consolidations no longer re-run (and lock
+email_sources) on every boot, and nothing probes information_schema.
+
+Steps are idempotent (IF NOT EXISTS, ON CONFLICT) so a step interrupted
+before it was recorded can simply run again. Most run in a transaction;
+index builds on the big tables use CREATE INDEX CONCURRENTLY outside one,
+so ingest keeps writing while they build. A session advisory lock makes
+concurrent runs (two deploys, workers with MIGRATE_ON_START) wait for each
+other instead of migrating at the same time.
+
+    python migrate.py apply     # apply pending steps (the default)
+    python migrate.py status    # list steps and when each was applied
+    python migrate.py check     # exit non-zero if any step is pending
+
+Web workers only read the latest applied version at startup (one query) and
+warn if it is behind SCHEMA_VERSION. Set MIGRATE_ON_START=true to apply
+pending steps on boot instead.
+
+To change the schema, append a step with the next version number; never
+edit or renumber a step that has shipped.
+"""
+import argparse
+import os
+import sys
+import time
+
+from psycopg2.extras import execute_values
+
+import db
+import dedupe
+import jobs
+import link_index
+import llm_cache
+import rollups
+import search
+import source_catalog
+import spam_scoring
+import work_queue
+
+MIGRATE_ON_START = os.environ.get('MIGRATE_ON_START', 'false').lower() == 'true'
+
+# Held for the whole run; other migrators block on it
+MIGRATION_LOCK_ID = 0x6d696772  # "migr"
+
+VERSION_SQL = '''
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        duration_seconds DOUBLE PRECISION
+    );
+'''
+
+# Display names from the sources spreadsheet, by source id
+SOURCE_DISPLAY_NAMES = {
+    1: "InvestorPlace - Free",
+    2: "Marketbeat - Free",
+    3: "Weiss Ratings - Free",
+    4: "Brownstone Research - Free",
+    5: "Wyatt Research - Free",
+    6: "Banyan Hill - Free",
+    7: "Tim Sykes - Paid",
+    8: "Tim Sykes - Paid",
+    9: "Banyan Hill - Free",
+    10: "Paradigm Press - Free",
+    11: "Paradigm Press - Free",
+    12: "Angel Pub - Wealth Daily - Free",
+    13: "Angel Pub - Energy Capital - Free",
+    14: "Agora - MoneyMorning - Free",
+    15: "Tradesmith - Free",
+    16: "Daily Strike Alliance - Free",
+    17: "Tradesmith - Free",
+    18: "Tradesmith - Free",
+    19: "Widemoat Research - Free",
+    20: "Paradigm Press - Free",
+    21: "Paradigm Press - Free",
+    22: "Marketbeat - Free",
+    23: "Southbank Research (UK) - AI Collision - Free",
+    24: "Fat Tail Research (AUS) - Free",
+    25: "Agora France - Free",
+    26: "Omnia Research - Opportunistic Trader - Free",
+    27: "Porter and Co - Free",
+    28: "Oxford Club - Comunique - Paid",
+    29: "Oxford Club - Comunique - Paid",
+    30: "Teeka Tiwari - Free",
+    31: "Weiss Ratings - Free",
+    32: "Paradigm Press - Free",
+}
+
+# Indexes on emails and email_terms: (name, definition)
+EMAIL_INDEXES = (
+    ('idx_emails_source_date', 'ON emails(source_id, received_at DESC)'),
+    # Keyset pagination on (received_at, id), see pagination.py
+    ('idx_emails_received_id', 'ON emails(received_at DESC, id DESC)'),
+    ('idx_emails_enrichment_pending', 'ON emails(id) WHERE enrichment_pending'),
+    ('idx_email_terms_received', 'ON email_terms(received_at)'),
+    ('idx_email_terms_source_received', 'ON email_terms(source_id, received_at)'),
+)
+
+
+def create_index_concurrently(cur, name, definition):
+    """Build an index without blocking writes (needs an autocommit connection).
+
+    A failed concurrent build leaves an INVALID index behind, which IF NOT
+    EXISTS would then skip; such an index is dropped and built again.
+    Returns True if the index was built.
+    """
+    cur.execute('''
+        SELECT i.indisvalid
+        FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid
+        WHERE c.relname = %s
+    ''', (name,))
+    row = cur.fetchone()
+    if row and row[0]:
+        return False
+    if row:
+        print(f"Rebuilding invalid index {name}")
+        cur.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+    print(f"Building index {name}...")
+    cur.execute(f'CREATE INDEX CONCURRENTLY {name} {definition}')
+    return True
+
+
+def _base_tables(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS email_sources (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL,
+            email_address TEXT NOT NULL UNIQUE,
+            description TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            display_name TEXT,
+            parent_id INTEGER NULL REFERENCES email_sources(id),
+            hidden BOOLEAN DEFAULT FALSE
+        );
+
+        CREATE TABLE IF NOT EXISTS emails (
+            id SERIAL PRIMARY KEY,
+            source_id INTEGER REFERENCES email_sources(id),
+            to_address TEXT,
+            from_address TEXT,
+            subject TEXT,
+            body_text TEXT,
+            body_html TEXT,
+            urls TEXT[],
+            received_at TIMESTAMP,
+            processed BOOLEAN DEFAULT FALSE,
+            spam_score FLOAT
+        );
+
+        -- Columns added after the first deploys
+        ALTER TABLE emails ADD COLUMN IF NOT EXISTS processed BOOLEAN DEFAULT FALSE;
+        ALTER TABLE emails ADD COLUMN IF NOT EXISTS spam_score FLOAT;
+        ALTER TABLE email_sources ADD COLUMN IF NOT EXISTS display_name TEXT;
+        ALTER TABLE email_sources ADD COLUMN IF NOT EXISTS parent_id INTEGER NULL REFERENCES email_sources(id);
+        ALTER TABLE email_sources ADD COLUMN IF NOT EXISTS hidden BOOLEAN DEFAULT FALSE;
+
+        CREATE INDEX IF NOT EXISTS idx_sources_email ON email_sources(email_address);
+    ''')
+
+
+def _email_columns(cur):
+    cur.execute('''
+        -- Enrichment bookkeeping for async ingest (see enrichment.py)
+        ALTER TABLE emails ADD COLUMN IF NOT EXISTS enrichment_pending BOOLEAN NOT NULL DEFAULT FALSE;
+        ALTER TABLE emails ADD COLUMN IF NOT EXISTS enrichment_claimed_at TIMESTAMP;
+        ALTER TABLE emails ADD COLUMN IF NOT EXISTS enrichment_attempts INTEGER NOT NULL DEFAULT 0;
+
+        -- Summary metrics stored at ingest; plain_text holds the text extracted
+        -- from body_html for emails without a text part
+        ALTER TABLE emails ADD COLUMN IF NOT EXISTS subject_length INTEGER;
+        ALTER TABLE emails ADD COLUMN IF NOT EXISTS word_count INTEGER;
+        ALTER TABLE emails ADD COLUMN IF NOT EXISTS link_count INTEGER;
+        ALTER TABLE emails ADD COLUMN IF NOT EXISTS plain_text TEXT;
+
+        -- Prompt tokens per email, filled in the first time it is analysed (see llm_analysis.py)
+        ALTER TABLE emails ADD COLUMN IF NOT EXISTS token_count INTEGER;
+    ''')
+
+
+def _support_tables(cur):
+    cur.execute('''
+        -- Per-email word cloud term counts (see term_index.py)
+        CREATE TABLE IF NOT EXISTS email_terms (
+            email_id INTEGER NOT NULL REFERENCES emails(id) ON DELETE CASCADE,
+            source_id INTEGER,
+            received_at TIMESTAMP,
+            term TEXT NOT NULL,
+            term_count INTEGER NOT NULL,
+            PRIMARY KEY (email_id, term)
+        );
+
+        -- Pre-rendered word cloud images (see wordcloud_cache.py)
+        CREATE TABLE IF NOT EXISTS wordcloud_images (
+            name TEXT PRIMARY KEY,
+            png BYTEA NOT NULL,
+            etag TEXT NOT NULL,
+            data_version TEXT,
+            generated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    ''')
+
+
+def _seed_sources(cur):
+    rows = [(source_id, name) for source_id, name in SOURCE_DISPLAY_NAMES.items()]
+    # Existing sources only get a display name they are missing
+    execute_values(cur, '''
+        UPDATE email_sources AS s SET display_name = v.display_name
+        FROM (VALUES %s) AS v(id, display_name)
+        WHERE s.id = v.id AND (s.display_name IS NULL OR s.display_name = '')
+    ''', rows)
+    # Placeholder addresses are replaced when the source's first email arrives.
+    # A source may already own an address under another id, so any conflict
+    # (id or email_address) skips the row rather than failing the step
+    execute_values(cur, '''
+        INSERT INTO email_sources (id, name, email_address, display_name)
+        VALUES %s
+        ON CONFLICT DO NOTHING
+    ''', [(source_id, name, f"source{source_id}@mailfoxes.com", name) for source_id, name in rows])
+    # Explicit ids do not advance the sequence; keep new sources clear of them
+    cur.execute('''
+        SELECT setval(pg_get_serial_sequence('email_sources', 'id'), MAX(id))
+        FROM email_sources
+        HAVING MAX(id) > COALESCE(pg_sequence_last_value(pg_get_serial_sequence('email_sources', 'id')::regclass), 0)
+    ''')
+
+
+def _consolidate_sources(cur):
+    cur.execute('''
+        -- Marketbeat duplicates (2 and 22)
+        UPDATE email_sources SET parent_id = 2, hidden = TRUE WHERE id = 22;
+        -- Banyan Hill duplicates (6 and 9)
+        UPDATE email_sources SET parent_id = 6, hidden = TRUE WHERE id = 9;
+        -- Tradesmith duplicates (15, 17 and 18)
+        UPDATE email_sources SET parent_id = 17, hidden = TRUE WHERE id IN (15, 18);
+        -- Paradigm Press inboxes (10, 11, 20, 21 and 32)
+        UPDATE email_sources SET parent_id = 10, hidden = TRUE WHERE id IN (11, 20, 21, 32);
+        -- Weiss Ratings duplicates (3 and 31)
+        UPDATE email_sources SET parent_id = 3, hidden = TRUE WHERE id = 31;
+        -- Paid sources
+        UPDATE email_sources SET hidden = TRUE WHERE id IN (7, 8, 28, 29);
+    ''')
+
+
+def _email_indexes(cur):
+    for name, definition in EMAIL_INDEXES + search.INDEXES + work_queue.INDEXES:
+        create_index_concurrently(cur, name, definition)
+    cur.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")
+    if cur.fetchone()[0]:
+        for name, definition in search.TRIGRAM_INDEXES:
+            create_index_concurrently(cur, name, definition)
+
+
+def _spam_indexes(cur):
+    for name, definition in spam_scoring.INDEXES:
+        create_index_concurrently(cur, name, definition)
+
+
+def _token_count_trigger(cur):
+    cur.execute('''
+        -- A stored count is only good for the text it was made from; any write
+        -- that changes the entry (e.g. the plain_text backfill) clears it
+        CREATE OR REPLACE FUNCTION emails_token_count_reset() RETURNS trigger AS $$
+        BEGIN
+            IF NEW.token_count IS NOT DISTINCT FROM OLD.token_count AND (
+                    NEW.subject IS DISTINCT FROM OLD.subject
+                    OR NEW.from_address IS DISTINCT FROM OLD.from_address
+                    OR NEW.received_at IS DISTINCT FROM OLD.received_at
+                    OR NEW.body_text IS DISTINCT FROM OLD.body_text
+                    OR NEW.plain_text IS DISTINCT FROM OLD.plain_text) THEN
+                NEW.token_count := NULL;
+            END IF;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS emails_token_count_reset ON emails;
+        CREATE TRIGGER emails_token_count_reset
+            BEFORE UPDATE OF subject, from_address, received_at, body_text, plain_text ON emails
+            FOR EACH ROW EXECUTE PROCEDURE emails_token_count_reset();
+    ''')
+
+
+# (version, name, step(cur), transactional)
+MIGRATIONS = [
+    (1, 'email_sources and emails tables', _base_tables, True),
+    (2, 'enrichment, metrics and token count columns on emails', _email_columns, True),
+    (3, 'dashboard rollup tables and triggers', rollups.install, True),
+    (4, 'full-text search column and trigger', search.install, True),
+    (5, 'email_sources change notifications', source_catalog.install, True),
+    (6, 'work queue lease columns', work_queue.install, True),
+    (7, 'email_terms and wordcloud_images tables', _support_tables, True),
+    (8, 'llm_cache table', llm_cache.install, True),
+    (9, 'analysis_jobs table', jobs.install, True),
+    (10, 'seed email sources', _seed_sources, True),
+    (11, 'inbox consolidations', _consolidate_sources, True),
+    (12, 'emails and email_terms indexes', _email_indexes, False),
+    (13, 'display_html column and email_urls table', link_index.install, True),
+    (14, 'spam_models table and spam_scorer column', spam_scoring.install, True),
+    (15, 'spam score memo table and spam_pending column', spam_scoring.install_memo, True),
+    (16, 'deferred spam score index', _spam_indexes, False),
+    (17, 'canonical_id column and email_fingerprints table', dedupe.install, True),
+    (18, 'token_count reset trigger', _token_count_trigger, True),
+    (19, 'statement-level rollup triggers', rollups.install_statement_triggers, True),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def _applied(cur):
+    cur.execute('SELECT version, name, applied_at, duration_seconds FROM schema_version ORDER BY version')
+    return {row[0]: row[1:] for row in cur.fetchall()}
+
+
+def migrate():
+    """Apply pending migrations in order. Returns the versions applied."""
+    applied_now = []
+    with db.connection() as conn:
+        conn.autocommit = True
+        cur = conn.cursor()
+        try:
+            cur.execute('SELECT pg_advisory_lock(%s)', (MIGRATION_LOCK_ID,))
+            try:
+                cur.execute(VERSION_SQL)
+                # Read after taking the lock: another run may have just finished
+                applied = _applied(cur)
+                for version, name, step, transactional in MIGRATIONS:
+                    if version in applied:
+                        continue
+                    print(f"Applying migration {version}: {name}")
+                    start = time.monotonic()
+                    conn.autocommit = not transactional
+                    step(cur)
+                    cur.execute('''
+                        INSERT INTO schema_version (version, name, duration_seconds) VALUES (%s, %s, %s)
+                    ''', (version, name, round(time.monotonic() - start, 3)))
+                    if transactional:
+                        conn.commit()
+                        conn.autocommit = True
+                    applied_now.append(version)
+            finally:
+                if not conn.autocommit:
+                    conn.rollback()
+                    conn.autocommit = True
+                cur.execute('SELECT pg_advisory_unlock(%s)', (MIGRATION_LOCK_ID,))
+        finally:
+            cur.close()
+            conn.autocommit = False
+    print(f"Schema is at version {SCHEMA_VERSION} ({len(applied_now)} migrations applied)")
+    return applied_now
+
+
+def status():
+    """[(version, name, applied_at or None, duration_seconds or None)] for every step."""
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+        applied = _applied(cur) if cur.fetchone()[0] else {}
+        cur.close()
+    rows = []
+    for version, name, _, _ in MIGRATIONS:
+        _, applied_at, duration = applied.get(version, (None, None, None))
+        rows.append((version, name, applied_at, duration))
+    return rows
+
+
+def current_version():
+    """The highest migration recorded in the database (0 if never migrated)."""
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+        if not cur.fetchone()[0]:
+            cur.close()
+            return 0
+        cur.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+        version = cur.fetchone()[0]
+        cur.close()
+    return version
+
+
+def check():
+    """Warn (without failing) if the database schema is behind this code. Returns True if current."""
+    try:
+        version = current_version()
+    except Exception as e:
+        print(f"Could not read the schema version: {str(e)}")
+        return False
+    if version < SCHEMA_VERSION:
+        print(f"Database schema is at version {version}, this code expects {SCHEMA_VERSION}: "
+              f"run python migrate.py")
+        return False
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Apply or inspect the database migrations.')
+    parser.add_argument('command', nargs='?', default='apply', choices=('apply', 'status', 'check'),
+                        help='apply pending migrations (default), list them, or exit 1 if any is pending')
+    args = parser.parse_args()
+
+    if args.command == 'status':
+        for version, name, applied_at, duration in status():
+            state = f"applied {applied_at:%Y-%m-%d %H:%M:%S} ({duration or 0:.1f}s)" if applied_at else 'pending'
+            print(f"{version:3d}  {name:55s}  {state}")
+    elif args.command == 'check':
+        sys.exit(0 if check() else 1)
+    else:
+        migrate()
@@ -0,0 +1,29 @@
+"""Run CPU-bound work off the gevent hub.
+
+Under the gevent worker (see gunicorn.conf.py) threading is monkey-patched,
+so background "threads" are greenlets on the same OS thread as every
+request: a second spent rendering a word cloud, building a spam feature
+matrix or parsing HTML stalls all requests and event-stream heartbeats in
+the process. run() hands such work to the hub's pool of native threads and
+parks only the calling greenlet. Outside gevent it just calls the function.
+
+Offloaded functions must not use the database: under gevent psycopg2 waits
+through the hub, which belongs to the worker's main thread.
+"""
+import sys
+
+
+def under_gevent():
+    """True when this process runs with gevent's threading patches."""
+    if 'gevent' not in sys.modules:
+        return False
+    from gevent import monkey
+    return monkey.is_module_patched('threading')
+
+
+def run(function, *args, **kwargs):
+    """Return function(*args, **kwargs), computed on a native thread under gevent."""
+    if under_gevent():
+        import gevent
+        return gevent.get_hub().threadpool.apply(function, args, kwargs)
+    return function(*args, **kwargs)
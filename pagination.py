@@ -0,0 +1,108 @@
+"""Keyset pagination, cheap totals and narrow projections for list pages.
+
+Pages are addressed by an opaque cursor holding the sort key of the last
+(or first) row shown, so fetching page 1000 is the same index range scan as
+page 1 instead of an OFFSET that reads and discards every earlier row. The
+sort key always ends in the primary key so it is unique.
+
+Totals come from the caller's cheapest exact source when there is one (see
+rollups.count_emails); otherwise rows are counted up to COUNT_LIMIT and
+anything larger is shown as the planner's estimate.
+
+List pages select EMAIL_LIST_COLUMNS, the summary columns stored at ingest,
+never the bodies: body_html is often hundreds of KB per email. Bodies
+(EMAIL_BODY_COLUMNS) are read one email at a time when it is opened.
+"""
+import base64
+import json
+
+COUNT_LIMIT = 1000
+
+# Columns of ``emails e`` that list rows render
+EMAIL_LIST_COLUMNS = ', '.join(f'e.{column}' for column in (
+    'id', 'source_id', 'from_address', 'subject', 'received_at',
+    'subject_length', 'word_count', 'link_count', 'spam_score', 'canonical_id',
+))
+# display_html is body_html with its links rewritten at ingest (see link_index.py)
+EMAIL_BODY_COLUMNS = ('e.body_text, COALESCE(e.display_html, e.body_html) AS body_html, '
+                      'e.display_html IS NOT NULL AS html_rendered, e.urls')
+
+
+def encode_cursor(values):
+    """Opaque, URL-safe token for a row's sort key."""
+    payload = json.dumps([v.isoformat() if hasattr(v, 'isoformat') else v for v in values])
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token, length):
+    """Return the sort key in ``token``, or None if it is missing or invalid."""
+    if not token:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except ValueError:
+        return None
+    if not isinstance(values, list) or len(values) != length:
+        return None
+    if not all(isinstance(v, (str, int, float)) for v in values):
+        return None
+    return values
+
+
+def keyset_query(select_sql, sort_columns, per_page, after=None, before=None, order_columns=None):
+    """Add keyset conditions, ORDER BY and LIMIT to a query.
+
+    ``select_sql`` is everything up to (not including) ORDER BY, with a WHERE
+    clause already present. ``sort_columns`` are SQL expressions, all sorted
+    descending; ``order_columns`` can name the same keys by output alias for
+    the ORDER BY. Returns (sql, params, reverse): one extra row is fetched to
+    tell whether another page exists, and rows must be reversed when paging
+    backwards (see page_rows).
+    """
+    columns = ', '.join(sort_columns)
+    order_columns = order_columns or sort_columns
+    placeholders = ', '.join(['%s'] * len(sort_columns))
+    params = []
+    sql = select_sql
+    if before is not None:
+        sql += f' AND ({columns}) > ({placeholders})'
+        params.extend(before)
+        order = ', '.join(f'{column} ASC' for column in order_columns)
+    else:
+        if after is not None:
+            sql += f' AND ({columns}) < ({placeholders})'
+            params.extend(after)
+        order = ', '.join(f'{column} DESC' for column in order_columns)
+    sql += f' ORDER BY {order} LIMIT {per_page + 1}'
+    return sql, params, before is not None
+
+
+def page_rows(rows, per_page, reverse):
+    """Trim the look-ahead row. Returns (rows, has_more_in_direction)."""
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if reverse:
+        rows.reverse()
+    return rows, has_more
+
+
+def bounded_count(cur, from_where_sql, params, limit=COUNT_LIMIT):
+    """Exact row count up to ``limit``; returns (count, exact).
+
+    Larger results fall back to the planner's row estimate, which costs no
+    more than planning the query.
+    """
+    cur.execute(f'SELECT COUNT(*) FROM (SELECT 1 {from_where_sql} LIMIT {limit + 1}) capped', params)
+    count = cur.fetchone()[0]
+    if count <= limit:
+        return count, True
+    return max(estimate_count(cur, from_where_sql, params), count), False
+
+
+def estimate_count(cur, from_where_sql, params):
+    """Planner row estimate for ``SELECT 1 <from_where_sql>``."""
+    cur.execute(f'EXPLAIN (FORMAT JSON) SELECT 1 {from_where_sql}', params)
+    plan = cur.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
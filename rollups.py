@@ -0,0 +1,367 @@
+"""Incrementally maintained rollups behind the home dashboard.
+
+Two small tables summarise the emails table:
+
+- email_daily_rollups: per day and source, the email count plus the sum and
+  count of non-null spam scores (for the all-time average). Emails whose
+  source was deleted are counted under source_id 0.
+- email_hourly_rollups: email count per day-of-week and hour-of-day bucket.
+
+Triggers on emails keep them current for every write path (webhook ingest,
+enrichment workers, backfills, source deletion), so the dashboard reads a few
+hundred rollup rows instead of scanning the whole corpus. They fire once per
+statement and read its transition tables (PostgreSQL 10+): a batch UPDATE
+of a thousand spam scores sums its changes per bucket and upserts each
+rollup row once, in key order, so concurrent batches do not deadlock on
+the hot rows the way per-row triggers did (migration 19 replaced those).
+
+The price is that a statement trigger cannot be limited to some columns:
+every UPDATE of emails captures its old and new rows and joins them, even
+one that only flips processed or a lease column. On 200k rows that join
+added about a sixth to a plain UPDATE. Writers that never touch
+received_at, source_id or spam_score (lease claims and acks, token counts,
+derived-column backfills) call skip() first, which makes the trigger
+return at once for the rest of their transaction; the row capture itself
+is cheap. A bulk job that does change those columns may skip too, as long
+as it runs rebuild() afterwards. Rollups can be checked against and
+rebuilt from the emails table:
+
+    python rollups.py --check
+    python rollups.py --rebuild
+"""
+import argparse
+from datetime import datetime, timedelta
+
+from psycopg2.extras import DictCursor
+
+import db
+
+# Migration 3, as shipped: the tables and the original per-row triggers
+SCHEMA_SQL = '''
+    CREATE TABLE IF NOT EXISTS email_daily_rollups (
+        day DATE NOT NULL,
+        source_id INTEGER NOT NULL,
+        email_count INTEGER NOT NULL DEFAULT 0,
+        spam_score_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+        spam_score_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, source_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS email_hourly_rollups (
+        day_of_week SMALLINT NOT NULL,
+        hour_of_day SMALLINT NOT NULL,
+        email_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day_of_week, hour_of_day)
+    );
+
+    CREATE OR REPLACE FUNCTION emails_rollup_apply(
+        p_received TIMESTAMP, p_source INTEGER, p_spam DOUBLE PRECISION,
+        p_sign INTEGER, p_hourly BOOLEAN
+    ) RETURNS void AS $$
+    BEGIN
+        IF p_received IS NULL THEN
+            RETURN;
+        END IF;
+
+        INSERT INTO email_daily_rollups (day, source_id, email_count, spam_score_sum, spam_score_count)
+        VALUES (
+            p_received::date,
+            COALESCE(p_source, 0),
+            p_sign,
+            COALESCE(p_spam, 0) * p_sign,
+            CASE WHEN p_spam IS NULL THEN 0 ELSE p_sign END
+        )
+        ON CONFLICT (day, source_id) DO UPDATE
+        SET email_count = email_daily_rollups.email_count + EXCLUDED.email_count,
+            spam_score_sum = email_daily_rollups.spam_score_sum + EXCLUDED.spam_score_sum,
+            spam_score_count = email_daily_rollups.spam_score_count + EXCLUDED.spam_score_count;
+
+        IF p_hourly THEN
+            INSERT INTO email_hourly_rollups (day_of_week, hour_of_day, email_count)
+            VALUES (EXTRACT(DOW FROM p_received), EXTRACT(HOUR FROM p_received), p_sign)
+            ON CONFLICT (day_of_week, hour_of_day) DO UPDATE
+            SET email_count = email_hourly_rollups.email_count + EXCLUDED.email_count;
+        END IF;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION emails_rollup_trigger() RETURNS trigger AS $$
+    DECLARE
+        moved BOOLEAN := TG_OP <> 'UPDATE' OR OLD.received_at IS DISTINCT FROM NEW.received_at;
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            PERFORM emails_rollup_apply(OLD.received_at, OLD.source_id, OLD.spam_score, -1, moved);
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            PERFORM emails_rollup_apply(NEW.received_at, NEW.source_id, NEW.spam_score, 1, moved);
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS emails_rollup_insert_delete ON emails;
+    CREATE TRIGGER emails_rollup_insert_delete
+        AFTER INSERT OR DELETE ON emails
+        FOR EACH ROW EXECUTE PROCEDURE emails_rollup_trigger();
+
+    DROP TRIGGER IF EXISTS emails_rollup_update ON emails;
+    CREATE TRIGGER emails_rollup_update
+        AFTER UPDATE OF received_at, source_id, spam_score ON emails
+        FOR EACH ROW
+        WHEN (OLD.received_at IS DISTINCT FROM NEW.received_at
+              OR OLD.source_id IS DISTINCT FROM NEW.source_id
+              OR OLD.spam_score IS DISTINCT FROM NEW.spam_score)
+        EXECUTE PROCEDURE emails_rollup_trigger();
+'''
+
+# Transaction-local setting that turns the triggers below into no-ops
+SKIP_SETTING = 'mailfoxes.skip_rollups'
+
+# Migration 19: statement-level triggers
+_TRIGGER_TEMPLATE = '''
+    -- Replaces the per-row triggers that migration 3 installed
+    DROP TRIGGER IF EXISTS emails_rollup_insert_delete ON emails;
+    DROP TRIGGER IF EXISTS emails_rollup_update ON emails;
+
+    CREATE OR REPLACE FUNCTION emails_rollup_trigger() RETURNS trigger AS $$
+    BEGIN
+        -- Set by skip() for writes that leave every rollup column alone
+        IF current_setting('{skip_setting}', true) = 'on' THEN
+            RETURN NULL;
+        END IF;
+        IF TG_OP = 'INSERT' THEN
+{insert}
+        ELSIF TG_OP = 'UPDATE' THEN
+{update}
+        ELSE
+{delete}
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS emails_rollup_insert ON emails;
+    CREATE TRIGGER emails_rollup_insert
+        AFTER INSERT ON emails
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE PROCEDURE emails_rollup_trigger();
+
+    CREATE TRIGGER emails_rollup_update
+        AFTER UPDATE ON emails
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE PROCEDURE emails_rollup_trigger();
+
+    DROP TRIGGER IF EXISTS emails_rollup_delete ON emails;
+    CREATE TRIGGER emails_rollup_delete
+        AFTER DELETE ON emails
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE PROCEDURE emails_rollup_trigger();
+
+    DROP FUNCTION IF EXISTS emails_rollup_apply(TIMESTAMP, INTEGER, DOUBLE PRECISION, INTEGER, BOOLEAN);
+'''
+
+# Rows a statement added (sign 1) or removed (sign -1), from its transition tables
+_INSERTED = 'SELECT received_at, source_id, spam_score, 1 AS sign FROM new_rows'
+_DELETED = 'SELECT received_at, source_id, spam_score, -1 AS sign FROM old_rows'
+# Only rows whose bucket or score changed; the rest would cancel out
+_UPDATED = '''SELECT c.* FROM old_rows o JOIN new_rows n ON n.id = o.id,
+                LATERAL (VALUES (o.received_at, o.source_id, o.spam_score, -1),
+                                (n.received_at, n.source_id, n.spam_score, 1))
+                    AS c(received_at, source_id, spam_score, sign)
+                WHERE o.received_at IS DISTINCT FROM n.received_at
+                   OR o.source_id IS DISTINCT FROM n.source_id
+                   OR o.spam_score IS DISTINCT FROM n.spam_score'''
+
+# One upsert per rollup table per statement, in key order, so concurrent
+# batch writers take the rollup row locks in the same order
+_APPLY_TEMPLATE = '''            INSERT INTO email_daily_rollups (day, source_id, email_count, spam_score_sum, spam_score_count)
+            SELECT received_at::date, COALESCE(source_id, 0), SUM(sign),
+                   SUM(COALESCE(spam_score, 0) * sign),
+                   SUM(CASE WHEN spam_score IS NULL THEN 0 ELSE sign END)
+            FROM ({changes}) AS changes
+            WHERE received_at IS NOT NULL
+            GROUP BY 1, 2
+            HAVING SUM(sign) <> 0 OR SUM(COALESCE(spam_score, 0) * sign) <> 0
+                OR SUM(CASE WHEN spam_score IS NULL THEN 0 ELSE sign END) <> 0
+            ORDER BY 1, 2
+            ON CONFLICT (day, source_id) DO UPDATE
+            SET email_count = email_daily_rollups.email_count + EXCLUDED.email_count,
+                spam_score_sum = email_daily_rollups.spam_score_sum + EXCLUDED.spam_score_sum,
+                spam_score_count = email_daily_rollups.spam_score_count + EXCLUDED.spam_score_count;
+
+            INSERT INTO email_hourly_rollups (day_of_week, hour_of_day, email_count)
+            SELECT EXTRACT(DOW FROM received_at), EXTRACT(HOUR FROM received_at), SUM(sign)
+            FROM ({changes}) AS changes
+            WHERE received_at IS NOT NULL
+            GROUP BY 1, 2
+            HAVING SUM(sign) <> 0
+            ORDER BY 1, 2
+            ON CONFLICT (day_of_week, hour_of_day) DO UPDATE
+            SET email_count = email_hourly_rollups.email_count + EXCLUDED.email_count;'''
+
+TRIGGER_SQL = _TRIGGER_TEMPLATE.format(
+    skip_setting=SKIP_SETTING,
+    insert=_APPLY_TEMPLATE.format(changes=_INSERTED),
+    update=_APPLY_TEMPLATE.format(changes=_UPDATED),
+    delete=_APPLY_TEMPLATE.format(changes=_DELETED),
+)
+
+REBUILD_SQL = '''
+    DELETE FROM email_daily_rollups;
+    DELETE FROM email_hourly_rollups;
+
+    INSERT INTO email_daily_rollups (day, source_id, email_count, spam_score_sum, spam_score_count)
+    SELECT received_at::date, COALESCE(source_id, 0), COUNT(*),
+           COALESCE(SUM(spam_score), 0), COUNT(spam_score)
+    FROM emails
+    WHERE received_at IS NOT NULL
+    GROUP BY received_at::date, COALESCE(source_id, 0);
+
+    INSERT INTO email_hourly_rollups (day_of_week, hour_of_day, email_count)
+    SELECT EXTRACT(DOW FROM received_at), EXTRACT(HOUR FROM received_at), COUNT(*)
+    FROM emails
+    WHERE received_at IS NOT NULL
+    GROUP BY 1, 2;
+'''
+
+
+def install(cur):
+    """Create the rollup tables and triggers, seeding them on first install."""
+    cur.execute("SELECT to_regclass('email_daily_rollups') IS NULL")
+    first_install = cur.fetchone()[0]
+    cur.execute(SCHEMA_SQL)
+    if first_install:
+        print("Building dashboard rollups from the emails table...")
+        rebuild(cur)
+
+
+def install_statement_triggers(cur):
+    """Swap the per-row rollup triggers for the statement-level ones."""
+    cur.execute(TRIGGER_SQL)
+
+
+def skip(cur):
+    """Turn the rollup triggers off for the rest of the caller's transaction.
+
+    Only for writes that never change received_at, source_id or spam_score
+    (leases, processed flags, derived-column backfills). A bulk job that
+    does change them and skips the triggers must call rebuild() afterwards.
+    """
+    cur.execute(f"SET LOCAL {SKIP_SETTING} = 'on'")
+
+
+def rebuild(cur):
+    """Recompute the rollups from scratch inside the caller's transaction."""
+    # Block concurrent writes so no trigger update is lost between the
+    # DELETE and the re-aggregation
+    cur.execute('LOCK TABLE emails IN SHARE MODE')
+    cur.execute(REBUILD_SQL)
+
+
+def get_dashboard_stats(cur, days=30):
+    """Return the home dashboard aggregates, read from the rollups only."""
+    cur.execute('''
+        SELECT COALESCE(SUM(email_count), 0) AS total_emails,
+               SUM(spam_score_sum) / NULLIF(SUM(spam_score_count), 0) AS avg_spam_score
+        FROM email_daily_rollups
+    ''')
+    totals = cur.fetchone()
+
+    since = (datetime.now() - timedelta(days=days)).date()
+    cur.execute('''
+        SELECT day, SUM(email_count) AS email_count
+        FROM email_daily_rollups
+        WHERE day >= %s
+        GROUP BY day
+        HAVING SUM(email_count) > 0
+        ORDER BY day
+    ''', (since,))
+    daily = cur.fetchall()
+
+    cur.execute('''
+        SELECT day_of_week, SUM(email_count) AS email_count
+        FROM email_hourly_rollups
+        GROUP BY day_of_week
+        ORDER BY day_of_week
+    ''')
+    day_of_week = cur.fetchall()
+
+    return {
+        'total_emails': int(totals['total_emails']),
+        'avg_spam_score': totals['avg_spam_score'],
+        'daily': daily,
+        'day_of_week': day_of_week,
+    }
+
+
+def count_emails(cur, source_ids=None, start_date=None, end_date=None):
+    """Exact email count for some sources and/or an inclusive date range, from the rollups.
+
+    Dates are 'YYYY-MM-DD' strings or dates; the rollups are per day, so
+    day-granular filters need no scan of the emails table.
+    """
+    query = 'SELECT COALESCE(SUM(email_count), 0) FROM email_daily_rollups WHERE TRUE'
+    params = []
+    if source_ids is not None:
+        query += ' AND source_id = ANY(%s)'
+        params.append(list(source_ids))
+    if start_date:
+        query += ' AND day >= %s::date'
+        params.append(start_date)
+    if end_date:
+        query += ' AND day <= %s::date'
+        params.append(end_date)
+    cur.execute(query, params)
+    return int(cur.fetchone()[0])
+
+
+def check():
+    """Compare the rollups with a fresh aggregate and return the mismatches."""
+    with db.connection() as conn:
+        cur = conn.cursor(cursor_factory=DictCursor)
+        cur.execute('''
+            WITH actual AS (
+                SELECT received_at::date AS day, COALESCE(source_id, 0) AS source_id,
+                       COUNT(*) AS email_count, COUNT(spam_score) AS spam_score_count
+                FROM emails
+                WHERE received_at IS NOT NULL
+                GROUP BY 1, 2
+            )
+            SELECT COALESCE(a.day, r.day) AS day,
+                   COALESCE(a.source_id, r.source_id) AS source_id,
+                   COALESCE(a.email_count, 0) AS actual_count,
+                   COALESCE(r.email_count, 0) AS rollup_count,
+                   COALESCE(a.spam_score_count, 0) AS actual_spam_count,
+                   COALESCE(r.spam_score_count, 0) AS rollup_spam_count
+            FROM actual a
+            FULL OUTER JOIN email_daily_rollups r
+              ON r.day = a.day AND r.source_id = a.source_id
+            WHERE COALESCE(a.email_count, 0) <> COALESCE(r.email_count, 0)
+               OR COALESCE(a.spam_score_count, 0) <> COALESCE(r.spam_score_count, 0)
+            ORDER BY 1, 2
+        ''')
+        mismatches = [dict(row) for row in cur.fetchall()]
+        cur.close()
+    return mismatches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check or rebuild the dashboard rollup tables.')
+    parser.add_argument('--rebuild', action='store_true', help='recompute the rollups from the emails table')
+    parser.add_argument('--check', action='store_true', help='report days/sources where the rollups disagree')
+    args = parser.parse_args()
+
+    if args.rebuild:
+        with db.connection() as conn:
+            cur = conn.cursor()
+            rebuild(cur)
+            conn.commit()
+            cur.close()
+        print("Rollups rebuilt")
+    else:
+        mismatches = check()
+        for row in mismatches:
+            print(f"{row['day']} source {row['source_id']}: "
+                  f"{row['rollup_count']} rolled up vs {row['actual_count']} emails, "
+                  f"{row['rollup_spam_count']} vs {row['actual_spam_count']} spam scores")
+        print(f"{len(mismatches)} mismatched day/source buckets")
@@ -0,0 +1,196 @@
+"""Full-text keyword search for the inbox.
+
+Every email carries a search_vector: its subject (weight A) and body
+(weight B; the extracted plain text for HTML-only emails) run through the
+English text-search configuration. A trigger keeps it current on insert and
+whenever the subject or body changes, and a GIN index answers keyword
+queries without reading any bodies. Subjects also get a trigram index, so
+plain substring matches ("vid" in "nvidia") on the subject stay indexed.
+
+The inbox keyword_type modes map onto the vector's weights:
+
+- subject: subject words, or the keyword anywhere in the subject
+- body: body words only
+- all: subject or body words, or the keyword anywhere in the subject
+
+Results are ranked with ts_rank_cd and each row gets a highlighted snippet.
+Emails stored before the column existed are indexed with:
+
+    python search.py --backfill
+"""
+import argparse
+import time
+
+from markupsafe import Markup, escape
+
+import db
+import rollups
+
+CONFIG = 'english'
+# to_tsvector refuses documents over 1MB; bodies are cut well below that
+MAX_BODY_CHARS = 200000
+KEYWORD_TYPES = ('subject', 'body', 'all')
+
+SCHEMA_SQL = f'''
+    ALTER TABLE emails ADD COLUMN IF NOT EXISTS search_vector tsvector;
+
+    CREATE OR REPLACE FUNCTION emails_search_vector(p_subject TEXT, p_body TEXT)
+    RETURNS tsvector AS $$
+        SELECT setweight(to_tsvector('{CONFIG}', COALESCE(p_subject, '')), 'A') ||
+               setweight(to_tsvector('{CONFIG}', LEFT(COALESCE(p_body, ''), {MAX_BODY_CHARS})), 'B')
+    $$ LANGUAGE sql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION emails_search_vector_trigger() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector := emails_search_vector(NEW.subject, COALESCE(NEW.body_text, NEW.plain_text));
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS emails_search_vector_update ON emails;
+    CREATE TRIGGER emails_search_vector_update
+        BEFORE INSERT OR UPDATE OF subject, body_text, plain_text ON emails
+        FOR EACH ROW EXECUTE PROCEDURE emails_search_vector_trigger();
+'''
+
+TRIGRAM_SQL = 'CREATE EXTENSION IF NOT EXISTS pg_trgm;'
+
+# Built with CREATE INDEX CONCURRENTLY by migrate.py: (name, definition)
+INDEXES = (
+    ('idx_emails_search_vector', 'ON emails USING GIN (search_vector)'),
+)
+# Only when pg_trgm is installed
+TRIGRAM_INDEXES = (
+    ('idx_emails_subject_trgm', 'ON emails USING GIN (subject gin_trgm_ops)'),
+)
+
+BACKFILL_SQL = '''
+    UPDATE emails
+    SET search_vector = emails_search_vector(subject, COALESCE(body_text, plain_text))
+    WHERE id > %s AND id <= %s AND search_vector IS NULL
+'''
+
+# ts_headline markers; the snippet is HTML-escaped before they become <mark>
+_START_SEL = '\x02'
+_STOP_SEL = '\x03'
+_HEADLINE_OPTIONS = f'StartSel={_START_SEL}, StopSel={_STOP_SEL}, MaxFragments=2, MaxWords=18, MinWords=6'
+
+
+def install(cur):
+    """Create the search column and trigger, and pg_trgm if possible (indexes: see INDEXES)."""
+    cur.execute(SCHEMA_SQL)
+
+    # pg_trgm may not be available to this database user; substring matches
+    # on the subject still work without it, just unindexed (no TRIGRAM_INDEXES)
+    cur.execute('SAVEPOINT search_trigram')
+    try:
+        cur.execute(TRIGRAM_SQL)
+        cur.execute('RELEASE SAVEPOINT search_trigram')
+    except Exception as e:
+        cur.execute('ROLLBACK TO SAVEPOINT search_trigram')
+        print(f"pg_trgm not installed: {str(e)}")
+
+
+def keyword_filter(keyword, keyword_type='subject', alias='e'):
+    """Return (where_sql, params) matching ``keyword`` in the given mode.
+
+    The SQL references the query as ``websearch_to_tsquery(...)`` so the
+    planner can use the GIN index; params are in placeholder order.
+    """
+    if keyword_type not in KEYWORD_TYPES:
+        keyword_type = 'all'
+    query = f"websearch_to_tsquery('{CONFIG}', %s)"
+    substring = f"{alias}.subject ILIKE %s"
+    pattern = '%' + keyword.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+    if keyword_type == 'subject':
+        # The index narrows the candidates, ts_filter keeps subject matches
+        sql = (f"(({alias}.search_vector @@ {query} AND ts_filter({alias}.search_vector, '{{a}}') @@ {query})"
+               f" OR {substring})")
+        return sql, [keyword, keyword, pattern]
+    if keyword_type == 'body':
+        sql = f"({alias}.search_vector @@ {query} AND ts_filter({alias}.search_vector, '{{b}}') @@ {query})"
+        return sql, [keyword, keyword]
+    sql = f"({alias}.search_vector @@ {query} OR {substring})"
+    return sql, [keyword, pattern]
+
+
+def rank_expression(alias='e'):
+    """SQL ranking expression for ORDER BY; takes the keyword as one param.
+
+    ts_rank_cd returns float4; the cast makes the value a page cursor carries
+    (a Python float through JSON) compare equal to the row it came from.
+    """
+    return f"ts_rank_cd({alias}.search_vector, websearch_to_tsquery('{CONFIG}', %s))::float8"
+
+
+def add_snippets(cur, emails, keyword):
+    """Set email['snippet'] to a highlighted excerpt for each email dict.
+
+    Only the rows already on the page are headlined, so ts_headline never
+    runs over the whole result set.
+    """
+    ids = [email['id'] for email in emails]
+    if not ids or not keyword:
+        return emails
+
+    cur.execute(f'''
+        SELECT id, ts_headline('{CONFIG}',
+                               LEFT(COALESCE(body_text, plain_text, ''), {MAX_BODY_CHARS}),
+                               websearch_to_tsquery('{CONFIG}', %s),
+                               %s) AS snippet
+        FROM emails
+        WHERE id = ANY(%s)
+    ''', (keyword, _HEADLINE_OPTIONS, ids))
+    snippets = {row[0]: row[1] for row in cur.fetchall()}
+
+    for email in emails:
+        snippet = snippets.get(email['id'])
+        if snippet and _START_SEL in snippet:
+            email['snippet'] = highlight(snippet)
+        else:
+            email['snippet'] = None
+    return emails
+
+
+def highlight(headline):
+    """Escape a ts_headline result and turn its markers into <mark> tags."""
+    text = str(escape(' '.join(headline.split())))
+    return Markup(text.replace(_START_SEL, '<mark>').replace(_STOP_SEL, '</mark>'))
+
+
+def backfill(batch_size=1000):
+    """Compute search_vector for emails that do not have one yet."""
+    total = 0
+    last_id = 0
+    start = time.monotonic()
+    while True:
+        with db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT MAX(id) FROM (SELECT id FROM emails WHERE id > %s ORDER BY id LIMIT %s) batch",
+                        (last_id, batch_size))
+            batch_end = cur.fetchone()[0]
+            if batch_end is None:
+                cur.close()
+                break
+            rollups.skip(cur)
+            cur.execute(BACKFILL_SQL, (last_id, batch_end))
+            total += cur.rowcount
+            conn.commit()
+            cur.close()
+        last_id = batch_end
+        print(f"Indexed {total} emails up to id {last_id} ({total / (time.monotonic() - start):.0f}/s)")
+    print(f"Search backfill complete: {total} emails indexed")
+    return total
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Maintain the inbox full-text search index.')
+    parser.add_argument('--backfill', action='store_true', help='index emails stored before search_vector existed')
+    parser.add_argument('--batch-size', type=int, default=1000, help='emails per UPDATE (default 1000)')
+    args = parser.parse_args()
+
+    if args.backfill:
+        backfill(batch_size=args.batch_size)
+    else:
+        parser.print_help()
@@ -0,0 +1,209 @@
+"""In-process catalog of email sources.
+
+Every page used to re-read email_sources, and the webhook looked its source
+up by address on each delivery. The table is small and changes rarely, so
+each process keeps the whole thing in memory: rows by id, the parent/child
+tree and an address-to-id map.
+
+A statement trigger on email_sources runs pg_notify('email_sources_changed')
+on every write, whatever code path made it. Each process LISTENs on a
+dedicated connection and drops its copy when a notification arrives, so
+gunicorn workers on every node see additions, deletions and consolidations
+within moments. The writing process also invalidates its own copy right
+after committing, and every copy is reloaded after SOURCE_CATALOG_MAX_AGE
+seconds in case the listener connection was down.
+
+A reload needs a database connection. Code that already holds one passes
+it as ``conn`` to the lookups below, so a cold catalog never makes a
+request wait on a second connection from the pool it is holding one of.
+"""
+import os
+import select
+import threading
+import time
+
+import psycopg2
+from psycopg2.extras import DictCursor
+
+import db
+
+CHANNEL = 'email_sources_changed'
+# Safety net if notifications are missed while the listener reconnects
+SOURCE_CATALOG_MAX_AGE = float(os.environ.get('SOURCE_CATALOG_MAX_AGE', 300))
+
+SCHEMA_SQL = f'''
+    CREATE OR REPLACE FUNCTION email_sources_notify() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('{CHANNEL}', TG_OP);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS email_sources_changed ON email_sources;
+    CREATE TRIGGER email_sources_changed
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON email_sources
+        FOR EACH STATEMENT EXECUTE PROCEDURE email_sources_notify();
+'''
+
+_lock = threading.Lock()
+_catalog = None
+# Bumped by invalidate() so a load that raced with a change is not kept
+_generation = 0
+_listener_thread = None
+_listener_pid = None
+
+
+class SourceCatalog:
+    """Immutable snapshot of email_sources."""
+
+    def __init__(self, rows):
+        self.loaded_at = time.monotonic()
+        self.by_id = {row['id']: row for row in rows}
+        self.by_address = {row['email_address']: row['id'] for row in rows if row['email_address']}
+        self.children = {}
+        for row in rows:
+            if row['parent_id'] is not None:
+                self.children.setdefault(row['parent_id'], []).append(row['id'])
+        # Same order the pages have always listed sources in
+        self.visible = sorted(
+            (row for row in rows if not row['hidden']),
+            key=lambda row: (row['display_name'] is None,
+                             (row['display_name'] or '').casefold(), (row['name'] or '').casefold()),
+        )
+
+    def descendant_ids(self, source_id):
+        """``source_id`` followed by every source below it in the tree."""
+        ids = [source_id]
+        seen = {source_id}
+        for current in ids:
+            for child in self.children.get(current, ()):
+                if child not in seen:
+                    seen.add(child)
+                    ids.append(child)
+        return ids
+
+    def root_id(self, source_id):
+        """The topmost ancestor of ``source_id`` (itself if it has no parent)."""
+        seen = {source_id}
+        row = self.by_id.get(source_id)
+        while row is not None and row['parent_id'] is not None and row['parent_id'] not in seen:
+            source_id = row['parent_id']
+            seen.add(source_id)
+            row = self.by_id.get(source_id)
+        return source_id
+
+
+def install(cur):
+    """Create the change-notification trigger on email_sources."""
+    cur.execute(SCHEMA_SQL)
+
+
+def _read(conn):
+    cur = conn.cursor(cursor_factory=DictCursor)
+    cur.execute('SELECT * FROM email_sources')
+    rows = [dict(row) for row in cur.fetchall()]
+    cur.close()
+    return rows
+
+
+def load(conn=None):
+    """Read email_sources into a new catalog.
+
+    Pass the connection a caller already holds: checking out a second one
+    while holding the first can exhaust the pool when many requests find
+    the catalog cold at once.
+    """
+    if conn is not None:
+        return SourceCatalog(_read(conn))
+    with db.connection() as conn:
+        return SourceCatalog(_read(conn))
+
+
+def get_catalog(conn=None):
+    """Return the current catalog, reloading it (on ``conn`` if given) if invalidated or too old."""
+    global _catalog
+    catalog = _catalog
+    if catalog is not None and time.monotonic() - catalog.loaded_at < SOURCE_CATALOG_MAX_AGE:
+        return catalog
+    generation = _generation
+    catalog = load(conn)
+    with _lock:
+        if generation == _generation:
+            _catalog = catalog
+    return catalog
+
+
+def invalidate():
+    """Drop this process's copy; the next lookup reloads it."""
+    global _catalog, _generation
+    with _lock:
+        _generation += 1
+        _catalog = None
+
+
+def visible_sources(conn=None):
+    """Non-hidden sources as dicts, ordered by display name then name."""
+    return [dict(row) for row in get_catalog(conn).visible]
+
+
+def get_source(source_id, conn=None):
+    row = get_catalog(conn).by_id.get(source_id)
+    return dict(row) if row else None
+
+
+def source_id_for_address(email_address, conn=None):
+    return get_catalog(conn).by_address.get(email_address)
+
+
+def descendant_ids(source_id, conn=None):
+    """The source and all of its children, grandchildren, etc."""
+    return get_catalog(conn).descendant_ids(source_id)
+
+
+def root_id(source_id, conn=None):
+    """The top of the consolidation tree ``source_id`` belongs to."""
+    return get_catalog(conn).root_id(source_id)
+
+
+def _listen_forever():
+    backoff = 1
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(db.get_database_url())
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cur = conn.cursor()
+            cur.execute(f'LISTEN {CHANNEL}')
+            # Anything may have changed while we were not listening
+            invalidate()
+            backoff = 1
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    # Quiet for a minute: make sure the connection is still alive
+                    cur.execute('SELECT 1')
+                    continue
+                conn.poll()
+                if conn.notifies:
+                    conn.notifies.clear()
+                    invalidate()
+        except Exception as e:
+            print(f"Source catalog listener error: {str(e)}")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+        finally:
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+
+
+def start_listener():
+    """Start the LISTEN thread for this process (once per pid)."""
+    global _listener_thread, _listener_pid
+    if _listener_thread is not None and _listener_pid == os.getpid() and _listener_thread.is_alive():
+        return _listener_thread
+    _listener_pid = os.getpid()
+    _listener_thread = threading.Thread(target=_listen_forever, name='source-catalog-listener', daemon=True)
+    _listener_thread.start()
+    return _listener_thread
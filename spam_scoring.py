@@ -0,0 +1,813 @@
+"""Spam scoring engines.
+
+Scores are on the SpamAssassin scale the remote spamcheck service returns
+(around 5 and above is spam), so scores from either engine can be compared
+and averaged on the dashboard. SPAM_SCORER picks the engine:
+
+- "auto" (the default) is "local" once a model has been trained and
+  "remote" until then, so deploying this module does not replace the
+  stored scores with uncalibrated rule sums.
+- "local" scores in-process. Every message is turned into a
+  row of a NumPy feature matrix: hits for the rules in RULES, a few numeric
+  features and hashed subject/body word counts. With a trained model the
+  scores for a whole batch are one matrix-vector product; until a model is
+  trained, the rule weights are summed instead.
+- "remote" sends each message to the spamcheck service, as before, on
+  SPAM_REMOTE_WORKERS threads. A failed call raises, and the front-end
+  below defers the email instead of storing a score.
+
+Every stored score records the engine version that produced it in
+emails.spam_scorer (NULL for scores stored before the column existed, all
+from the remote service). The model is a ridge regression fitted to the
+stored scores that did not come from the local scorer, so a retrain never
+learns from its own predictions, and is kept in the spam_models table;
+workers reload it every SPAM_MODEL_REFRESH seconds.
+
+    python spam_scoring.py --train [--rows 20000]   # fit and store a model, then report
+    python spam_scoring.py --report                 # compare with the stored scores
+
+Other engines can be added with register_scorer(name, factory); a scorer
+needs a score_batch(messages) method returning a list of floats and a
+version() string that changes whenever its scores would.
+
+Callers go through score_batch()/score(), a front-end over the engine:
+
+- Memo: the same newsletter is often delivered to several inboxes. Each
+  message is hashed (the raw message the scorer sees, minus the To header,
+  plus the HTML) together with the engine version, and scores are reused
+  from the spam_score_memo table.
+- Deadline: each engine call (up to SPAM_SCORE_CHUNK messages) must finish
+  within SPAM_SCORE_TIMEOUT seconds. A late call cannot be stopped, so at
+  most as many calls as the call pool has threads may be running at once;
+  past that, chunks are deferred rather than queued. Callers that can wait
+  (the backfill, which paces its own calls) pass timeout=None and the
+  engine is called directly.
+- Circuit breaker: after SPAM_BREAKER_FAILURES failed or late calls in a row
+  the engine is not called for SPAM_BREAKER_COOLDOWN seconds, then one trial
+  call decides whether it is healthy again. Messages that could not be
+  scored get None instead of a made-up 0; their emails are stored with
+  spam_pending = TRUE and rescored by a background retrier every
+  SPAM_RETRY_INTERVAL seconds (or python spam_scoring.py --retry). The
+  retrier leases a batch (spam_claimed_at) and commits before scoring, so
+  no row lock or connection is held while the engine runs.
+
+    python spam_scoring.py --retry    # score deferred emails now
+    python spam_scoring.py --stats    # memo hit rate, breaker state, deferred queue depth
+"""
+import argparse
+import hashlib
+import io
+import json
+import math
+import os
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from psycopg2.extras import DictCursor, execute_values
+
+import db
+import offload
+import rollups
+
+SPAM_SCORER = os.environ.get('SPAM_SCORER', 'auto')
+SPAM_REMOTE_WORKERS = int(os.environ.get('SPAM_REMOTE_WORKERS', 8))
+SPAM_MODEL_REFRESH = int(os.environ.get('SPAM_MODEL_REFRESH', 600))
+SPAM_SCORE_TIMEOUT = float(os.environ.get('SPAM_SCORE_TIMEOUT', 10))
+SPAM_SCORE_CHUNK = int(os.environ.get('SPAM_SCORE_CHUNK', 25))
+SPAM_BREAKER_FAILURES = int(os.environ.get('SPAM_BREAKER_FAILURES', 3))
+SPAM_BREAKER_COOLDOWN = float(os.environ.get('SPAM_BREAKER_COOLDOWN', 60))
+SPAM_RETRY_INTERVAL = int(os.environ.get('SPAM_RETRY_INTERVAL', 60))
+SPAM_RETRY_BATCH = int(os.environ.get('SPAM_RETRY_BATCH', 100))
+SPAM_RETRY_LEASE_SECONDS = int(os.environ.get('SPAM_RETRY_LEASE_SECONDS', 600))
+
+# Bump when the features change; models trained on other features are ignored
+FEATURE_VERSION = 1
+HASH_FEATURES = 1024
+RIDGE_ALPHA = 1.0
+# Score from which an email counts as spam in the calibration report
+SPAM_THRESHOLD = 5.0
+
+SCHEMA_SQL = '''
+    CREATE TABLE IF NOT EXISTS spam_models (
+        id SERIAL PRIMARY KEY,
+        feature_version INTEGER NOT NULL,
+        weights BYTEA NOT NULL,
+        trained_rows INTEGER NOT NULL,
+        report JSONB,
+        created_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+
+    -- Engine version that wrote spam_score (see score_batch); NULL before this column
+    ALTER TABLE emails ADD COLUMN IF NOT EXISTS spam_scorer TEXT;
+'''
+
+MEMO_SCHEMA_SQL = '''
+    CREATE TABLE IF NOT EXISTS spam_score_memo (
+        content_hash TEXT PRIMARY KEY,
+        scorer TEXT NOT NULL,
+        score DOUBLE PRECISION NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+
+    -- Emails whose scoring was deferred while the scorer was unhealthy
+    ALTER TABLE emails ADD COLUMN IF NOT EXISTS spam_pending BOOLEAN NOT NULL DEFAULT FALSE;
+    -- Lease taken by retry_deferred; expired leases are claimed again
+    ALTER TABLE emails ADD COLUMN IF NOT EXISTS spam_claimed_at TIMESTAMP;
+'''
+
+# (name, definition), built concurrently by migrate.py
+INDEXES = (
+    ('idx_emails_spam_pending', 'ON emails(id) WHERE spam_pending'),
+)
+
+# (name, field, pattern, weight): weights are used only until a model is trained
+RULES = [
+    ('subject_exclamation', 'subject', r'!', 0.5),
+    ('subject_money', 'subject', r'\$\s?\d|\d+\s?%|\bfree\b', 1.0),
+    ('subject_all_caps_word', 'subject', r'(?-i:\b[A-Z]{4,}\b)', 0.5),
+    ('subject_re_fwd', 'subject', r'^\s*(re|fwd?):', -0.5),
+    ('urgency', 'text', r'\b(act now|limited time|urgent|expires? (today|tonight|soon)|last chance|final notice)\b', 1.0),
+    ('money_claims', 'text', r'\b(guaranteed?|risk[- ]free|double your|get rich|\d+x (returns?|gains?)|millionaire)\b', 1.5),
+    ('free_offer', 'text', r'\bfree\b', 0.5),
+    ('click_here', 'text', r'\bclick here\b', 0.5),
+    ('unsubscribe', 'text', r'\bunsubscribe\b', -0.5),
+    ('url_shortener', 'html', r'https?://(bit\.ly|tinyurl\.com|t\.co|ow\.ly|goo\.gl|is\.gd)/', 1.0),
+    ('url_ip_address', 'html', r'https?://\d{1,3}(\.\d{1,3}){3}', 2.0),
+    ('html_hidden_text', 'html', r'display\s*:\s*none|font-size\s*:\s*[01]px', 1.0),
+]
+_COMPILED_RULES = [(name, field, re.compile(pattern, re.IGNORECASE | re.DOTALL), weight)
+                   for name, field, pattern, weight in RULES]
+NUMERIC_FEATURES = ('log_length', 'log_links', 'log_images', 'caps_ratio', 'exclamation_density', 'html_only')
+
+_WORD = re.compile(r"[a-z][a-z']{2,}")
+_TAG = re.compile(r'<[^>]+>')
+_URL = re.compile(r'https?://', re.IGNORECASE)
+_IMAGE = re.compile(r'<img\b', re.IGNORECASE)
+
+_scorers = {}
+_instances = {}
+_instances_lock = threading.Lock()
+# Engine calls run here so a late one can be abandoned at its deadline;
+# the semaphore counts calls still running, abandoned ones included
+SPAM_CALL_THREADS = 4
+_call_executor = ThreadPoolExecutor(max_workers=SPAM_CALL_THREADS, thread_name_prefix='spam-score')
+_call_slots = threading.BoundedSemaphore(SPAM_CALL_THREADS)
+_stats_lock = threading.Lock()
+_stats = {
+    'memo_hits': 0,
+    'scored': 0,
+    'deferred': 0,
+    'timeouts': 0,
+    'failures': 0,
+    'retried': 0,
+}
+_retrier_thread = None
+_retrier_pid = None
+
+
+def install(cur):
+    """Create the spam_models table and the spam_scorer column on emails."""
+    cur.execute(SCHEMA_SQL)
+
+
+def install_memo(cur):
+    """Create the score memo table and the spam_pending/spam_claimed_at columns on emails."""
+    cur.execute(MEMO_SCHEMA_SQL)
+
+
+def build_raw_email(from_addr, to_addr, subject, text_body):
+    """Reconstruct the raw message format the remote scorer expects."""
+    return f"From: {from_addr}\nTo: {to_addr}\nSubject: {subject}\n\n{text_body}"
+
+
+def _fields(message):
+    subject = message.get('subject') or ''
+    html = message.get('body_html') or ''
+    text = message.get('body_text') or _TAG.sub(' ', html)
+    return {'subject': subject, 'text': f"{subject}\n{text}", 'html': html or text}
+
+
+def feature_matrix(messages):
+    """An (n, d) float32 matrix: rule hits, numeric features, hashed word counts."""
+    import numpy as np
+
+    rule_count, numeric_count = len(_COMPILED_RULES), len(NUMERIC_FEATURES)
+    offset = rule_count + numeric_count
+    matrix = np.zeros((len(messages), offset + HASH_FEATURES), dtype=np.float32)
+    for row, message in enumerate(messages):
+        fields = _fields(message)
+        for column, (_, field, pattern, _) in enumerate(_COMPILED_RULES):
+            if pattern.search(fields[field]):
+                matrix[row, column] = 1.0
+
+        text = fields['text']
+        letters = [c for c in fields['subject'] if c.isalpha()]
+        matrix[row, rule_count:offset] = (
+            math.log1p(len(text)),
+            math.log1p(len(_URL.findall(fields['html']))),
+            math.log1p(len(_IMAGE.findall(fields['html']))),
+            sum(c.isupper() for c in letters) / len(letters) if letters else 0.0,
+            1000.0 * text.count('!') / (len(text) + 1),
+            0.0 if message.get('body_text') else 1.0,
+        )
+
+        # Hashed bag of words, log-scaled and normalised to unit length
+        counts = Counter(zlib.crc32(word.encode()) % HASH_FEATURES for word in _WORD.findall(text.lower()))
+        if counts:
+            columns = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+            values = np.log1p(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+            matrix[row, offset + columns] = values / np.linalg.norm(values)
+    return matrix
+
+
+def rule_weights():
+    import numpy as np
+
+    weights = np.zeros(len(_COMPILED_RULES) + len(NUMERIC_FEATURES) + HASH_FEATURES, dtype=np.float32)
+    weights[:len(_COMPILED_RULES)] = [weight for _, _, _, weight in _COMPILED_RULES]
+    return weights
+
+
+def fit(matrix, scores, alpha=RIDGE_ALPHA):
+    """Ridge regression weights (intercept last) for ``matrix`` -> ``scores``."""
+    import numpy as np
+
+    scores = np.asarray(scores, dtype=np.float64)
+    width = matrix.shape[1] + 1
+    gram = alpha * np.eye(width)
+    gram[-1, -1] = 0.0  # the intercept is not shrunk
+    target = np.zeros(width)
+    # Accumulated in slices so the float64 copy never holds every row at once
+    for start in range(0, matrix.shape[0], 5000):
+        chunk = matrix[start:start + 5000].astype(np.float64)
+        x = np.hstack([chunk, np.ones((len(chunk), 1))])
+        gram += x.T @ x
+        target += x.T @ scores[start:start + 5000]
+    return np.linalg.solve(gram, target).astype(np.float32)
+
+
+def predict(matrix, weights):
+    return matrix @ weights[:-1] + weights[-1]
+
+
+def _local_scores(messages, weights):
+    matrix = feature_matrix(messages)
+    if weights is None:
+        scores = matrix @ rule_weights()
+    else:
+        scores = predict(matrix, weights)
+    return [round(float(score), 3) for score in scores]
+
+
+def load_model():
+    """(id, weights) of the newest stored model for the current features, or (None, None)."""
+    import numpy as np
+
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            SELECT id, weights FROM spam_models
+            WHERE feature_version = %s
+            ORDER BY id DESC LIMIT 1
+        ''', (FEATURE_VERSION,))
+        row = cur.fetchone()
+        cur.close()
+    if row is None:
+        return None, None
+    weights = np.load(io.BytesIO(bytes(row[1])))
+    if weights.shape[0] != len(rule_weights()) + 1:
+        return None, None
+    return row[0], weights
+
+
+def save_model(weights, trained_rows, report):
+    import numpy as np
+
+    buffer = io.BytesIO()
+    np.save(buffer, weights)
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            INSERT INTO spam_models (feature_version, weights, trained_rows, report)
+            VALUES (%s, %s, %s, %s)
+            RETURNING id
+        ''', (FEATURE_VERSION, buffer.getvalue(), trained_rows, json.dumps(report)))
+        model_id = cur.fetchone()[0]
+        # Scores memoized under the previous model are never looked up again
+        cur.execute("DELETE FROM spam_score_memo WHERE scorer LIKE 'local:%%'")
+        conn.commit()
+        cur.close()
+    return model_id
+
+
+class LocalScorer:
+    """Rules plus the trained model, scored a batch at a time."""
+
+    def __init__(self, refresh=SPAM_MODEL_REFRESH):
+        self.refresh = refresh
+        self._model_id = None
+        self._weights = None
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def weights(self):
+        with self._lock:
+            if self._loaded_at is None or time.monotonic() - self._loaded_at > self.refresh:
+                try:
+                    self._model_id, self._weights = load_model()
+                except Exception as e:
+                    # Keep the model we have (or the rules) until the next refresh
+                    print(f"Error loading spam model: {str(e)}")
+                if self._weights is None and self._loaded_at is None:
+                    print("No trained spam model (python spam_scoring.py --train)")
+                self._loaded_at = time.monotonic()
+            return self._weights
+
+    def version(self):
+        self.weights()
+        return f"local:{FEATURE_VERSION}:{self._model_id or 'rules'}"
+
+    def score_batch(self, messages):
+        if not messages:
+            return []
+        # Loads the model from the database, so not on the offloaded thread
+        weights = self.weights()
+        return offload.run(_local_scores, messages, weights)
+
+
+class RemoteScorer:
+    """The spamcheck service, one call per message."""
+
+    def __init__(self, workers=SPAM_REMOTE_WORKERS, rate_limit=None):
+        from backfill import RateLimiter
+        self.workers = workers
+        self.limiter = RateLimiter(rate_limit)
+
+    def score(self, message):
+        self.limiter.wait()
+        raw_email = build_raw_email(message.get('from_address'), message.get('to_address'),
+                                    message.get('subject'), message.get('body_text') or '')
+        try:
+            import spamcheck
+        except ImportError:
+            raise RuntimeError("spamcheck library not installed. Install with: pip install spamcheck")
+        # We only need the score, not the full report. Failures propagate to
+        # the front-end, which defers the email instead of scoring it 0
+        return spamcheck.check(raw_email, report=False)['score']
+
+    def version(self):
+        return 'remote'
+
+    def score_batch(self, messages):
+        if len(messages) <= 1:
+            return [self.score(message) for message in messages]
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(messages))) as executor:
+            return list(executor.map(self.score, messages))
+
+
+class AutoScorer:
+    """The local scorer when a trained model exists, the remote service otherwise."""
+
+    def current(self):
+        local = get_scorer('local')
+        return local if local.weights() is not None else get_scorer('remote')
+
+    def version(self):
+        return self.current().version()
+
+    def score_batch(self, messages):
+        return self.current().score_batch(messages)
+
+
+def register_scorer(name, factory):
+    """Make ``factory(**options)`` available as SPAM_SCORER=``name``."""
+    _scorers[name] = factory
+
+
+register_scorer('local', LocalScorer)
+register_scorer('remote', RemoteScorer)
+register_scorer('auto', AutoScorer)
+
+
+def get_scorer(name=None):
+    """The shared scorer instance for ``name`` (default SPAM_SCORER)."""
+    name = name or SPAM_SCORER
+    if name not in _scorers:
+        raise ValueError(f"Unknown spam scorer: {name} (choose from {', '.join(sorted(_scorers))})")
+    with _instances_lock:
+        if name not in _instances:
+            _instances[name] = _scorers[name]()
+        return _instances[name]
+
+
+def resolve(scorer=None):
+    """The engine that will score now: ``scorer`` (a name or instance), with "auto" resolved.
+
+    Callers storing scores record ``resolve(...).version()`` in
+    emails.spam_scorer and pass the same engine to score_batch().
+    """
+    engine = scorer if hasattr(scorer, 'score_batch') else get_scorer(scorer)
+    return engine.current() if hasattr(engine, 'current') else engine
+
+
+class CircuitBreaker:
+    """Stop calling a failing engine for a while, then let one trial call through."""
+
+    def __init__(self, failures=SPAM_BREAKER_FAILURES, cooldown=SPAM_BREAKER_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self._consecutive = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if self._trial or time.monotonic() - self._opened_at >= self.cooldown:
+                return 'half-open'
+            return 'open'
+
+    def ready(self):
+        """Whether a call would be allowed now (without claiming the trial)."""
+        return self.state() != 'open'
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial or time.monotonic() - self._opened_at < self.cooldown:
+                return False
+            self._trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self._consecutive = 0
+            self._opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self._consecutive += 1
+            if self._trial or self._consecutive >= self.failures:
+                if self._opened_at is None or self._trial:
+                    print(f"Spam scorer unhealthy after {self._consecutive} failed calls; "
+                          f"deferring scoring for {self.cooldown:.0f}s")
+                self._opened_at = time.monotonic()
+                self._trial = False
+
+
+_breaker = CircuitBreaker()
+
+
+def _record(**changes):
+    with _stats_lock:
+        for key, value in changes.items():
+            _stats[key] += value
+
+
+def content_hash(message, version):
+    """Memo key: the engine version, the raw message without its To header, and the HTML."""
+    raw_email = build_raw_email(message.get('from_address'), '', message.get('subject'),
+                                message.get('body_text') or '')
+    payload = f"{version}\n{raw_email}\n{message.get('body_html') or ''}"
+    return hashlib.sha256(payload.encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+def _memo_get(hashes):
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT content_hash, score FROM spam_score_memo WHERE content_hash = ANY(%s)',
+                    (list(hashes),))
+        known = dict(cur.fetchall())
+        cur.close()
+    return known
+
+
+def _memo_put(version, scores):
+    with db.connection() as conn:
+        cur = conn.cursor()
+        execute_values(cur, '''
+            INSERT INTO spam_score_memo (content_hash, scorer, score)
+            VALUES %s
+            ON CONFLICT (content_hash) DO NOTHING
+        ''', [(key, version, value) for key, value in scores.items()])
+        conn.commit()
+        cur.close()
+
+
+def _call(engine, messages, timeout):
+    """engine.score_batch(messages), abandoned after ``timeout`` seconds (None waits)."""
+    if timeout is None:
+        return engine.score_batch(messages)
+    if not _call_slots.acquire(blocking=False):
+        raise FutureTimeout(f"{SPAM_CALL_THREADS} earlier calls are still running")
+    try:
+        future = _call_executor.submit(engine.score_batch, messages)
+    except Exception:
+        _call_slots.release()
+        raise
+    future.add_done_callback(lambda _: _call_slots.release())
+    return future.result(timeout=timeout)
+
+
+def score_batch(messages, scorer=None, timeout=SPAM_SCORE_TIMEOUT, breaker=_breaker):
+    """Scores for a list of message dicts (subject, body_text, body_html, from/to_address).
+
+    ``scorer`` is an engine name (default SPAM_SCORER) or a scorer instance.
+    ``timeout`` is the deadline per engine call of up to SPAM_SCORE_CHUNK
+    messages (None to wait however long it takes); ``breaker`` is the
+    CircuitBreaker guarding the engine (None to call it regardless).
+    A message gets None when the engine failed, timed out or is behind an
+    open circuit breaker; the caller stores it as deferred.
+    """
+    if not messages:
+        return []
+    engine = resolve(scorer)
+    version = engine.version()
+    hashes = [content_hash(message, version) for message in messages]
+    try:
+        known = _memo_get(set(hashes))
+    except Exception as e:
+        print(f"Error reading spam score memo: {str(e)}")
+        known = {}
+
+    # Copies within the batch are scored once
+    pending = {}
+    for key, message in zip(hashes, messages):
+        if key not in known:
+            pending.setdefault(key, message)
+
+    scored = {}
+    items = list(pending.items())
+    for start in range(0, len(items), SPAM_SCORE_CHUNK):
+        if breaker is not None and not breaker.allow():
+            break
+        chunk = items[start:start + SPAM_SCORE_CHUNK]
+        try:
+            results = _call(engine, [message for _, message in chunk], timeout)
+        except FutureTimeout as e:
+            # An empty message is the deadline passing; otherwise no slot was free
+            print(f"Spam scorer busy: {e}" if str(e) else
+                  f"Spam scorer took more than {timeout:g}s for {len(chunk)} emails")
+            _record(timeouts=1)
+            if breaker is not None:
+                breaker.failure()
+            continue
+        except Exception as e:
+            print(f"Error checking spam score: {str(e)}")
+            _record(failures=1)
+            if breaker is not None:
+                breaker.failure()
+            continue
+        if breaker is not None:
+            breaker.success()
+        scored.update((key, float(result)) for (key, _), result in zip(chunk, results))
+
+    if scored:
+        try:
+            _memo_put(version, scored)
+        except Exception as e:
+            print(f"Error writing spam score memo: {str(e)}")
+
+    scores = [known.get(key, scored.get(key)) for key in hashes]
+    deferred = sum(value is None for value in scores)
+    _record(memo_hits=len(messages) - len(pending), scored=len(scored), deferred=deferred)
+    return scores
+
+
+def score(message, scorer=None):
+    return score_batch([message], scorer)[0]
+
+
+def _claim_deferred(limit):
+    """Lease up to ``limit`` deferred emails and return them."""
+    with db.connection() as conn:
+        cur = conn.cursor(cursor_factory=DictCursor)
+        rollups.skip(cur)
+        cur.execute('''
+            UPDATE emails
+            SET spam_claimed_at = NOW()
+            WHERE id IN (
+                SELECT id FROM emails
+                WHERE spam_pending
+                  AND (spam_claimed_at IS NULL OR spam_claimed_at < NOW() - %s * INTERVAL '1 second')
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, from_address, to_address, subject, body_text, body_html
+        ''', (SPAM_RETRY_LEASE_SECONDS, limit))
+        rows = sorted((dict(row) for row in cur.fetchall()), key=lambda row: row['id'])
+        conn.commit()
+        cur.close()
+    return rows
+
+
+def retry_deferred(limit=SPAM_RETRY_BATCH):
+    """Score up to ``limit`` deferred emails. Returns (claimed, scored).
+
+    The rows are leased and committed first; scoring runs with no database
+    connection held, and emails still unscored are released for the next run.
+    """
+    if not _breaker.ready():
+        return 0, 0
+    rows = _claim_deferred(limit)
+    if not rows:
+        return 0, 0
+    engine = resolve()
+    version = engine.version()
+    scores = score_batch(rows, engine)
+    values = [(row['id'], value, version) for row, value in zip(rows, scores) if value is not None]
+    unscored = [row['id'] for row, value in zip(rows, scores) if value is None]
+    with db.connection() as conn:
+        cur = conn.cursor()
+        if values:
+            execute_values(cur, '''
+                UPDATE emails AS e
+                SET spam_score = v.spam_score, spam_scorer = v.spam_scorer,
+                    spam_pending = FALSE, spam_claimed_at = NULL
+                FROM (VALUES %s) AS v(id, spam_score, spam_scorer)
+                WHERE e.id = v.id AND e.spam_pending
+            ''', values, template='(%s, %s::float, %s::text)')
+        if unscored:
+            cur.execute('UPDATE emails SET spam_claimed_at = NULL WHERE id = ANY(%s)', (unscored,))
+        conn.commit()
+        cur.close()
+    _record(retried=len(values))
+    return len(rows), len(values)
+
+
+def _run_retrier():
+    while True:
+        time.sleep(SPAM_RETRY_INTERVAL)
+        try:
+            # Drain while whole batches are being scored
+            while True:
+                claimed, scored = retry_deferred()
+                if scored:
+                    print(f"Scored {scored} of {claimed} deferred emails")
+                if claimed < SPAM_RETRY_BATCH or scored < claimed:
+                    break
+        except Exception as e:
+            print(f"Error retrying deferred spam scores: {str(e)}")
+
+
+def start_retrier():
+    """Start the deferred-score retrier on a daemon thread (once per process)."""
+    global _retrier_thread, _retrier_pid
+    if _retrier_thread is not None and _retrier_pid == os.getpid() and _retrier_thread.is_alive():
+        return _retrier_thread
+    _retrier_pid = os.getpid()
+    _retrier_thread = threading.Thread(target=_run_retrier, name='spam-retrier', daemon=True)
+    _retrier_thread.start()
+    return _retrier_thread
+
+
+def stats():
+    """Memo hit rate, engine health and the deferred queue, for this process."""
+    with _stats_lock:
+        counters = dict(_stats)
+    lookups = counters['memo_hits'] + counters['scored'] + counters['deferred']
+    counters.update({
+        'pid': os.getpid(),
+        'scorer': SPAM_SCORER,
+        'engine': resolve().version(),
+        'memo_hit_ratio': round(counters['memo_hits'] / lookups, 4) if lookups else None,
+        'breaker': _breaker.state(),
+    })
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT COUNT(*), MIN(received_at) FROM emails WHERE spam_pending')
+        deferred_queue, oldest = cur.fetchone()
+        cur.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = 'spam_score_memo'")
+        row = cur.fetchone()
+        cur.close()
+    counters.update({
+        'deferred_queue': deferred_queue,
+        'oldest_deferred': oldest.isoformat() if oldest else None,
+        'memo_rows_estimate': max(row[0], 0) if row else 0,
+    })
+    return counters
+
+
+def _load_scored(rows):
+    """The latest ``rows`` emails with a score from any engine but the local one, with their bodies.
+
+    A score of 0 is what failed remote calls used to store, not a real score.
+    """
+    with db.connection() as conn:
+        cur = conn.cursor(cursor_factory=DictCursor)
+        cur.execute('''
+            SELECT id, subject, body_text, body_html, spam_score
+            FROM emails
+            WHERE spam_score IS NOT NULL AND spam_score <> 0 AND NOT enrichment_pending
+              AND (spam_scorer IS NULL OR spam_scorer NOT LIKE 'local:%%')
+            ORDER BY id DESC
+            LIMIT %s
+        ''', (rows,))
+        emails = [dict(row) for row in cur.fetchall()]
+        cur.close()
+    return emails
+
+
+def calibration_report(predicted, actual, threshold=SPAM_THRESHOLD):
+    """Error, correlation, per-band means and spam/ham agreement against stored scores."""
+    import numpy as np
+
+    predicted = np.asarray(predicted, dtype=np.float64)
+    actual = np.asarray(actual, dtype=np.float64)
+    errors = predicted - actual
+    bands = []
+    for low, high in ((-math.inf, 0), (0, 2), (2, 4), (4, 5), (5, 8), (8, math.inf)):
+        mask = (actual >= low) & (actual < high)
+        if mask.any():
+            bands.append({
+                'band': f"[{low}, {high})",
+                'emails': int(mask.sum()),
+                'mean_stored': round(float(actual[mask].mean()), 3),
+                'mean_predicted': round(float(predicted[mask].mean()), 3),
+            })
+    spam, flagged = actual >= threshold, predicted >= threshold
+    true_positives = int((spam & flagged).sum())
+    correlated = len(actual) > 1 and actual.std() > 0 and predicted.std() > 0
+    return {
+        'emails': int(len(actual)),
+        'mae': round(float(np.abs(errors).mean()), 3),
+        'rmse': round(float(np.sqrt((errors ** 2).mean())), 3),
+        'correlation': round(float(np.corrcoef(predicted, actual)[0, 1]), 3) if correlated else None,
+        'threshold': threshold,
+        'agreement': round(float((spam == flagged).mean()), 4),
+        'precision': round(true_positives / int(flagged.sum()), 4) if flagged.any() else None,
+        'recall': round(true_positives / int(spam.sum()), 4) if spam.any() else None,
+        'bands': bands,
+    }
+
+
+def train(rows=20000, alpha=RIDGE_ALPHA):
+    """Fit a model to stored remote scores, holding out every fifth email for the report."""
+    import numpy as np
+
+    emails = _load_scored(rows)
+    if len(emails) < 50:
+        raise SystemExit(f"Only {len(emails)} emails scored by the remote service; need at least 50 to train")
+    start = time.monotonic()
+    matrix = feature_matrix(emails)
+    scores = np.array([email['spam_score'] for email in emails], dtype=np.float64)
+    holdout = np.array([email['id'] % 5 == 0 for email in emails])
+    print(f"Built {matrix.shape[0]}x{matrix.shape[1]} feature matrix in {time.monotonic() - start:.1f}s")
+
+    weights = fit(matrix[~holdout], scores[~holdout], alpha)
+    report = {
+        'model': calibration_report(predict(matrix[holdout], weights), scores[holdout]),
+        'rules_only': calibration_report(matrix[holdout] @ rule_weights(), scores[holdout]),
+    }
+    # The stored model is refitted on every row
+    weights = fit(matrix, scores, alpha)
+    model_id = save_model(weights, len(emails), report)
+    print(f"Stored spam model {model_id} trained on {len(emails)} emails")
+    return report
+
+
+def report(rows=5000):
+    """Calibration of the current local scorer against the latest remote scores."""
+    emails = _load_scored(rows)
+    if not emails:
+        raise SystemExit("No scored emails to compare with")
+    scorer = LocalScorer()
+    return {
+        'model': 'trained' if scorer.weights() is not None else 'rules only',
+        'report': calibration_report(scorer.score_batch(emails), [email['spam_score'] for email in emails]),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train and check the local spam scorer.')
+    parser.add_argument('--train', action='store_true', help='fit a model to stored scores and save it')
+    parser.add_argument('--report', action='store_true', help='compare local scores with stored scores')
+    parser.add_argument('--rows', type=int, default=None, help='latest scored emails to use (default 20000 / 5000)')
+    parser.add_argument('--alpha', type=float, default=RIDGE_ALPHA, help=f'ridge penalty (default {RIDGE_ALPHA})')
+    parser.add_argument('--retry', action='store_true', help='score deferred emails until none are left')
+    parser.add_argument('--stats', action='store_true', help='print the deferred queue and memo size')
+    args = parser.parse_args()
+
+    if args.train:
+        print(json.dumps(train(rows=args.rows or 20000, alpha=args.alpha), indent=2))
+    if args.retry:
+        total = 0
+        while True:
+            claimed, scored = retry_deferred()
+            total += scored
+            if not claimed or scored < claimed:
+                break
+        print(f"Scored {total} deferred emails")
+    if args.stats:
+        print(json.dumps(stats(), indent=2))
+    if args.report or not (args.train or args.retry or args.stats):
+        print(json.dumps(report(rows=args.rows or 5000), indent=2))
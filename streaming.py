@@ -0,0 +1,132 @@
+"""Server-sent events for the LLM analysis endpoints.
+
+A DeepSeek reasoning call can take minutes. Returned as one JSON body, it
+held a sync gunicorn worker for the whole call, and proxies cut the idle
+connection, which showed up as 502s. The streaming endpoints instead:
+
+- run the analysis on a background thread (a greenlet under the gevent
+  worker, see gunicorn.conf.py) that puts events on a queue;
+- send those events as they arrive, plus a comment frame every
+  SSE_HEARTBEAT_SECONDS while the queue is quiet, so proxies see traffic
+  during the map stage and while the model is reasoning;
+- notice a client that went away when a write fails (gunicorn then closes
+  the generator) and set a cancel event. The analysis stops sending map
+  chunks and the upstream stream is closed, which aborts generation.
+
+Events, each with a JSON payload:
+
+    progress  {"stage": "map" | "reduce" | "answer", "done": n, "total": n}
+    status    {"status": "reasoning"}
+    coverage  {...}                  same as the non-streaming response
+    delta     {"content": "..."}     the next piece of the answer
+    done      {"cached": bool, "timings": {...}, ...}
+    error     {"error": "..."}
+
+A completed stream is cached under the same key as the non-streaming
+endpoint, so either one serves the other's result.
+"""
+import json
+import os
+import queue
+import threading
+
+import llm_analysis
+import llm_cache
+
+SSE_HEARTBEAT_SECONDS = float(os.environ.get('SSE_HEARTBEAT_SECONDS', 15))
+
+# Keep proxies (nginx, the platform router) from buffering or caching the stream
+HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no',
+}
+
+_DONE = object()
+
+
+def format_event(name, data):
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+def _run(emit, cancelled, emails, prompt, system_prompt, temperature, cache_key, meta):
+    cached = llm_cache.get(cache_key)
+    if cached:
+        emit('coverage', cached.get('coverage'))
+        emit('delta', {'content': cached['analysis']})
+        emit('done', dict(meta, cached=True, timings=cached.get('timings')))
+        return
+
+    result = llm_analysis.analyze(
+        emails, prompt, system_prompt, temperature=temperature, stream=True,
+        progress=lambda stage, done, total: emit('progress', {'stage': stage, 'done': done, 'total': total}),
+        cancelled=cancelled,
+    )
+    emit('coverage', result['coverage'])
+
+    pieces = llm_analysis.iter_stream(result['analysis'])
+    parts = []
+    reasoning = False
+    try:
+        for kind, text in pieces:
+            if cancelled.is_set():
+                break
+            if kind == 'reasoning':
+                if not reasoning:
+                    reasoning = True
+                    emit('status', {'status': 'reasoning'})
+            else:
+                parts.append(text)
+                emit('delta', {'content': text})
+    finally:
+        # Closes the upstream stream, so an abandoned answer stops generating
+        pieces.close()
+    if cancelled.is_set():
+        raise llm_analysis.Cancelled()
+
+    result['analysis'] = ''.join(parts)
+    llm_cache.put(cache_key, result)
+    emit('done', dict(meta, cached=False, timings=result['timings']))
+
+
+def stream_analysis(emails, prompt, system_prompt, temperature, cache_key, meta=None):
+    """Yield SSE frames for an analysis of ``emails`` (see llm_analysis.analyze).
+
+    ``meta`` is merged into the final ``done`` event.
+    """
+    events = queue.Queue()
+    cancelled = threading.Event()
+
+    def emit(name, data):
+        events.put(format_event(name, data))
+
+    def run():
+        try:
+            _run(emit, cancelled, emails, prompt, system_prompt, temperature, cache_key, meta or {})
+        except llm_analysis.Cancelled:
+            print(f"Analysis of {len(emails)} emails cancelled by the client")
+        except Exception as e:
+            print(f"Error streaming analysis: {str(e)}")
+            emit('error', {'error': str(e)})
+        finally:
+            events.put(_DONE)
+
+    threading.Thread(target=run, name='llm-stream', daemon=True).start()
+
+    def generate():
+        try:
+            # First byte right away: routers drop requests with no response after ~30s
+            yield ': connected\n\n'
+            while True:
+                try:
+                    frame = events.get(timeout=SSE_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ': heartbeat\n\n'
+                    continue
+                if frame is _DONE:
+                    return
+                yield frame
+        finally:
+            # Also runs when the client disconnects and the server closes us
+            cancelled.set()
+
+    return generate()
@@ -0,0 +1,124 @@
+"""Per-email term counts for the word cloud.
+
+Each email is tokenised once, at ingest, with the same footer stripping and
+stop-word rules the word cloud has always used (process_text_for_word_cloud),
+and its term counts are stored in email_terms together with the email's
+source and date. A word cloud for any window or source is then a single
+aggregate over that table instead of a re-read of every email body.
+
+Emails ingested before the table existed can be indexed with:
+
+    python term_index.py --backfill [--days 30]
+"""
+import argparse
+from collections import Counter
+
+from psycopg2.extras import execute_values
+
+from backfill import run_backfill
+from text_processing import process_text_for_word_cloud
+
+# Subjects count three times, as they always have in the word cloud
+SUBJECT_WEIGHT = 3
+# Only the most frequent terms of each email are kept; the long tail never
+# reaches the 400 words shown in the cloud
+TERMS_PER_EMAIL = 200
+
+INSERT_SQL = '''
+    INSERT INTO email_terms (email_id, source_id, received_at, term, term_count)
+    VALUES %s
+    ON CONFLICT (email_id, term) DO NOTHING
+'''
+
+
+def compute_term_counts(subject, body_text):
+    """Return a Counter of word-cloud terms for one email."""
+    counts = Counter()
+    for word in process_text_for_word_cloud(subject):
+        counts[word] += SUBJECT_WEIGHT
+    counts.update(process_text_for_word_cloud(body_text))
+    return Counter(dict(counts.most_common(TERMS_PER_EMAIL)))
+
+
+def term_rows(email_id, source_id, received_at, counts):
+    return [(email_id, source_id, received_at, term, count) for term, count in counts.items()]
+
+
+def store_term_rows(cur, rows):
+    """Insert (email_id, source_id, received_at, term, count) rows."""
+    if rows:
+        execute_values(cur, INSERT_SQL, rows, page_size=1000)
+
+
+def index_email(cur, email_id, source_id, received_at, subject, body_text):
+    """Compute and store the term counts for one email in the caller's transaction."""
+    counts = compute_term_counts(subject, body_text)
+    store_term_rows(cur, term_rows(email_id, source_id, received_at, counts))
+
+
+def load_term_frequencies(cur, days=7, source_ids=None, limit=2000):
+    """Return {term: count} summed over emails from the past ``days`` days."""
+    query = '''
+        SELECT term, SUM(term_count) AS total
+        FROM email_terms
+        WHERE received_at >= NOW() - %s * INTERVAL '1 day'
+    '''
+    params = [days]
+    if source_ids:
+        query += ' AND source_id = ANY(%s)'
+        params.append(list(source_ids))
+    query += ' GROUP BY term ORDER BY total DESC LIMIT %s'
+    params.append(limit)
+
+    cur.execute(query, params)
+    return {term: int(total) for term, total in cur.fetchall()}
+
+
+def _backfill_rows(email):
+    counts = compute_term_counts(email['subject'], email['body_text'])
+    return term_rows(email['id'], email['source_id'], email['received_at'], counts)
+
+
+def backfill_terms(days=None, workers=4, batch_size=200, restart=False):
+    """Index emails that have no stored term counts yet."""
+    where = '''
+        id > %(last_id)s
+        AND NOT EXISTS (SELECT 1 FROM email_terms t WHERE t.email_id = e.id)
+    '''
+    params = {}
+    if days:
+        where += " AND received_at >= NOW() - %(days)s * INTERVAL '1 day'"
+        params['days'] = days
+
+    return run_backfill(
+        'email_terms' + (f'_{days}_days' if days else ''),
+        f'''
+            SELECT id, source_id, received_at, subject, body_text
+            FROM emails e
+            WHERE {where}
+            ORDER BY id
+            LIMIT %(limit)s
+        ''',
+        _backfill_rows,
+        INSERT_SQL,
+        params=params,
+        count_sql=f"SELECT COUNT(*) FROM emails e WHERE {where}",
+        batch_size=batch_size,
+        workers=workers,
+        executor='process',
+        restart=restart,
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index word-cloud term counts for existing emails.')
+    parser.add_argument('--backfill', action='store_true', help='index emails without stored term counts')
+    parser.add_argument('--days', type=int, default=None, help='only index emails from the past N days')
+    parser.add_argument('--workers', type=int, default=4, help='worker processes (default 4)')
+    parser.add_argument('--restart', action='store_true', help='ignore the saved checkpoint and start over')
+    args = parser.parse_args()
+
+    if args.backfill:
+        backfill_terms(days=args.days, workers=args.workers, restart=args.restart)
+    else:
+        parser.print_help()
@@ -0,0 +1,97 @@
+"""Shared fixtures.
+
+Tests that touch the database need TEST_DATABASE_URL pointing at a scratch
+PostgreSQL database: it is migrated once per run and its email tables are
+emptied before every test. Without it those tests are skipped.
+
+    TEST_DATABASE_URL=postgresql://localhost/mailfoxes_test python -m pytest -q tests
+"""
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL')
+
+# Emptied before every database test; email_sources keeps its seeded rows
+TRUNCATE_SQL = '''
+    TRUNCATE emails, email_terms, email_urls, email_fingerprints, spam_score_memo,
+             email_daily_rollups, email_hourly_rollups, wordcloud_images, backfill_checkpoints
+    RESTART IDENTITY CASCADE
+'''
+
+
+@pytest.fixture(scope='session')
+def migrated():
+    if not TEST_DATABASE_URL:
+        pytest.skip('TEST_DATABASE_URL not set')
+    # Modules that open their own connections (the catalog listener) read this
+    os.environ['DATABASE_URL'] = TEST_DATABASE_URL
+    import backfill
+    import db
+    import migrate
+
+    db._pool = db.ConnectionPool(TEST_DATABASE_URL)
+    migrate.migrate()
+    backfill.ensure_checkpoint_table()
+    return TEST_DATABASE_URL
+
+
+@pytest.fixture
+def database(migrated):
+    """A migrated database with no emails; yields the pooled ``db`` module."""
+    import db
+    import source_catalog
+
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(TRUNCATE_SQL)
+        conn.commit()
+        cur.close()
+    source_catalog.invalidate()
+    yield db
+    source_catalog.invalidate()
+
+
+@pytest.fixture
+def make_source(database):
+    """Insert an email source and return its id."""
+    def make(name='Test source', **fields):
+        with database.connection() as conn:
+            cur = conn.cursor()
+            cur.execute('''
+                INSERT INTO email_sources (name, email_address, display_name, parent_id, hidden)
+                VALUES (%s, %s, %s, %s, %s) RETURNING id
+            ''', (name, fields.get('email_address', f"{uuid.uuid4().hex}@example.com"),
+                  fields.get('display_name', name), fields.get('parent_id'), fields.get('hidden', False)))
+            source_id = cur.fetchone()[0]
+            conn.commit()
+            cur.close()
+        return source_id
+    return make
+
+
+@pytest.fixture
+def make_email(database):
+    """Insert an email (received now unless given) and return its id."""
+    def make(**fields):
+        row = {'from_address': 'news@example.com', 'to_address': 'inbox@example.com',
+               'subject': 'Subject', 'body_text': 'Body text', 'body_html': None, 'urls': []}
+        row.update(fields)
+        received_at = row.pop('received_at', None)
+        columns = list(row)
+        with database.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(f'''
+                INSERT INTO emails ({', '.join(columns)}, received_at)
+                VALUES ({', '.join(['%s'] * len(columns))}, COALESCE(%s, NOW()))
+                RETURNING id
+            ''', [row[column] for column in columns] + [received_at])
+            email_id = cur.fetchone()[0]
+            conn.commit()
+            cur.close()
+        return email_id
+    return make
@@ -0,0 +1,56 @@
+import importlib
+
+import pytest
+
+import source_catalog
+
+
+@pytest.fixture
+def client(database, monkeypatch):
+    """Flask test client; importing app would otherwise start its background threads."""
+    import enrichment
+    import jobs
+    import llm_cache
+    import spam_scoring
+    import wordcloud_cache
+
+    for module, name in [(wordcloud_cache, 'start_scheduler'), (spam_scoring, 'start_retrier'),
+                         (llm_cache, 'start_purger'), (jobs, 'start_dispatcher'),
+                         (source_catalog, 'start_listener'), (enrichment, 'start_background_worker')]:
+        monkeypatch.setattr(module, name, lambda: None)
+    app = importlib.import_module('app')
+    return app.app.test_client()
+
+
+def source_ids(db, table, key, value):
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f'SELECT source_id FROM {table} WHERE {key} = %s', (value,))
+        rows = [row[0] for row in cur.fetchall()]
+        cur.close()
+    return rows
+
+
+def test_delete_source_detaches_emails_terms_and_urls(client, database, make_source, make_email):
+    source_id = make_source('Doomed')
+    email_id = make_email(source_id=source_id, urls=['https://example.com/a'])
+    with database.connection() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            INSERT INTO email_terms (email_id, source_id, received_at, term, term_count)
+            VALUES (%s, %s, NOW(), 'earnings', 1)
+        ''', (email_id, source_id))
+        cur.execute('''
+            INSERT INTO email_urls (email_id, source_id, received_at, url, domain)
+            VALUES (%s, %s, NOW(), 'https://example.com/a', 'example.com')
+        ''', (email_id, source_id))
+        conn.commit()
+        cur.close()
+
+    response = client.post(f'/sources/delete/{source_id}')
+
+    assert response.status_code == 302
+    assert source_ids(database, 'emails', 'id', email_id) == [None]
+    assert source_ids(database, 'email_terms', 'email_id', email_id) == [None]
+    assert source_ids(database, 'email_urls', 'email_id', email_id) == [None]
+    assert source_catalog.get_source(source_id) is None
@@ -0,0 +1,62 @@
+import rollups
+
+
+def rollup_rows(db):
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT day, source_id, email_count, spam_score_sum, spam_score_count '
+                    'FROM email_daily_rollups WHERE email_count <> 0 ORDER BY 1, 2')
+        rows = cur.fetchall()
+        cur.close()
+    return rows
+
+
+def test_statement_triggers_replace_the_per_row_ones(database):
+    with database.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT tgname FROM pg_trigger WHERE tgrelid = 'emails'::regclass AND tgname LIKE 'emails_rollup%%'")
+        names = sorted(row[0] for row in cur.fetchall())
+        cur.close()
+    assert names == ['emails_rollup_delete', 'emails_rollup_insert', 'emails_rollup_update']
+
+
+def test_triggers_follow_inserts_rescores_and_deletes(database, make_email):
+    ids = [make_email(spam_score=score) for score in (1.0, 2.0, None)]
+    with database.connection() as conn:
+        cur = conn.cursor()
+        cur.execute('UPDATE emails SET spam_score = 4.0 WHERE id = ANY(%s)', (ids[1:],))
+        cur.execute('DELETE FROM emails WHERE id = %s', (ids[0],))
+        conn.commit()
+        cur.close()
+
+    assert rollups.check() == []
+    assert [row[2:] for row in rollup_rows(database)] == [(2, 8.0, 2)]
+
+
+def test_skip_leaves_rollups_alone_for_that_transaction_only(database, make_email):
+    ids = [make_email(spam_score=1.0) for _ in range(3)]
+    before = rollup_rows(database)
+
+    with database.connection() as conn:
+        cur = conn.cursor()
+        rollups.skip(cur)
+        cur.execute('UPDATE emails SET processed = TRUE, token_count = 5 WHERE id = ANY(%s)', (ids,))
+        cur.execute('UPDATE emails SET spam_score = 9.0 WHERE id = %s', (ids[0],))
+        conn.commit()
+        cur.close()
+    assert rollup_rows(database) == before
+
+    with database.connection() as conn:
+        cur = conn.cursor()
+        cur.execute('UPDATE emails SET spam_score = 2.0 WHERE id = %s', (ids[1],))
+        conn.commit()
+        cur.close()
+    assert [row[2:] for row in rollup_rows(database)] == [(3, 4.0, 3)]
+
+    # After a skipped write that changed a rollup column, a rebuild catches up
+    with database.connection() as conn:
+        cur = conn.cursor()
+        rollups.rebuild(cur)
+        conn.commit()
+        cur.close()
+    assert [row[2:] for row in rollup_rows(database)] == [(3, 12.0, 3)]
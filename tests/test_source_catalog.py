@@ -0,0 +1,33 @@
+import uuid
+
+import pytest
+
+import dedupe
+import source_catalog
+
+
+@pytest.fixture
+def single_connection_pool(database, migrated):
+    """Swap in a pool with one connection, so a second checkout times out."""
+    pool = database._pool
+    database._pool = database.ConnectionPool(migrated, min_size=1, max_size=1, timeout=2)
+    yield database
+    database._pool.closeall()
+    database._pool = pool
+
+
+def test_cold_catalog_loads_on_the_callers_connection(single_connection_pool, make_source):
+    parent = make_source('Parent')
+    address = f"{uuid.uuid4().hex}@example.com"
+    child = make_source('Child', parent_id=parent, email_address=address)
+    source_catalog.invalidate()
+
+    with single_connection_pool.connection() as conn:
+        assert source_catalog.source_id_for_address(address, conn) == child
+        source_catalog.invalidate()
+        assert set(source_catalog.descendant_ids(parent, conn)) == {parent, child}
+        source_catalog.invalidate()
+        assert dedupe.family_id(child, conn) == parent
+        source_catalog.invalidate()
+        names = [source['name'] for source in source_catalog.visible_sources(conn)]
+        assert 'Child' in names
@@ -0,0 +1,66 @@
+import sys
+import types
+
+import pytest
+
+import backfill
+import spam_scoring
+from backfill_spam_scores_standalone import backfill_spam_scores
+
+
+@pytest.fixture
+def spamcheck(monkeypatch):
+    """Stand-in for the spamcheck service; subjects listed in ``failing`` raise."""
+    service = types.SimpleNamespace(calls=0, failing=set())
+
+    def check(raw_email, report=False):
+        service.calls += 1
+        if any(f"Subject: {subject}\n" in raw_email for subject in service.failing):
+            raise ConnectionError('spamcheck unavailable')
+        return {'score': 2.5}
+
+    service.check = check
+    monkeypatch.setitem(sys.modules, 'spamcheck', service)
+    return service
+
+
+def stored_scores(db):
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT id, spam_score, spam_scorer FROM emails ORDER BY id')
+        rows = cur.fetchall()
+        cur.close()
+    return rows
+
+
+def test_rate_limited_remote_backfill_scores_every_row(database, make_email, spamcheck, monkeypatch):
+    # A chunk of 25 calls at 50/s takes 0.5s, well past this deadline
+    monkeypatch.setattr(spam_scoring, 'SPAM_SCORE_TIMEOUT', 0.1)
+    ids = [make_email(subject=f"Issue {i}") for i in range(30)]
+
+    done = backfill_spam_scores(scorer='remote', workers=4, batch_size=40, rate_limit=50)
+
+    assert done == 30
+    assert spamcheck.calls == 30
+    assert stored_scores(database) == [(email_id, 2.5, 'remote') for email_id in ids]
+    assert backfill.load_checkpoint('spam_scores') == (0, 0)
+
+
+def test_backfill_checkpoint_stops_before_deferred_rows(database, make_email, spamcheck, monkeypatch):
+    # A failed engine call defers its whole chunk
+    monkeypatch.setattr(spam_scoring, 'SPAM_SCORE_CHUNK', 2)
+    ids = [make_email(subject=f"Issue {i}") for i in range(6)]
+    spamcheck.failing.add('Issue 3')
+
+    backfill_spam_scores(scorer='remote', batch_size=10)
+
+    scores = dict((email_id, score) for email_id, score, _ in stored_scores(database))
+    assert [scores[email_id] for email_id in ids] == [2.5, 2.5, None, None, 2.5, 2.5]
+    assert backfill.load_checkpoint('spam_scores')[0] == ids[1]
+
+    # Once the service recovers, a rerun resumes from the checkpoint and
+    # picks up the email it could not score
+    spamcheck.failing.clear()
+    backfill_spam_scores(scorer='remote', batch_size=10)
+    assert all(score == 2.5 for _, score, _ in stored_scores(database))
+    assert backfill.load_checkpoint('spam_scores') == (0, 0)
@@ -0,0 +1,83 @@
+import os
+import sys
+
+import pytest
+
+import text_processing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+from legacy_text_processing import (  # noqa: E402
+    legacy_process_text_for_word_cloud,
+    legacy_remove_footer_content,
+)
+
+TEXTS = [
+    # Empty input
+    None,
+    '',
+    '   ',
+    # No footer at all
+    'Markets opened higher on strong earnings from chipmakers',
+    # Overlapping indicators: the shorter, earlier-listed one decides
+    'Read the analysis below.\nTo unsubscribe, click here',
+    'Click here to unsubscribe from these alerts',
+    'If you would like to unsubscribe, reply STOP',
+    # Priority ties: a later-listed indicator that occurs first in the text
+    'Thanks for reading. Our privacy policy changed. Unsubscribe',
+    'Best regards, the team\nView in browser\nCopyright 2024',
+    'Regards from the desk. Kind regards, Ann',
+    'Sent to you by the desk; this email was sent by Acme',
+    # Case folding
+    'Weekly outlook for investors UNSUBSCRIBE Here',
+    'Weekly outlook PrIvAcY PoLiCy applies',
+    'İstanbul equities rallied. Unsubscribe',
+    'İstanbul equities rallied with no footer',
+    'Straße und Überblick. Copyright Acme',
+    'ΣΟΦΙΑ report Thanks',
+    # Overlapping separators, without any indicator
+    'Main story\n\n---\nSigned off',
+    'Main story\n---\nSigned off',
+    'Main story\n\n-----------\nSigned off',
+    'Main story\n--\nSigned off\n***\nmore',
+    'Main story\n===\nthen\n___\nend',
+    # A separator before an indicator: the indicator still wins
+    'Main story\n---\nFooter text unsubscribe',
+    # Punctuation and short words
+    "Don't miss (this): Acme's quarterly results; it's big!",
+]
+
+
+@pytest.mark.parametrize('text', TEXTS)
+def test_remove_footer_content_matches_legacy(text):
+    assert text_processing.remove_footer_content(text) == legacy_remove_footer_content(text)
+
+
+@pytest.mark.parametrize('text', TEXTS)
+def test_process_text_for_word_cloud_matches_legacy(text):
+    assert text_processing.process_text_for_word_cloud(text) == legacy_process_text_for_word_cloud(text)
+
+
+def test_every_indicator_and_separator_matches_legacy():
+    for pattern in text_processing.FOOTER_INDICATORS + text_processing.SEPARATOR_PATTERNS:
+        for text in (f"Body text {pattern} tail", f"Body text {pattern.upper()} tail\nregards"):
+            assert text_processing.remove_footer_content(text) == legacy_remove_footer_content(text)
+            assert text_processing.process_text_for_word_cloud(text) == legacy_process_text_for_word_cloud(text)
+
+
+@pytest.mark.parametrize('workers', [None, 1, 2])
+def test_batch_matches_single(workers):
+    texts = TEXTS * 3
+    assert text_processing.remove_footer_content_batch(texts, workers=workers) == \
+        [text_processing.remove_footer_content(text) for text in texts]
+    assert text_processing.process_texts_for_word_cloud(texts, workers=workers) == \
+        [text_processing.process_text_for_word_cloud(text) for text in texts]
+
+
+def test_batch_reuses_worker_pool(monkeypatch):
+    monkeypatch.setattr(text_processing, 'BATCH_MIN_PER_WORKER', 1)
+    texts = TEXTS * 2
+    expected = [text_processing.process_text_for_word_cloud(text) for text in texts]
+    assert text_processing.process_texts_for_word_cloud(texts, workers=2) == expected
+    executor = text_processing._executor
+    assert text_processing.process_texts_for_word_cloud(texts, workers=2) == expected
+    assert text_processing._executor is executor
@@ -0,0 +1,43 @@
+import work_queue
+
+
+def expire_leases(db, ids):
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE emails SET processing_claimed_at = NOW() - INTERVAL '1 hour' WHERE id = ANY(%s)",
+                    (ids,))
+        conn.commit()
+        cur.close()
+
+
+def queue_state(db, ids):
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT processed, processing_claimed_by FROM emails WHERE id = ANY(%s) ORDER BY id', (ids,))
+        rows = cur.fetchall()
+        cur.close()
+    return rows
+
+
+def test_late_ack_after_lease_expired_and_reclaimed_is_ignored(database, make_email, capsys):
+    ids = [make_email() for _ in range(3)]
+    assert work_queue.claim(10, lease_seconds=60, consumer='slow') == ids
+    expire_leases(database, ids)
+    assert work_queue.claim(10, lease_seconds=60, consumer='fast') == ids
+
+    # The first consumer's lease is gone: neither its ack nor its release lands
+    assert work_queue.ack(ids, 'slow') == 0
+    assert work_queue.release(ids, 'slow') == 0
+    assert '3 of 3 acks from consumer' in capsys.readouterr().out
+    assert queue_state(database, ids) == [(False, 'fast')] * 3
+
+    assert work_queue.release(ids[2:], 'fast') == 1
+    assert work_queue.ack(ids[:2], 'fast') == 2
+    assert queue_state(database, ids) == [(True, None), (True, None), (False, None)]
+
+
+def test_unnamed_consumer_cannot_ack_a_named_lease(database, make_email):
+    ids = [make_email() for _ in range(2)]
+    assert work_queue.claim(10, consumer='named') == ids
+    assert work_queue.ack(ids) == 0
+    assert work_queue.ack(ids, 'named') == 2
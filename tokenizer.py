@@ -0,0 +1,51 @@
+"""Token counting shared by everything that builds LLM prompts.
+
+The encoding is loaded once per process (tiktoken's cl100k/o200k tables
+take a noticeable fraction of a second to build) and reused by every
+request thread. count_batch() encodes many texts in one call, which tiktoken
+spreads over its own thread pool.
+"""
+import os
+import threading
+
+# Close enough to DeepSeek's tokenizer for budgeting
+TOKENIZER_MODEL = os.environ.get('TOKENIZER_MODEL', 'gpt-4o')
+TOKENIZER_THREADS = int(os.environ.get('TOKENIZER_THREADS', 4))
+
+_encoding = None
+_lock = threading.Lock()
+
+
+def get_encoding():
+    global _encoding
+    if _encoding is None:
+        with _lock:
+            if _encoding is None:
+                import tiktoken
+                try:
+                    _encoding = tiktoken.encoding_for_model(TOKENIZER_MODEL)
+                except Exception:
+                    _encoding = tiktoken.get_encoding("cl100k_base")  # Fallback encoding
+    return _encoding
+
+
+def count(text):
+    """Number of tokens in ``text``."""
+    return len(get_encoding().encode_ordinary(text))
+
+
+def count_batch(texts):
+    """Token counts for many texts, encoded in one batched call."""
+    if not texts:
+        return []
+    tokens = get_encoding().encode_ordinary_batch(list(texts), num_threads=TOKENIZER_THREADS)
+    return [len(t) for t in tokens]
+
+
+def truncate(text, max_tokens):
+    """``text`` cut to at most ``max_tokens`` tokens."""
+    encoding = get_encoding()
+    tokens = encoding.encode_ordinary(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max(0, max_tokens)])
@@ -0,0 +1,262 @@
+"""Background-generated word cloud images.
+
+Rendering the cloud takes seconds of CPU, so it never happens on the page
+request. A scheduler thread in each web process checks every
+WORDCLOUD_CHECK_INTERVAL seconds whether new emails have arrived (or the image
+has aged past WORDCLOUD_MAX_AGE) and regenerates the default 7-day cloud;
+clouds for other windows or sources are rendered in the background when they
+are requested (the request gets a 503 until the image exists). Requests are
+limited to WORDCLOUD_MAX_DAYS days and WORDCLOUD_MAX_SOURCES known sources,
+and only the WORDCLOUD_MAX_CUSTOM most recently rendered non-default clouds
+are kept.
+Images are built from the per-email term counts in email_terms, so rendering
+never reads email bodies. A PostgreSQL advisory lock makes sure only one
+process renders a given cloud at a time; the PNG is stored in the
+wordcloud_images table with an ETag so every worker serves the same bytes
+from /wordcloud.png.
+"""
+import hashlib
+import os
+import random
+import threading
+import time
+from datetime import datetime
+from io import BytesIO
+
+import db
+import offload
+import source_catalog
+import term_index
+
+WORDCLOUD_CHECK_INTERVAL = int(os.environ.get('WORDCLOUD_CHECK_INTERVAL', 60))
+# Regenerate at most this often when new emails arrive...
+WORDCLOUD_MIN_INTERVAL = int(os.environ.get('WORDCLOUD_MIN_INTERVAL', 600))
+# ...and at least this often regardless, so the 7-day window keeps sliding
+WORDCLOUD_MAX_AGE = int(os.environ.get('WORDCLOUD_MAX_AGE', 6 * 3600))
+# Bounds on the clouds /wordcloud.png can be asked for
+WORDCLOUD_MAX_DAYS = int(os.environ.get('WORDCLOUD_MAX_DAYS', 90))
+WORDCLOUD_MAX_SOURCES = int(os.environ.get('WORDCLOUD_MAX_SOURCES', 5))
+# Non-default clouds kept in wordcloud_images; the least recently rendered go first
+WORDCLOUD_MAX_CUSTOM = int(os.environ.get('WORDCLOUD_MAX_CUSTOM', 50))
+
+DEFAULT_CLOUD = 'recent_7_days'
+_ADVISORY_LOCK_KEY = 0x776f7264  # "word"
+# Images kept in each process's memory
+_MEMORY_IMAGES = 8
+
+_memory = {}
+_last_checked = {}
+_memory_lock = threading.Lock()
+_scheduler_thread = None
+_scheduler_pid = None
+
+
+def render_wordcloud_png(frequencies):
+    """Render a word cloud image from {term: count} and return the PNG bytes."""
+    from wordcloud import WordCloud, STOPWORDS
+    from matplotlib.colors import LinearSegmentedColormap
+
+    # Create a custom colormap similar to the Macbeth example
+    colors = ["#0066cc", "#4285f4", "#5e97f6", "#7baaf7", "#a1c2fa",
+              "#34a853", "#26c281", "#2ecc71", "#87d37c",
+              "#f4b400", "#f9bc02", "#f7ca18", "#f4d03f",
+              "#ea4335", "#e74c3c", "#c0392b", "#d35400",
+              "#9c27b0", "#8e44ad", "#9b59b6", "#db0a5b"]
+
+    # Create a custom stopwords set
+    custom_stopwords = set(STOPWORDS)
+
+    # Add our existing stop words
+    custom_stopwords.update([
+        # Add any additional stopwords here
+        'future', 'issuer', '4nths', 'likely', 'risk'
+    ])
+
+    frequencies = {term: count for term, count in frequencies.items() if term not in custom_stopwords}
+    if not frequencies:
+        frequencies = {'no emails yet': 1}
+
+    # Create the wordcloud object
+    wordcloud = WordCloud(
+        width=1200,
+        height=600,
+        background_color='white',
+        max_words=400,
+        colormap=LinearSegmentedColormap.from_list("custom_colormap", colors, N=len(colors)),
+        min_font_size=4,
+        max_font_size=150,
+        random_state=42,
+        prefer_horizontal=0.7,  # 70% horizontal, 30% vertical
+        relative_scaling=0.5,   # Balance between word frequency and font size
+        scale=2                 # Higher resolution
+    ).generate_from_frequencies(frequencies)
+
+    # The layout is already rasterised at scale=2; save it directly instead
+    # of re-rendering through a matplotlib figure
+    img = BytesIO()
+    wordcloud.to_image().save(img, format='PNG', optimize=True)
+    return img.getvalue()
+
+
+def cloud_name(days=7, source_ids=None):
+    """Storage key for the cloud of a given window and set of sources."""
+    if days == 7 and not source_ids:
+        return DEFAULT_CLOUD
+    sources = '_'.join(str(sid) for sid in sorted(source_ids)) if source_ids else 'all'
+    return f"days_{days}_sources_{sources}"
+
+
+def normalize(days=7, source_ids=None):
+    """Clamp ``days`` and validate ``source_ids``; returns (days, sorted ids).
+
+    Raises ValueError for unknown sources or more than WORDCLOUD_MAX_SOURCES.
+    """
+    days = min(max(int(days), 1), WORDCLOUD_MAX_DAYS)
+    source_ids = sorted(set(source_ids or ()))
+    if len(source_ids) > WORDCLOUD_MAX_SOURCES:
+        raise ValueError(f"At most {WORDCLOUD_MAX_SOURCES} sources per word cloud")
+    known = source_catalog.get_catalog().by_id
+    unknown = [sid for sid in source_ids if sid not in known]
+    if unknown:
+        raise ValueError(f"Unknown sources: {', '.join(str(sid) for sid in unknown)}")
+    return days, source_ids
+
+
+def _data_version(cur):
+    """Changes whenever an email arrives or the 7-day window moves to a new day."""
+    cur.execute("SELECT COALESCE(MAX(id), 0) FROM emails")
+    return f"{cur.fetchone()[0]}:{datetime.now().strftime('%Y%m%d')}"
+
+
+def refresh(days=7, source_ids=None, force=False):
+    """Regenerate the stored image if it is stale. Returns True if it was rendered."""
+    name = cloud_name(days, source_ids)
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_try_advisory_lock(%s, hashtext(%s))", (_ADVISORY_LOCK_KEY, name))
+        if not cur.fetchone()[0]:
+            # Another process is rendering right now
+            cur.close()
+            return False
+        try:
+            cur.execute('''
+                SELECT data_version, EXTRACT(EPOCH FROM NOW() - generated_at)
+                FROM wordcloud_images WHERE name = %s
+            ''', (name,))
+            row = cur.fetchone()
+            version = _data_version(cur)
+
+            if row and not force:
+                stored_version, age = row[0], float(row[1])
+                if age < WORDCLOUD_MIN_INTERVAL:
+                    return False
+                if stored_version == version and age < WORDCLOUD_MAX_AGE:
+                    return False
+
+            start = time.monotonic()
+            # Term counts were stored per email at ingest (see term_index.py)
+            frequencies = term_index.load_term_frequencies(cur, days=days, source_ids=source_ids)
+            png = offload.run(render_wordcloud_png, frequencies)
+            etag = hashlib.sha1(png).hexdigest()[:20]
+
+            cur.execute('''
+                INSERT INTO wordcloud_images (name, png, etag, data_version, generated_at)
+                VALUES (%s, %s, %s, %s, NOW())
+                ON CONFLICT (name) DO UPDATE
+                SET png = EXCLUDED.png,
+                    etag = EXCLUDED.etag,
+                    data_version = EXCLUDED.data_version,
+                    generated_at = NOW()
+            ''', (name, png, etag, version))
+            if name != DEFAULT_CLOUD:
+                cur.execute('''
+                    DELETE FROM wordcloud_images
+                    WHERE name <> %s AND name NOT IN (
+                        SELECT name FROM wordcloud_images WHERE name <> %s
+                        ORDER BY generated_at DESC LIMIT %s
+                    )
+                ''', (DEFAULT_CLOUD, DEFAULT_CLOUD, WORDCLOUD_MAX_CUSTOM))
+            conn.commit()
+            print(f"Generated word cloud '{name}' ({len(png)} bytes) in {time.monotonic() - start:.1f}s")
+            return True
+        finally:
+            conn.rollback()
+            cur.execute("SELECT pg_advisory_unlock(%s, hashtext(%s))", (_ADVISORY_LOCK_KEY, name))
+            conn.commit()
+            cur.close()
+
+
+def get_image(name=DEFAULT_CLOUD):
+    """Return (png_bytes, etag) for the latest stored image, or (None, None)."""
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT etag FROM wordcloud_images WHERE name = %s", (name,))
+        row = cur.fetchone()
+        if row is None:
+            cur.close()
+            return None, None
+        etag = row[0]
+
+        with _memory_lock:
+            cached = _memory.get(name)
+        if cached and cached[1] == etag:
+            cur.close()
+            return cached
+
+        cur.execute("SELECT png, etag FROM wordcloud_images WHERE name = %s", (name,))
+        row = cur.fetchone()
+        cur.close()
+
+    png, etag = bytes(row[0]), row[1]
+    with _memory_lock:
+        _memory.pop(name, None)
+        _memory[name] = (png, etag)
+        # Drop the least recently loaded images beyond the cap
+        while len(_memory) > _MEMORY_IMAGES:
+            del _memory[next(iter(_memory))]
+    return png, etag
+
+
+def refresh_in_background(days=7, source_ids=None):
+    """Regenerate a cloud on a short-lived thread if it is stale.
+
+    Checks are throttled to one per WORDCLOUD_CHECK_INTERVAL per cloud.
+    """
+    name = cloud_name(days, source_ids)
+    now = time.monotonic()
+    with _memory_lock:
+        if now - _last_checked.get(name, float('-inf')) < WORDCLOUD_CHECK_INTERVAL:
+            return
+        for checked in [key for key, at in _last_checked.items() if now - at >= WORDCLOUD_CHECK_INTERVAL]:
+            del _last_checked[checked]
+        _last_checked[name] = now
+
+    def run():
+        try:
+            refresh(days, source_ids)
+        except Exception as e:
+            print(f"Error generating word cloud: {str(e)}")
+    threading.Thread(target=run, name='wordcloud-refresh', daemon=True).start()
+
+
+def _run_scheduler():
+    # Stagger the first check so a booting worker serves requests first and
+    # workers started together do not all check at once
+    time.sleep(random.uniform(0, WORDCLOUD_CHECK_INTERVAL))
+    while True:
+        try:
+            refresh()
+        except Exception as e:
+            print(f"Error generating word cloud: {str(e)}")
+        time.sleep(WORDCLOUD_CHECK_INTERVAL)
+
+
+def start_scheduler():
+    """Start the regeneration loop on a daemon thread (once per process)."""
+    global _scheduler_thread, _scheduler_pid
+    if _scheduler_thread is not None and _scheduler_pid == os.getpid() and _scheduler_thread.is_alive():
+        return _scheduler_thread
+    _scheduler_pid = os.getpid()
+    _scheduler_thread = threading.Thread(target=_run_scheduler, name='wordcloud-scheduler', daemon=True)
+    _scheduler_thread.start()
+    return _scheduler_thread
@@ -0,0 +1,164 @@
+"""Leased, batched hand-off of processed-flag work to downstream consumers.
+
+Consumers used to GET every unprocessed email (full HTML, no limit) and
+mark them one HTTP call at a time, so two consumers did the same work and
+responses grew with the backlog. Now each consumer claims a batch:
+
+    POST /api/unprocessed-emails/claim?limit=100&fields=urls&lease=300
+    POST /api/unprocessed-emails/ack   {"ids": [1, 2, 3]}
+
+A claim leases rows with FOR UPDATE SKIP LOCKED, so concurrent consumers
+never receive the same email; rows that are not acknowledged before the
+lease expires are handed out again. Claimed rows are streamed back as
+newline-delimited JSON with only the requested columns.
+
+Acks and releases only touch rows the consumer still holds: once a lease
+has expired and another consumer has claimed the row, the late ack from
+the first one matches nothing and is logged. Consumers that do not pass
+a name share one anonymous identity, so they should name themselves.
+"""
+import json
+import os
+from datetime import date, datetime
+
+import db
+import rollups
+
+WORK_QUEUE_LEASE_SECONDS = int(os.environ.get('WORK_QUEUE_LEASE_SECONDS', 300))
+WORK_QUEUE_MAX_CLAIM = int(os.environ.get('WORK_QUEUE_MAX_CLAIM', 1000))
+
+# Columns a consumer may ask for; id is always included
+FIELDS = ('urls', 'body_html', 'body_text', 'plain_text', 'subject', 'from_address',
+          'to_address', 'source_id', 'received_at', 'spam_score')
+# What /api/unprocessed-emails has always returned
+DEFAULT_FIELDS = ('urls', 'body_html', 'received_at')
+
+STREAM_BATCH_SIZE = 50
+
+SCHEMA_SQL = '''
+    ALTER TABLE emails ADD COLUMN IF NOT EXISTS processing_claimed_at TIMESTAMP;
+    ALTER TABLE emails ADD COLUMN IF NOT EXISTS processing_claimed_by TEXT;
+'''
+
+# Built with CREATE INDEX CONCURRENTLY by migrate.py: (name, definition)
+INDEXES = (
+    ('idx_emails_unprocessed', 'ON emails(id) WHERE processed = FALSE AND NOT enrichment_pending'),
+)
+
+
+def install(cur):
+    """Create the lease columns (the partial index on unprocessed rows is in INDEXES)."""
+    cur.execute(SCHEMA_SQL)
+
+
+def parse_fields(value):
+    """Validate a comma-separated field list; raises ValueError on unknown names."""
+    if not value:
+        return DEFAULT_FIELDS
+    fields = tuple(dict.fromkeys(field.strip() for field in value.split(',') if field.strip()))
+    unknown = [field for field in fields if field not in FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+
+def claim(limit, lease_seconds=WORK_QUEUE_LEASE_SECONDS, consumer=None):
+    """Lease up to ``limit`` unprocessed emails and return their ids."""
+    limit = max(1, min(int(limit), WORK_QUEUE_MAX_CLAIM))
+    with db.connection() as conn:
+        cur = conn.cursor()
+        rollups.skip(cur)
+        cur.execute('''
+            UPDATE emails
+            SET processing_claimed_at = NOW(),
+                processing_claimed_by = %s
+            WHERE id IN (
+                SELECT id FROM emails
+                WHERE processed = FALSE
+                  AND NOT enrichment_pending
+                  AND (processing_claimed_at IS NULL
+                       OR processing_claimed_at < NOW() - %s * INTERVAL '1 second')
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id
+        ''', (consumer, lease_seconds, limit))
+        ids = sorted(row[0] for row in cur.fetchall())
+        conn.commit()
+        cur.close()
+    return ids
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def iter_ndjson(ids, fields):
+    """Yield one JSON line per claimed email, fetched in small batches."""
+    columns = ', '.join(('id',) + tuple(fields))
+    for start in range(0, len(ids), STREAM_BATCH_SIZE):
+        batch = ids[start:start + STREAM_BATCH_SIZE]
+        with db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(f'SELECT {columns} FROM emails WHERE id = ANY(%s) ORDER BY id', (batch,))
+            names = [column.name for column in cur.description]
+            rows = cur.fetchall()
+            cur.close()
+        yield ''.join(json.dumps(dict(zip(names, row)), default=_json_default) + '\n' for row in rows)
+
+
+def _log_unmatched(action, ids, updated, consumer):
+    if updated < len(ids):
+        print(f"[work_queue] {len(ids) - updated} of {len(ids)} {action} from consumer {consumer!r} "
+              f"matched no lease it holds (expired and claimed again, or already done)")
+
+
+def ack(ids, consumer=None):
+    """Mark emails processed and release their leases, if ``consumer`` still holds them.
+
+    Returns rows updated.
+    """
+    if not ids:
+        return 0
+    with db.connection() as conn:
+        cur = conn.cursor()
+        rollups.skip(cur)
+        cur.execute('''
+            UPDATE emails
+            SET processed = TRUE,
+                processing_claimed_at = NULL,
+                processing_claimed_by = NULL
+            WHERE id = ANY(%s)
+              AND processing_claimed_at IS NOT NULL
+              AND processing_claimed_by IS NOT DISTINCT FROM %s
+        ''', (list(ids), consumer))
+        updated = cur.rowcount
+        conn.commit()
+        cur.close()
+    _log_unmatched('acks', ids, updated, consumer)
+    return updated
+
+
+def release(ids, consumer=None):
+    """Give leased emails back to the queue without marking them processed."""
+    if not ids:
+        return 0
+    with db.connection() as conn:
+        cur = conn.cursor()
+        rollups.skip(cur)
+        cur.execute('''
+            UPDATE emails
+            SET processing_claimed_at = NULL,
+                processing_claimed_by = NULL
+            WHERE id = ANY(%s) AND processed = FALSE
+              AND processing_claimed_at IS NOT NULL
+              AND processing_claimed_by IS NOT DISTINCT FROM %s
+        ''', (list(ids), consumer))
+        updated = cur.rowcount
+        conn.commit()
+        cur.close()
+    _log_unmatched('releases', ids, updated, consumer)
+    return updated